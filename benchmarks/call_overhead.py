@@ -0,0 +1,112 @@
+"""
+Per-call overhead benchmark for trivial cells such as ``1+1``.
+
+"legacy" replays the old protocol on the same kernel: wait_for_ready (a
+kernel_info round trip), the cell prefixed with a signal.alarm timer, then a
+second wait_for_ready and a separate cell cancelling the timer. "sync" and
+"async" are the current CodeInterpreter.call / AsyncCodeInterpreter.call,
+which send exactly one execute request per cell.
+
+Usage:
+    python benchmarks/call_overhead.py --calls 200 --output overhead.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_interpreter.async_interpreter import AsyncCodeInterpreter  # noqa: E402
+from code_interpreter.interpreter import CodeInterpreter  # noqa: E402
+
+CODE = "1+1"
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "calls": len(latencies),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+
+def _run_until_idle(kc, code: str):
+    msg_id = kc.execute(code)
+    while True:
+        msg = kc.get_iopub_msg()
+        if (
+            msg["parent_header"].get("msg_id") == msg_id
+            and msg["msg_type"] == "status"
+            and msg["content"]["execution_state"] == "idle"
+        ):
+            return
+
+
+def bench_legacy(interpreter: CodeInterpreter, calls: int):
+    kc = interpreter._get_kernel()
+    latencies = []
+    for _ in range(calls):
+        start_time = time.time()
+        kc.wait_for_ready()
+        _run_until_idle(kc, f"import signal; signal.alarm(30)\n{CODE}\n\n")
+        kc.wait_for_ready()
+        _run_until_idle(kc, "signal.alarm(0)")
+        latencies.append(time.time() - start_time)
+    return _summary(latencies)
+
+
+def bench_sync(interpreter: CodeInterpreter, calls: int):
+    latencies = []
+    for _ in range(calls):
+        start_time = time.time()
+        interpreter.call(json.dumps({"code": CODE}), timeout=30)
+        latencies.append(time.time() - start_time)
+    return _summary(latencies)
+
+
+async def bench_async(interpreter: AsyncCodeInterpreter, calls: int):
+    await interpreter.start()
+    latencies = []
+    for _ in range(calls):
+        start_time = time.time()
+        await interpreter.call(json.dumps({"code": CODE}), timeout=30)
+        latencies.append(time.time() - start_time)
+    await interpreter.stop()
+    return _summary(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    cfg = {"work_dir": tempfile.mkdtemp(prefix="m6_bench_")}
+    interpreter = CodeInterpreter(cfg)
+    interpreter.call(json.dumps({"code": CODE}))  # warm up: start the kernel
+    results = {
+        "legacy": bench_legacy(interpreter, args.calls),
+        "sync": bench_sync(interpreter, args.calls),
+        "async": asyncio.run(bench_async(AsyncCodeInterpreter(cfg), args.calls)),
+    }
+    interpreter.shutdown_kernel()
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Kernel startup benchmark: compares the subprocess and zygote launchers and the
+preload profiles.
+
+For every launcher and profile it starts ``--kernels`` kernels one after another
+and reports the time until the kernel is ready, the time spent in the init
+script, the memory of each kernel process (RSS, and USS/PSS which account for
+pages shared copy-on-write with the zygote), and the time the first use of
+pandas and pyplot takes, i.e. the import cost a profile defers to user code.
+
+``--font-cache`` replays a fresh container: "cold" removes the installed font,
+the font list cache and the bootstrap stamp first, "bootstrap" does the same
+and then runs ``python -m code_interpreter.bootstrap`` as the image build
+would. The first kernel pays the font cache rebuild, so it is reported on its
+own as well.
+
+Usage:
+    python benchmarks/kernel_startup.py --kernels 5 --output startup.json
+    python benchmarks/kernel_startup.py --launchers subprocess --profiles minimal full
+    python benchmarks/kernel_startup.py --launchers subprocess --font-cache cold bootstrap
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import matplotlib
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import code_interpreter.interpreter as interpreter_module  # noqa: E402
+from code_interpreter.bootstrap import bootstrap, font_install_path, stamp_path  # noqa: E402
+from code_interpreter.config import KERNEL_PRELOAD_PROFILE  # noqa: E402
+from code_interpreter.interpreter import (  # noqa: E402
+    FONT_FILE,
+    CodeInterpreter,
+    get_init_code,
+)
+from code_interpreter.preload import PRELOAD_PROFILES  # noqa: E402
+from code_interpreter.zygote import get_zygote_launcher  # noqa: E402
+
+# 未预加载的库在这里被导入
+FIRST_USE_CODE = "pd.DataFrame({'x': [1, 2]}).sum()\nplt.close(plt.figure())"
+
+
+def _summary(values):
+    return {
+        "mean": statistics.mean(values),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def _memory(pid: int) -> dict:
+    info = psutil.Process(pid).memory_full_info()
+    return {
+        "rss_mb": info.rss / 2**20,
+        "uss_mb": getattr(info, "uss", 0) / 2**20,
+        "pss_mb": getattr(info, "pss", 0) / 2**20,
+    }
+
+
+def prepare_font_cache(mode: str):
+    """Returns how long the bootstrap took, if it ran."""
+    # 每种场景都重新做一次服务端的字体检查
+    interpreter_module._FONT_CHECKED = False
+    if mode == "warm":
+        return None
+    stale = glob.glob(os.path.join(matplotlib.get_cachedir(), "fontlist-*.json"))
+    for path in stale + [stamp_path(), font_install_path(FONT_FILE)]:
+        if os.path.exists(path):
+            os.remove(path)
+    if mode == "bootstrap":
+        start_time = time.time()
+        bootstrap(FONT_FILE, byte_compile=False)
+        return time.time() - start_time
+    return None
+
+
+def bench_launcher(
+    launcher: str, profile: str, font_cache: str, kernels: int, work_dir: str
+) -> dict:
+    init_code = get_init_code(profile)
+    bootstrap_time = prepare_font_cache(font_cache)
+
+    zygote_start = None
+    if launcher == "zygote":
+        start_time = time.time()
+        get_zygote_launcher(profile)._ensure_started()
+        zygote_start = time.time() - start_time
+
+    started = []
+    font_times, start_times, init_times, first_use_times = [], [], [], []
+    for _ in range(kernels):
+        interpreter = CodeInterpreter(
+            {"work_dir": work_dir, "kernel_launcher": launcher, "preload_profile": profile}
+        )
+        start_time = time.time()
+        interpreter_module._fix_matplotlib_cjk_font_issue()
+        font_times.append(time.time() - start_time)
+        start_time = time.time()
+        kc, proc = interpreter._start_kernel(interpreter.kernel_id)
+        start_times.append(time.time() - start_time)
+        start_time = time.time()
+        interpreter._execute_code(kc, init_code)
+        init_times.append(time.time() - start_time)
+        # Keep the interpreter alive, its __del__ would shut the kernel down.
+        started.append((interpreter, kc, proc))
+
+    # Measure once all kernels are alive so that sharing shows up in PSS.
+    memory = [_memory(proc.pid) for _, _, proc in started]
+    for interpreter, kc, _ in started:
+        start_time = time.time()
+        interpreter._execute_code(kc, FIRST_USE_CODE)
+        first_use_times.append(time.time() - start_time)
+    for _, kc, proc in started:
+        kc.shutdown()
+        proc.terminate()
+
+    return {
+        "launcher": launcher,
+        "profile": profile,
+        "font_cache": font_cache,
+        "kernels": kernels,
+        "bootstrap_s": bootstrap_time,
+        "zygote_start_s": zygote_start,
+        "first_kernel": {
+            "font_check_s": font_times[0],
+            "kernel_start_s": start_times[0],
+            "init_script_s": init_times[0],
+            "first_use_s": first_use_times[0],
+        },
+        "font_check_s": _summary(font_times),
+        "kernel_start_s": _summary(start_times),
+        "init_script_s": _summary(init_times),
+        "total_s": _summary(
+            [sum(x) for x in zip(font_times, start_times, init_times)]
+        ),
+        "first_use_s": _summary(first_use_times),
+        "memory": {
+            key: _summary([m[key] for m in memory]) for key in memory[0]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--kernels", type=int, default=5)
+    parser.add_argument(
+        "--launchers", nargs="+", default=["subprocess", "zygote"]
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=[KERNEL_PRELOAD_PROFILE],
+        choices=sorted(PRELOAD_PROFILES),
+    )
+    parser.add_argument(
+        "--font-cache",
+        nargs="+",
+        default=["warm"],
+        choices=["warm", "cold", "bootstrap"],
+    )
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp(prefix="m6_bench_")
+    results = [
+        bench_launcher(launcher, profile, font_cache, args.kernels, work_dir)
+        for launcher in args.launchers
+        for profile in args.profiles
+        for font_cache in args.font_cache
+    ]
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(text)
+
+
+if __name__ == "__main__":
+    main()
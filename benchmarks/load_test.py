@@ -0,0 +1,373 @@
+"""
+Load test for the HTTP (/execute) and WebSocket (/ws) servers.
+
+It starts the servers locally (or targets ``--http-url`` / ``--ws-url``),
+runs ``--sessions`` concurrent sessions of ``--requests`` cells each, picking
+cells from a weighted workload mix, and reports throughput and p50/p95/p99
+latency per workload. The first cell of a session (which has to get a
+kernel) is reported as "cold", the others as "warm". While the test runs,
+the server RSS and the number of kernels are sampled.
+
+Workloads: trivial, cpu, stdout (large output), plot (matplotlib figure),
+files (reads a CSV passed in ``files``), timeout (exceeds its timeout).
+
+Usage:
+    python benchmarks/load_test.py --protocols http ws --sessions 8 \\
+        --requests 20 --mix trivial=5,cpu=2,stdout=1,plot=1,files=1,timeout=0.2 \\
+        --output load.json
+"""
+
+import argparse
+import asyncio
+import functools
+import http.server
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import psutil
+import requests
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKLOADS = {
+    "trivial": {"code": "1+1"},
+    "cpu": {"code": "sum(i * i for i in range(2_000_000))"},
+    "stdout": {"code": "for i in range(20000):\n    print('line', i)"},
+    "plot": {
+        "code": "import numpy as np\nimport matplotlib.pyplot as plt\n"
+        "plt.plot(np.random.rand(1000))\nplt.show()"
+    },
+    "files": {
+        "code": "import pandas as pd\npd.read_csv('load_test.csv').describe()",
+        "files": ["{file_url}"],
+    },
+    "timeout": {"code": "import time\ntime.sleep(10)", "timeout": 0.5},
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(latencies: List[float]) -> Dict:
+    if not latencies:
+        return {"count": 0}
+    latencies = sorted(latencies)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        "count": len(latencies),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def _parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in WORKLOADS:
+            raise ValueError(f"Unknown workload {name}, choose from {list(WORKLOADS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class FileServer:
+    """Serves the CSV used by the "files" workload."""
+
+    def __init__(self, rows: int = 100_000):
+        self.dir = tempfile.mkdtemp(prefix="m6_load_files_")
+        with open(os.path.join(self.dir, "load_test.csv"), "w") as fout:
+            fout.write("a,b,c\n")
+            for i in range(rows):
+                fout.write(f"{i},{i * 2},{i % 7}\n")
+        handler = functools.partial(_QuietHandler, directory=self.dir)
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/load_test.csv"
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Server:
+    """A local uvicorn server with its own work dir."""
+
+    def __init__(self, app: str, env: Dict[str, str]):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log = open(os.path.join(env["M6_CODE_INTERPRETER_WORK_DIR"], f"{app}.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", f"{app}:app", "--port", str(self.port)],
+            cwd=ROOT,
+            env={**os.environ, **env},
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                requests.get(f"{self.url}/sessions", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise RuntimeError(f"{app} did not start, see {self.log.name}")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+class Sampler:
+    """Samples the server process RSS, kernel RSS and kernel count."""
+
+    def __init__(self, base_url: str, pid: Optional[int], interval: float):
+        self.base_url = base_url
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[Dict] = []
+        self._stopped = threading.Event()
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> List[Dict]:
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            sample: Dict = {"t": time.time() - self._start_time}
+            try:
+                sessions = requests.get(f"{self.base_url}/sessions", timeout=5).json()
+                pool = requests.get(f"{self.base_url}/pool", timeout=5).json()
+                sample["session_kernels"] = sessions["live_kernels"]
+                sample["busy_kernels"] = sessions["busy_kernels"]
+                sample["pool_kernels"] = pool["idle"] + pool["starting"]
+                sample["kernel_rss_mb"] = sessions["kernel_rss_mb"]
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+            if self.pid is not None:
+                try:
+                    sample["server_rss_mb"] = psutil.Process(self.pid).memory_info().rss / 2**20
+                except psutil.Error:
+                    pass
+            self.samples.append(sample)
+
+
+def wait_for_pool(base_url: str, timeout: float = 180):
+    """Wait until the kernel pool is warm, so "cold" measures a pool hit, not a boot."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pool = requests.get(f"{base_url}/pool", timeout=5).json()
+        if pool["idle"] >= pool["min_size"]:
+            return
+        time.sleep(0.5)
+
+
+def _request(workload: str, file_url: str) -> Dict:
+    request = dict(WORKLOADS[workload])
+    if "files" in request:
+        request["files"] = [f.format(file_url=file_url) for f in request["files"]]
+    return request
+
+
+def run_http_session(url: str, api_key: str, cells: List[str], file_url: str) -> List[Dict]:
+    records = []
+    with requests.Session() as session:
+        session.headers["X-API-Key"] = api_key
+        for i, workload in enumerate(cells):
+            request = _request(workload, file_url)
+            start_time = time.time()
+            try:
+                response = session.post(f"{url}/execute", json=request, timeout=120)
+                ok = response.status_code == 200
+                status = response.json().get("status") if ok else "http_error"
+            except requests.RequestException:
+                status = "http_error"
+            records.append(
+                {
+                    "workload": workload,
+                    "cold": i == 0,
+                    "latency": time.time() - start_time,
+                    "status": status,
+                }
+            )
+        session.post(f"{url}/release", timeout=30)
+    return records
+
+
+async def run_ws_session(url: str, api_key: str, cells: List[str], file_url: str) -> List[Dict]:
+    records = []
+    async with websockets.connect(
+        url, extra_headers={"X-API-Key": api_key}, max_size=None
+    ) as ws:
+        for i, workload in enumerate(cells):
+            request = {"type": "execute", **_request(workload, file_url)}
+            start_time = time.time()
+            await ws.send(json.dumps(request))
+            response = json.loads(await ws.recv())
+            records.append(
+                {
+                    "workload": workload,
+                    "cold": i == 0,
+                    "latency": time.time() - start_time,
+                    "status": response.get("status"),
+                }
+            )
+        await ws.send(json.dumps({"type": "release"}))
+        await ws.recv()
+    return records
+
+
+def _session_cells(mix: Dict[str, float], requests_per_session: int, rng: random.Random):
+    names, weights = list(mix), list(mix.values())
+    return rng.choices(names, weights=weights, k=requests_per_session)
+
+
+async def run_protocol(protocol: str, base_url: str, args, file_url: str) -> Dict:
+    rng = random.Random(args.seed)
+    plans = [
+        _session_cells(args.mix, args.requests, rng) for _ in range(args.sessions)
+    ]
+    start_time = time.time()
+    if protocol == "http":
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        executor, run_http_session, base_url, f"load-http-{i}", cells, file_url
+                    )
+                    for i, cells in enumerate(plans)
+                )
+            )
+    else:
+        ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://") + "/ws"
+        results = await asyncio.gather(
+            *(
+                run_ws_session(ws_url, f"load-ws-{i}", cells, file_url)
+                for i, cells in enumerate(plans)
+            )
+        )
+    elapsed = time.time() - start_time
+    records = [r for session in results for r in session]
+
+    workloads = {}
+    for name in args.mix:
+        selected = [r for r in records if r["workload"] == name]
+        workloads[name] = {
+            "cold": _percentiles([r["latency"] for r in selected if r["cold"]]),
+            "warm": _percentiles([r["latency"] for r in selected if not r["cold"]]),
+            "statuses": {
+                s: sum(1 for r in selected if r["status"] == s)
+                for s in sorted({str(r["status"]) for r in selected})
+            },
+        }
+    return {
+        "requests": len(records),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(records) / elapsed,
+        "cold": _percentiles([r["latency"] for r in records if r["cold"]]),
+        "warm": _percentiles([r["latency"] for r in records if not r["cold"]]),
+        "workloads": workloads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--protocols", nargs="+", default=["http", "ws"], choices=["http", "ws"])
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="cells per session")
+    parser.add_argument(
+        "--mix", type=_parse_mix, default=_parse_mix("trivial=5,cpu=2,stdout=1,plot=1,files=1,timeout=0.2")
+    )
+    parser.add_argument("--http-url", default="", help="use a running HTTP server")
+    parser.add_argument("--ws-url", default="", help="use a running WebSocket server")
+    parser.add_argument("--sample-interval", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-pool-wait", action="store_true", help="start before the kernel pool is warm"
+    )
+    parser.add_argument(
+        "--env", nargs="*", default=[], help="extra KEY=VALUE settings for locally started servers"
+    )
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    file_server = FileServer()
+    work_dir = tempfile.mkdtemp(prefix="m6_load_")
+    env = {"M6_CODE_INTERPRETER_WORK_DIR": work_dir, **dict(e.split("=", 1) for e in args.env)}
+    results: Dict = {
+        "config": {
+            "sessions": args.sessions,
+            "requests_per_session": args.requests,
+            "mix": args.mix,
+            "env": env,
+        }
+    }
+    try:
+        for protocol in args.protocols:
+            target = args.http_url if protocol == "http" else args.ws_url
+            server = None if target else Server("server" if protocol == "http" else "ws_server", env)
+            base_url = target or server.url  # type: ignore
+            if not args.no_pool_wait:
+                wait_for_pool(base_url)
+            sampler = Sampler(base_url, server.process.pid if server else None, args.sample_interval)
+            sampler.start()
+            try:
+                result = asyncio.run(run_protocol(protocol, base_url, args, file_server.url))
+            finally:
+                result_samples = sampler.stop()
+                if server is not None:
+                    server.stop()
+            result["samples"] = result_samples
+            results[protocol] = result
+            print(
+                f"{protocol}: {result['throughput_rps']:.1f} req/s, "
+                f"warm p50 {result['warm'].get('p50_ms', 0):.1f} ms, "
+                f"cold p50 {result['cold'].get('p50_ms', 0):.1f} ms",
+                file=sys.stderr,
+            )
+    finally:
+        file_server.stop()
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(text)
+
+
+if __name__ == "__main__":
+    main()
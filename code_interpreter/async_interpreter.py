@@ -1,35 +1,667 @@
 import asyncio
-from typing import Dict, List, Optional, Union
+import json
+import os
+import queue
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-from code_interpreter.interpreter import AnyThreadEventLoopPolicy, CodeInterpreter
+from jupyter_client import AsyncKernelClient  # type: ignore
+
+from code_interpreter.config import (
+    INTERRUPT_GRACE_PERIOD,
+    KERNEL_STARTUP_TIMEOUT,
+    SESSION_HIBERNATE_TIMEOUT,
+    STREAM_FLUSH_INTERVAL,
+    STREAM_MAX_BATCH_CHARS,
+)
+from code_interpreter.dispatcher import IopubDispatcher
+from code_interpreter.hibernation import load_namespace_code, save_namespace_code
+from code_interpreter.interpreter import (
+    _TIMEOUT_MESSAGE,
+    _UNEXPECTED_ERROR_MESSAGE,
+    AnyThreadEventLoopPolicy,
+    CodeInterpreter,
+)
+from code_interpreter.logger import logging
+from code_interpreter.metrics import HIBERNATIONS, KERNEL_RESTARTS, PHASE_SECONDS, TIMEOUTS
+from code_interpreter.output_buffer import OutputList
+from code_interpreter.scheduler import kernel_started
+from code_interpreter.utils import print_traceback
+
+_ABORTED_MESSAGE = "Aborted: the kernel was shut down before this code finished."
 
 
 class AsyncCodeInterpreter:
-    def __init__(self, cfg: Optional[Dict] = None):
-        self.interpreter = CodeInterpreter(cfg)
+    """Asyncio front-end of CodeInterpreter.
+
+    The kernel is started (or taken from the pool) by the wrapped
+    CodeInterpreter, but executions go through an AsyncKernelClient whose
+    shell/iopub messages are awaited on the event loop, so an in-flight or idle
+    session does not occupy a thread.
+
+    Concurrent executions on the same session are pipelined: each request is
+    sent to the kernel as soon as it arrives, the kernel runs them in order,
+    and an IopubDispatcher hands every output to the request it belongs to.
+
+    Timeouts are enforced here rather than inside the kernel: when the deadline
+    passes the kernel is interrupted, and if it is still busy after
+    ``interrupt_grace_period`` seconds it is replaced by a fresh one. The
+    deadline of a request starts when the kernel gets to it, not when it is
+    sent; requests still queued behind a restarted kernel are "aborted".
+    """
+
+    def __init__(
+        self,
+        cfg: Optional[Dict] = None,
+        kernel_pool=None,
+        interrupt_grace_period: float = INTERRUPT_GRACE_PERIOD,
+        registry=None,
+        session_key: Optional[str] = None,
+    ):
+        self.interpreter = CodeInterpreter(
+            cfg, kernel_pool=kernel_pool, registry=registry, session_key=session_key
+        )
+        self.interrupt_grace_period = interrupt_grace_period
+        self._kc: Optional[AsyncKernelClient] = None
+        self._dispatcher: Optional[IopubDispatcher] = None
+        # 只在获取 kernel 与发送请求时持有；请求发出后按 msg_id 各自读取输出，不再互相等待
+        self._lock = asyncio.Lock()
+        # 超时重启时旧 kernel 的关闭，获取新 kernel 之前要等它结束
+        self._shutdown: Optional[asyncio.Future] = None
+        # 休眠时用户变量的快照文件；存在时，下次拿到新 kernel 会先恢复它
+        self.snapshot_path: Optional[str] = None
+        self._restore_report: Optional[Dict] = None
         asyncio.set_event_loop_policy(AnyThreadEventLoopPolicy())
 
     async def call(
         self,
         params: str,
         files: List[str] = [],
-        timeout: Optional[int] = 30,
+        timeout: Optional[float] = 30,
         **kwargs,
     ) -> str:
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None, self._execute_code_sync, params, files, timeout
+        return (await self.execute(params, files, timeout))["result"]
+
+    async def execute(
+        self,
+        params: str,
+        files: List[str] = [],
+        timeout: Optional[float] = 30,
+        datasets: List[str] = [],
+        output_format: str = "markdown",
+        image_data: bool = False,
+    ) -> Dict:
+        """Run the code and return the result together with how it ended.
+
+        ``status`` is "error" if the deadline passed, and ``recovery`` then says
+        whether interrupting the kernel was enough ("interrupted") or the
+        kernel had to be replaced ("restarted"). ``datasets`` are mounted in
+        the working directory first (see DatasetStore).
+
+        With ``output_format="structured"`` the outputs come as a list instead
+        of the markdown ``result`` (see OutputList), and ``status`` is also
+        "error" if the code raised; ``image_data`` returns images as bytes.
+        """
+        structured = output_format == "structured"
+        code = self.interpreter._parse_code(params)
+        if not code.strip():
+            if structured:
+                return {"status": "success", "recovery": None, **OutputList().result()}
+            return {"result": "", "status": "success", "recovery": None}
+        self.interpreter._mount_datasets(datasets)
+        loop = asyncio.get_running_loop()
+        # 下载文件与获取 kernel 同时进行
+        downloads = (
+            loop.run_in_executor(None, self.interpreter._download_files, files)
+            if files
+            else None
+        )
+
+        async with self._lock:
+            dispatcher = await self._get_kernel()
+            if downloads is not None:
+                await downloads
+            msg_id = dispatcher.execute(self.interpreter._prepare_code(code), stop_on_error=False)
+        outcome: Dict = {"status": "success", "recovery": None}
+        if structured:
+            outcome.update(await self._collect(dispatcher, msg_id, timeout, outcome, image_data))
+        else:
+            result = await self._execute_code(dispatcher, msg_id, timeout, outcome)
+            outcome["result"] = result if result.strip() else "Finished execution."
+        self._attach_restore_report(outcome)
+        return outcome
+
+    async def execute_batch(
+        self,
+        cells: List[str],
+        files: List[str] = [],
+        timeout: Optional[float] = 30,
+        stop_on_error: bool = True,
+        datasets: List[str] = [],
+        output_format: str = "markdown",
+        image_data: bool = False,
+    ) -> List[Dict]:
+        """Run ``cells`` in order, sending them to the kernel all at once.
+
+        Returns one result per cell. A cell's ``status`` is "error" if it raised
+        or exceeded ``timeout`` (which applies to each cell separately), and
+        with ``stop_on_error`` the cells after it are "aborted" by the kernel.
+        The kernel aborts every request queued behind the failed cell, so with
+        ``stop_on_error`` other requests on the session wait for the batch.
+        ``output_format`` and ``image_data`` are as in ``execute``.
+        """
+        structured = output_format == "structured"
+        self.interpreter._mount_datasets(datasets)
+        loop = asyncio.get_running_loop()
+        downloads = (
+            loop.run_in_executor(None, self.interpreter._download_files, files)
+            if files
+            else None
+        )
+
+        async with self._lock:
+            dispatcher = await self._get_kernel()
+            if downloads is not None:
+                await downloads
+            msg_ids = [
+                dispatcher.execute(
+                    self.interpreter._prepare_code(code), stop_on_error=stop_on_error
+                )
+                if code.strip()
+                else None
+                for code in cells
+            ]
+            if stop_on_error:
+                results = await self._run_batch(
+                    dispatcher, msg_ids, timeout, stop_on_error, structured, image_data
+                )
+        if not stop_on_error:
+            results = await self._run_batch(
+                dispatcher, msg_ids, timeout, stop_on_error, structured, image_data
+            )
+        if not structured:
+            for result in results:
+                if not result["result"].strip() and result["status"] != "aborted":
+                    result["result"] = "Finished execution."
+        return results
+
+    async def _run_batch(
+        self,
+        dispatcher: IopubDispatcher,
+        msg_ids: List[Optional[str]],
+        timeout: Optional[float],
+        stop_on_error: bool,
+        structured: bool = False,
+        image_data: bool = False,
+    ) -> List[Dict]:
+        results = [
+            {
+                **(OutputList().result() if structured else {"result": ""}),
+                "status": "success",
+                "recovery": None,
+            }
+            for _ in msg_ids
+        ]
+        # 全部 cell 已经一次性发给 kernel，kernel 按顺序执行；每个 cell 的超时从 kernel 开始执行它时计算
+        for i, msg_id in enumerate(msg_ids):
+            if msg_id is None:
+                continue
+            if results[i]["status"] == "aborted":
+                # kernel 会丢弃排在出错 cell 后面的请求(stop_on_error)，不再等它们的输出
+                dispatcher.discard(msg_id)
+                continue
+            if structured:
+                results[i].update(
+                    await self._collect(dispatcher, msg_id, timeout, results[i], image_data)
+                )
+            else:
+                output = self.interpreter._new_output_buffer()
+                async for msg_type, text, image_url in self._iter_outputs(
+                    dispatcher, msg_id, timeout, results[i]
+                ):
+                    if msg_type == "error":
+                        results[i]["status"] = "error"
+                    output.add(msg_type, text)
+                    if image_url:
+                        output.add_image(image_url)
+                results[i]["result"] = output.getvalue()
+            if results[i]["recovery"] == "restarted" or (
+                stop_on_error and results[i]["status"] == "error"
+            ):
+                for result in results[i + 1 :]:
+                    result["status"] = "aborted"
+        if stop_on_error:
+            # 被丢弃的请求处理完之前，后面的请求也会被 kernel 丢弃
+            await dispatcher.drained()
+        return results
+
+    async def _get_kernel(self) -> IopubDispatcher:
+        """The dispatcher of the session's kernel, starting or restoring it if needed.
+
+        Called with ``_lock`` held.
+        """
+        if self._kc is not None and self.interpreter.kernel_pid is None:
+            # kernel 进程已退出，下面会重新获取一个
+            self._drop_kernel()
+        if self._shutdown is not None:
+            await self._shutdown
+            self._shutdown = None
+        while self._kc is None:
+            # Starting a kernel is a one-off per session (and instant on a pool
+            # hit), so it is fine to do it in a worker thread.
+            loop = asyncio.get_running_loop()
+            blocking_kc = await loop.run_in_executor(None, self.interpreter._get_kernel)
+            # The blocking client is only kept for shutdown; nobody reads its iopub.
+            blocking_kc.iopub_channel.stop()
+            kc = AsyncKernelClient()
+            kc.load_connection_info(blocking_kc.get_connection_info())
+            kc.start_channels()
+            # 只在拿到 kernel 时确认一次就绪(同时确保 iopub 已订阅)，之后每次执行只发一个请求
+            await self._wait_for_ready(kc)
+            self._kc = kc
+            self._dispatcher = IopubDispatcher(kc)
+            if (
+                self.snapshot_path
+                and os.path.exists(self.snapshot_path)
+                and not self.interpreter.kernel_attached
+            ):
+                # 恢复超时会重启 kernel，那样会再循环一次拿新的 kernel
+                await self._restore(self._dispatcher, self.snapshot_path)
+        return self._dispatcher  # type: ignore
+
+    def _drop_kernel(self):
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+            self._dispatcher = None
+        if self._kc is not None:
+            self._kc.stop_channels()
+            self._kc = None
+
+    async def _wait_for_ready(self, kc: AsyncKernelClient):
+        """Like ``kc.wait_for_ready``, but without polling the heartbeat first.
+
+        The kernel is already running, so the kernel_info reply comes back as
+        soon as the channels are connected.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + KERNEL_STARTUP_TIMEOUT
+        while True:
+            kc.kernel_info()
+            try:
+                msg = await kc.get_shell_msg(timeout=0.25)
+            except queue.Empty:
+                pass
+            else:
+                if msg["msg_type"] == "kernel_info_reply":
+                    # iopub 收到了这次请求的 status 才算订阅成功，否则重新请求
+                    try:
+                        await kc.get_iopub_msg(timeout=0.2)
+                    except queue.Empty:
+                        pass
+                    else:
+                        return
+            if self.interpreter.kernel_pid is None:
+                raise RuntimeError("Kernel died before replying to kernel_info")
+            if loop.time() > deadline:
+                raise RuntimeError(
+                    f"Kernel did not become ready within {KERNEL_STARTUP_TIMEOUT} seconds"
+                )
+
+    async def hibernate(
+        self, path: str, max_bytes: int, max_variable_bytes: int, timeout: Optional[float]
+    ) -> Optional[Dict]:
+        """Save the user namespace to ``path`` and shut the kernel down.
+
+        Returns the report of saved and skipped variables, or None if there
+        was nothing to save: no kernel, or one that another worker owns (it
+        is only detached from then). If saving fails the kernel is shut down
+        anyway and the error is raised.
+        """
+        async with self._lock:
+            if self._dispatcher is not None:
+                # 等已经发出的请求执行完，新的请求在锁外等待
+                await self._dispatcher.drained()
+            if (
+                self._dispatcher is None
+                or self.interpreter.kernel_pid is None
+                or self.interpreter.kernel_attached
+            ):
+                await self.stop()
+                return None
+            try:
+                with PHASE_SECONDS.time("hibernate"):
+                    report = await self._run_json(
+                        self._dispatcher,
+                        save_namespace_code(path, max_bytes, max_variable_bytes),
+                        timeout,
+                    )
+                HIBERNATIONS.inc("hibernate")
+                self.snapshot_path = path
+                return report
+            except Exception:
+                HIBERNATIONS.inc("failed")
+                raise
+            finally:
+                await self.stop()
+
+    async def _restore(self, dispatcher: IopubDispatcher, path: str):
+        # 先挪开再恢复：只恢复一次，恢复超时重启 kernel 时也不会再次触发
+        restoring = f"{path}.restoring"
+        os.replace(path, restoring)
+        try:
+            with PHASE_SECONDS.time("restore"):
+                self._restore_report = await self._run_json(
+                    dispatcher, load_namespace_code(restoring), SESSION_HIBERNATE_TIMEOUT
+                )
+            HIBERNATIONS.inc("restore")
+            logging.info(f"Restored session from {path}: {self._restore_report}")
+        except Exception as e:
+            print_traceback()
+            self._restore_report = {"restored": [], "error": str(e)}
+        finally:
+            os.remove(restoring)
+
+    async def _run_json(
+        self, dispatcher: IopubDispatcher, code: str, timeout: Optional[float]
+    ) -> Dict:
+        """Run one of our own snippets and parse the JSON report it prints."""
+        stdout, errors = [], []
+        outcome: Dict = {}
+        msg_id = dispatcher.execute(code, stop_on_error=False)
+        async for msg_type, text, _ in self._iter_outputs(dispatcher, msg_id, timeout, outcome):
+            if msg_type == "stdout":
+                stdout.append(text)
+            elif msg_type == "error":
+                errors.append(text)
+        if errors or outcome.get("recovery"):
+            raise RuntimeError("\n".join(errors) or "Timed out")
+        return json.loads("".join(stdout).strip().splitlines()[-1])
+
+    def _attach_restore_report(self, outcome: Dict):
+        # 恢复后的第一次执行带上报告，告诉调用方哪些变量没能恢复
+        if self._restore_report is not None:
+            outcome["restore"], self._restore_report = self._restore_report, None
+
+    async def _restart_kernel(self, dispatcher: IopubDispatcher):
+        """Kill the kernel behind ``dispatcher``; the next request gets a new one.
+
+        The requests still queued on it are aborted. Nothing happens if the
+        kernel has already been replaced, e.g. by another timed-out request.
+        """
+        if dispatcher is not self._dispatcher:
+            return
+        self._drop_kernel()
+        loop = asyncio.get_running_loop()
+        shutdown = self._shutdown = loop.run_in_executor(
+            None, self.interpreter.shutdown_kernel, True
+        )
+        await shutdown
+        if self._shutdown is shutdown:
+            self._shutdown = None
+
+    async def stream(
+        self,
+        params: str,
+        files: List[str] = [],
+        timeout: Optional[float] = 30,
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        datasets: List[str] = [],
+        output_format: str = "markdown",
+        image_data: bool = False,
+        **kwargs,
+    ) -> AsyncIterator[Dict]:
+        """Yield the outputs of one execution as they arrive, then a "done" event.
+
+        Consecutive stdout/stderr fragments are merged for up to
+        ``flush_interval`` seconds, so a chatty loop does not turn into one
+        event per line. Every other output is yielded right away. With
+        ``output_format="structured"`` the events carry the outputs of the
+        structured format, and the "done" event the execution count and error.
+        """
+        structured = output_format == "structured"
+        outcome: Dict = {"status": "success", "recovery": None}
+        if structured:
+            outcome.update(execution_count=None, ename=None, evalue=None)
+        code = self.interpreter._parse_code(params)
+        if not code.strip():
+            yield {"type": "done", **outcome}
+            return
+        self.interpreter._mount_datasets(datasets)
+        loop = asyncio.get_running_loop()
+        downloads = (
+            loop.run_in_executor(None, self.interpreter._download_files, files)
+            if files
+            else None
+        )
+
+        async with self._lock:
+            dispatcher = await self._get_kernel()
+            if downloads is not None:
+                await downloads
+            msg_id = dispatcher.execute(self.interpreter._prepare_code(code), stop_on_error=False)
+        parse = (
+            partial(self.interpreter._parse_output, image_data=image_data) if structured else None
         )
+        outputs = self._iter_outputs(dispatcher, msg_id, timeout, outcome, parse)
+        pending: Optional[Dict] = None
+        flush_at = 0.0
+        next_output = asyncio.ensure_future(outputs.__anext__())
+        try:
+            while True:
+                wait = None if pending is None else max(0.0, flush_at - loop.time())
+                done, _ = await asyncio.wait({next_output}, timeout=wait)
+                if not done:
+                    yield _text_event(pending)  # type: ignore
+                    pending = None
+                    continue
+                try:
+                    output = next_output.result()
+                except StopAsyncIteration:
+                    break
+                next_output = asyncio.ensure_future(outputs.__anext__())
+                if structured:
+                    if output["kind"] == "execute_input":
+                        outcome["execution_count"] = output["execution_count"]
+                        continue
+                    if output["kind"] == "error":
+                        if outcome["status"] == "success":
+                            outcome["status"] = "error"
+                        outcome.update(ename=output["ename"], evalue=output["evalue"])
+                    event = {"type": "output", **output}
+                    # 同一个流(stdout/stderr)的连续输出合并
+                    key = output["name"] if output["kind"] == "stream" else None
+                else:
+                    msg_type, text, image_url = output
+                    event = {"type": "output", "msg_type": msg_type}
+                    if text:
+                        event["text"] = text
+                    if image_url:
+                        event["image"] = image_url
+                    key = msg_type if msg_type in ("stdout", "stderr") and not image_url else None
+                if key is not None:
+                    text = event["text"]
+                    if pending is not None and pending["key"] == key:
+                        pending["text"].append(text)
+                        pending["size"] += len(text)
+                        if pending["size"] >= STREAM_MAX_BATCH_CHARS:
+                            yield _text_event(pending)
+                            pending = None
+                        continue
+                    if pending is not None:
+                        yield _text_event(pending)
+                    pending = {"key": key, "event": event, "text": [text], "size": len(text)}
+                    flush_at = loop.time() + flush_interval
+                    continue
+                if pending is not None:
+                    yield _text_event(pending)
+                    pending = None
+                yield event
+            if pending is not None:
+                yield _text_event(pending)
+        finally:
+            next_output.cancel()
+            await asyncio.wait({next_output})
+            await outputs.aclose()
+        self._attach_restore_report(outcome)
+        yield {"type": "done", **outcome}
 
-    def _execute_code_sync(
-        self, params: str, files: List[str] = [], timeout: Optional[int] = 30
+    async def _execute_code(
+        self,
+        dispatcher: IopubDispatcher,
+        msg_id: str,
+        timeout: Optional[float] = None,
+        outcome: Optional[Dict] = None,
     ) -> str:
-        return self.interpreter.call(params, files, timeout)
+        output = self.interpreter._new_output_buffer()
+        async for msg_type, text, image_url in self._iter_outputs(
+            dispatcher, msg_id, timeout, outcome
+        ):
+            output.add(msg_type, text)
+            if image_url:
+                output.add_image(image_url)
+        return output.getvalue()
+
+    async def _collect(
+        self,
+        dispatcher: IopubDispatcher,
+        msg_id: str,
+        timeout: Optional[float],
+        outcome: Dict,
+        image_data: bool = False,
+    ) -> Dict:
+        """The outputs of ``msg_id`` in the structured format (see OutputList)."""
+        outputs = self.interpreter._new_output_list()
+        async for output in self._iter_outputs(
+            dispatcher,
+            msg_id,
+            timeout,
+            outcome,
+            partial(self.interpreter._parse_output, image_data=image_data),
+        ):
+            outputs.add(output)
+        result = outputs.result()
+        if result["ename"] is not None and outcome["status"] == "success":
+            outcome["status"] = "error"
+        return result
+
+    def _render(self, msg: Dict) -> Optional[Tuple[str, str, str]]:
+        # markdown 格式的 (msg_type, text, image_url)，没有内容的消息跳过
+        msg_type, text, image_url, _ = self.interpreter._parse_iopub_msg(msg)
+        return (msg_type, text, image_url) if text or image_url else None
+
+    async def _iter_outputs(
+        self,
+        dispatcher: IopubDispatcher,
+        msg_id: str,
+        timeout: Optional[float] = None,
+        outcome: Optional[Dict] = None,
+        parse: Optional[Callable[[Dict], Any]] = None,
+    ) -> AsyncIterator[Any]:
+        """Yield ``parse(msg)`` for each output message of ``msg_id`` until it is done.
+
+        ``parse`` defaults to the (msg_type, text, image_url) of the markdown
+        format; messages it turns into None are skipped. Timeouts and aborts
+        are reported as error messages too.
+
+        ``timeout`` counts from when the kernel starts on the request. If it
+        passes, the kernel is interrupted and then restarted if needed;
+        ``outcome`` records which of the two happened.
+        """
+        outcome = {} if outcome is None else outcome
+        parse = parse or self._render
+        loop = asyncio.get_running_loop()
+        try:
+            sent_at = loop.time()
+            await dispatcher.started(msg_id)
+            start_time = loop.time()
+            PHASE_SECONDS.observe(start_time - sent_at, "queue_wait")
+            kernel_started(start_time - sent_at)
+            deadline = start_time + timeout if timeout else None
+            interrupted = False
+            while True:
+                output = None
+                try:
+                    wait = None if deadline is None else deadline - loop.time()
+                    if wait is not None and wait <= 0:
+                        raise queue.Empty
+                    msg = await dispatcher.get(msg_id, timeout=wait)
+                    if msg is None:
+                        # 另一个请求超时重启了 kernel，这个请求不会再被执行
+                        outcome.update(status="aborted", recovery="restarted")
+                        yield parse(_error_msg("ExecutionAborted", _ABORTED_MESSAGE))
+                        return
+                    finished = (
+                        msg["msg_type"] == "status"
+                        and msg["content"].get("execution_state") == "idle"
+                    )
+                    # After an interrupt, the error is the KeyboardInterrupt traceback,
+                    # already reported as a timeout.
+                    if msg["msg_type"] != "status" and not (
+                        interrupted and msg["msg_type"] == "error"
+                    ):
+                        output = parse(msg)
+                except queue.Empty:
+                    if not interrupted:
+                        logging.warning(f"Execution exceeded {timeout}s, interrupting kernel")
+                        TIMEOUTS.inc()
+                        self.interpreter.interrupt_kernel()
+                        interrupted = True
+                        outcome.update(status="error", recovery="interrupted")
+                        deadline = loop.time() + self.interrupt_grace_period
+                        yield parse(_error_msg("ExecutionTimeout", _TIMEOUT_MESSAGE))
+                        continue
+                    logging.warning("Kernel did not respond to the interrupt, restarting it")
+                    KERNEL_RESTARTS.inc()
+                    PHASE_SECONDS.observe(loop.time() - start_time, "execution")
+                    outcome.update(recovery="restarted")
+                    await self._restart_kernel(dispatcher)
+                    return
+                except Exception:
+                    print_traceback()
+                    output = parse(_error_msg("InternalError", _UNEXPECTED_ERROR_MESSAGE))
+                    finished = True
+                if self.interpreter._image_writes:
+                    # 图片在线程池里落盘，这里只等待它写完，不阻塞事件循环
+                    await self._wait_image_writes()
+                if finished:
+                    PHASE_SECONDS.observe(loop.time() - start_time, "execution")
+                if output is not None:
+                    yield output
+                if finished:
+                    return
+        finally:
+            dispatcher.discard(msg_id)
+
+    async def _wait_image_writes(self):
+        futures, self.interpreter._image_writes = self.interpreter._image_writes, []
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(f) for f in futures])
+
+    @property
+    def busy(self) -> bool:
+        return (
+            self._lock.locked()
+            or self._shutdown is not None
+            or (self._dispatcher is not None and self._dispatcher.in_flight > 0)
+        )
 
     async def start(self):
-        # Any initialization code can go here
-        pass
+        await self._get_kernel()
+
+    async def stop(self, release: bool = False):
+        """Let go of the kernel; see CodeInterpreter.close for ``release``."""
+        self._drop_kernel()
+        self.interpreter.close(release)
+
+
+def _text_event(pending: Dict) -> Dict:
+    return {**pending["event"], "text": "".join(pending["text"])}
+
 
-    async def stop(self):
-        # Cleanup code can go here
-        pass
+def _error_msg(ename: str, message: str) -> Dict:
+    # 超时、中止等情况也以 kernel 的 error 消息的形式交给调用方解析
+    return {
+        "msg_type": "error",
+        "parent_header": {},
+        "content": {"ename": ename, "evalue": message, "traceback": [message]},
+    }
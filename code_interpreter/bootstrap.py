@@ -0,0 +1,148 @@
+"""
+One-shot bootstrap, meant to run while building the image, for the work every
+cold container would otherwise repeat at runtime:
+
+- copies the CJK font into matplotlib's font directory and rebuilds the font
+  list cache with it, so that neither the server nor the kernels rebuild it;
+- byte-compiles this package and the libraries the kernels import;
+- writes a stamp file, so that the runtime check is a single file read.
+
+The init script itself is sent to the kernel as cell source, so there is no
+bytecode to keep for it; what it imports is compiled here.
+
+Run as ``python -m code_interpreter.bootstrap``.
+"""
+
+import argparse
+import compileall
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import matplotlib
+
+from code_interpreter.preload import zygote_modules
+
+STAMP_FILE_NAME = "m6_bootstrap.json"
+
+# 除了预加载配置中的库，kernel 与服务本身还会导入这些
+EXTRA_PACKAGES = ["IPython", "jupyter_client", "zmq", "matplotlib_inline", "code_interpreter"]
+
+
+def stamp_path() -> str:
+    return os.path.join(matplotlib.get_cachedir(), STAMP_FILE_NAME)
+
+
+def font_install_path(font_file: str) -> str:
+    return os.path.join(matplotlib.get_data_path(), "fonts", "ttf", os.path.basename(font_file))
+
+
+def _stamp_key(font_file: str) -> Dict:
+    # 换了 Python/matplotlib 版本或字体文件后需要重新 bootstrap
+    try:
+        st = os.stat(font_file)
+        font = [st.st_size, st.st_mtime_ns]
+    except OSError:
+        font = None
+    return {
+        "python": sys.version,
+        "matplotlib": matplotlib.__version__,
+        "font_file": font_file,
+        "font": font,
+    }
+
+
+def is_bootstrapped(font_file: str) -> bool:
+    """Whether the bootstrap ran for this environment and its outputs are still there."""
+    try:
+        with open(stamp_path()) as fin:
+            stamp = json.load(fin)
+    except (OSError, ValueError):
+        return False
+    if stamp.get("key") != _stamp_key(font_file):
+        return False
+    return all(os.path.exists(path) for path in stamp.get("files", []))
+
+
+def register_font(font_file: str) -> List[str]:
+    """Install the font and rebuild the font list cache; returns the files written."""
+    files = []
+    installed = None
+    if os.path.exists(font_file):
+        installed = font_install_path(font_file)
+        shutil.copy(font_file, installed)
+        files.append(installed)
+    else:
+        print(f"bootstrap: font {font_file} not found, using the default fonts", file=sys.stderr)
+    # 删掉旧的缓存，下面导入 font_manager 时重新扫描字体目录
+    for cache_file in glob.glob(os.path.join(matplotlib.get_cachedir(), "fontlist-*.json")):
+        os.remove(cache_file)
+
+    from matplotlib import font_manager
+
+    # font_manager 之前已经被导入过的话，它的字体列表里还没有这个字体
+    if installed and not any(f.fname == installed for f in font_manager.fontManager.ttflist):
+        font_manager.fontManager.addfont(installed)
+    fontlist = os.path.join(
+        matplotlib.get_cachedir(), f"fontlist-v{font_manager.FontManager.__version__}.json"
+    )
+    font_manager.json_dump(font_manager.fontManager, fontlist)
+    files.append(fontlist)
+    return files
+
+
+def compile_packages(packages: List[str]) -> bool:
+    """Byte-compile the given top-level packages where they are installed."""
+    ok = True
+    for name in packages:
+        spec = importlib.util.find_spec(name)
+        if spec is None or not spec.submodule_search_locations:
+            continue
+        for path in spec.submodule_search_locations:
+            ok = bool(compileall.compile_dir(path, quiet=1, workers=0)) and ok
+    return ok
+
+
+def bootstrap(font_file: str, byte_compile: bool = True) -> Dict:
+    timings = {}
+    start_time = time.time()
+    files = register_font(font_file)
+    timings["font_s"] = time.time() - start_time
+
+    compiled: Optional[bool] = None
+    if byte_compile:
+        start_time = time.time()
+        packages = sorted({m.split(".")[0] for m in zygote_modules("full")})
+        compiled = compile_packages(packages + EXTRA_PACKAGES)
+        timings["compile_s"] = time.time() - start_time
+
+    stamp = {"key": _stamp_key(font_file), "files": files, "compiled": compiled, **timings}
+    os.makedirs(os.path.dirname(stamp_path()), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(stamp_path()))
+    with os.fdopen(fd, "w") as fout:
+        json.dump(stamp, fout, indent=2)
+    os.replace(tmp_path, stamp_path())
+    return stamp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--no-compile", action="store_true", help="only register the font"
+    )
+    args = parser.parse_args()
+
+    from code_interpreter.interpreter import FONT_FILE
+
+    stamp = bootstrap(FONT_FILE, byte_compile=not args.no_compile)
+    print(json.dumps(stamp, indent=2))
+
+
+if __name__ == "__main__":
+    main()
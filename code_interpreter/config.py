@@ -4,5 +4,101 @@ Date: 2024-07-03 16:47:37
 FilePath: /code_interpreter_server/code_interpreter/config.py
 Description: 
 '''
+import os
+
 LOG_PATH = "./code_interpreter.log"
 DEFAULT_WORKSPACE = "/tmp/workspace"
+
+# 预热 kernel 池：保持的空闲 kernel 数，未命中时最多增加到的空闲与启动中的 kernel 数，
+# 以及每秒最多补充的 kernel 数
+KERNEL_POOL_MIN_SIZE = int(os.getenv("M6_CODE_INTERPRETER_POOL_MIN_SIZE", "2"))
+KERNEL_POOL_MAX_SIZE = int(os.getenv("M6_CODE_INTERPRETER_POOL_MAX_SIZE", "8"))
+KERNEL_POOL_REFILL_RATE = float(os.getenv("M6_CODE_INTERPRETER_POOL_REFILL_RATE", "1.0"))
+
+# kernel 启动方式：subprocess 每个 kernel 单独起进程，zygote 从预加载好的进程 fork
+KERNEL_LAUNCHER = os.getenv("M6_CODE_INTERPRETER_KERNEL_LAUNCHER", "subprocess")
+
+# 等待新 kernel 就绪的超时(秒)，超时或 kernel 中途退出时启动失败；
+# kernel 与服务之间的 ZeroMQ 传输方式：tcp(本机回环)或 ipc(Unix socket)
+KERNEL_STARTUP_TIMEOUT = float(os.getenv("M6_CODE_INTERPRETER_KERNEL_STARTUP_TIMEOUT", "60"))
+KERNEL_TRANSPORT = os.getenv("M6_CODE_INTERPRETER_KERNEL_TRANSPORT", "tcp")
+
+# kernel 初始化时预加载的库：minimal / dataframe / plotting / full，未预加载的库第一次使用时才导入
+KERNEL_PRELOAD_PROFILE = os.getenv("M6_CODE_INTERPRETER_PRELOAD_PROFILE", "full")
+
+# WebSocket 流式输出：stdout/stderr 片段合并发送的时间窗口(秒)与单帧最大字符数
+STREAM_FLUSH_INTERVAL = float(os.getenv("M6_CODE_INTERPRETER_STREAM_FLUSH_INTERVAL", "0.05"))
+STREAM_MAX_BATCH_CHARS = int(os.getenv("M6_CODE_INTERPRETER_STREAM_MAX_BATCH_CHARS", "65536"))
+
+# 会话管理：空闲超时(秒)、最多同时存活的 kernel 数、kernel 总内存预算(MB，0 表示不限制)、后台清理间隔(秒)
+SESSION_IDLE_TTL = float(os.getenv("M6_CODE_INTERPRETER_SESSION_IDLE_TTL", "1800"))
+SESSION_MAX_KERNELS = int(os.getenv("M6_CODE_INTERPRETER_SESSION_MAX_KERNELS", "32"))
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("M6_CODE_INTERPRETER_SESSION_MEMORY_BUDGET_MB", "0"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("M6_CODE_INTERPRETER_SESSION_SWEEP_INTERVAL", "10"))
+
+# 超时后先中断 kernel，超过该宽限期(秒)仍未空闲则重启 kernel
+INTERRUPT_GRACE_PERIOD = float(os.getenv("M6_CODE_INTERPRETER_INTERRUPT_GRACE_PERIOD", "2"))
+
+# 不超过该大小(字节)的图片直接以 data URI 内联返回，不落盘；0 表示不内联
+IMAGE_INLINE_MAX_BYTES = int(os.getenv("M6_CODE_INTERPRETER_IMAGE_INLINE_MAX_BYTES", "0"))
+
+# 下载缓存：缓存目录(与工作目录在同一文件系统时可以硬链接)、缓存大小上限(MB，0 表示不限制)、并发下载数、分块大小(字节)、超时(秒)
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "M6_CODE_INTERPRETER_DOWNLOAD_CACHE_DIR", os.path.join(DEFAULT_WORKSPACE, "download_cache")
+)
+DOWNLOAD_CACHE_MAX_MB = float(os.getenv("M6_CODE_INTERPRETER_DOWNLOAD_CACHE_MAX_MB", "10240"))
+DOWNLOAD_MAX_WORKERS = int(os.getenv("M6_CODE_INTERPRETER_DOWNLOAD_MAX_WORKERS", "8"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("M6_CODE_INTERPRETER_DOWNLOAD_CHUNK_SIZE", str(2**20)))
+DOWNLOAD_TIMEOUT = float(os.getenv("M6_CODE_INTERPRETER_DOWNLOAD_TIMEOUT", "60"))
+
+# 上传：单次上传的大小上限(MB，0 表示不限制)；共享的只读数据集的存放目录；
+# 可以注册、删除数据集的 API key(逗号分隔)，为空时不能通过接口管理数据集
+UPLOAD_MAX_MB = float(os.getenv("M6_CODE_INTERPRETER_UPLOAD_MAX_MB", "4096"))
+DATASET_DIR = os.getenv(
+    "M6_CODE_INTERPRETER_DATASET_DIR", os.path.join(DEFAULT_WORKSPACE, "datasets")
+)
+DATASET_ADMIN_KEYS = [
+    k.strip()
+    for k in os.getenv("M6_CODE_INTERPRETER_DATASET_ADMIN_KEYS", "").split(",")
+    if k.strip()
+]
+
+# 会话工作目录：每个会话的磁盘配额(MB，0 表示不限制)；图片、溢出的输出等产物以及无主工作目录的保留时间(秒)；
+# 后台清理(垃圾回收)的间隔(秒)
+WORKSPACE_QUOTA_MB = float(os.getenv("M6_CODE_INTERPRETER_WORKSPACE_QUOTA_MB", "1024"))
+WORKSPACE_ARTIFACT_TTL = float(os.getenv("M6_CODE_INTERPRETER_WORKSPACE_ARTIFACT_TTL", "86400"))
+WORKSPACE_GC_INTERVAL = float(os.getenv("M6_CODE_INTERPRETER_WORKSPACE_GC_INTERVAL", "300"))
+
+# 多 worker 共享的会话注册表："" 不启用，"memory" 仅本进程，"sqlite:///<path>" 同一台机器上的所有 worker 共享
+SESSION_REGISTRY = os.getenv("M6_CODE_INTERPRETER_SESSION_REGISTRY", "")
+
+# 执行调度：同时执行的请求数、排队请求总数上限、每个 API key 的排队请求数上限，排满后直接拒绝(HTTP 429)。
+# 执行大多在等 kernel(sleep、I/O、流式输出)而不占 CPU，同时执行数默认与 kernel 数上限相同，而不是 CPU 核数
+SCHEDULER_MAX_CONCURRENCY = int(
+    os.getenv("M6_CODE_INTERPRETER_MAX_CONCURRENCY", str(SESSION_MAX_KERNELS))
+)
+SCHEDULER_MAX_QUEUE = int(os.getenv("M6_CODE_INTERPRETER_MAX_QUEUE", "256"))
+SCHEDULER_MAX_QUEUE_PER_KEY = int(os.getenv("M6_CODE_INTERPRETER_MAX_QUEUE_PER_KEY", "16"))
+
+# 并行 map 接口最多同时占用的 kernel 数，默认与 CPU 核数相同
+FANOUT_MAX_KERNELS = int(os.getenv("M6_CODE_INTERPRETER_FANOUT_MAX_KERNELS", str(os.cpu_count() or 1)))
+
+# 无状态执行的结果缓存：溢出到磁盘的目录、内存部分与磁盘部分的大小上限(MB)
+RESULT_CACHE_DIR = os.getenv(
+    "M6_CODE_INTERPRETER_RESULT_CACHE_DIR", os.path.join(DEFAULT_WORKSPACE, "result_cache")
+)
+RESULT_CACHE_MEMORY_MB = float(os.getenv("M6_CODE_INTERPRETER_RESULT_CACHE_MEMORY_MB", "64"))
+RESULT_CACHE_DISK_MB = float(os.getenv("M6_CODE_INTERPRETER_RESULT_CACHE_DISK_MB", "1024"))
+
+# 会话休眠：回收 kernel 前把用户变量序列化到磁盘，下次请求时在新 kernel 中恢复。
+# 是否启用、快照总大小与单个变量大小上限(MB)、保存超时(秒)、休眠会话保留时间(秒)
+SESSION_HIBERNATE = os.getenv("M6_CODE_INTERPRETER_SESSION_HIBERNATE", "1") == "1"
+SESSION_HIBERNATE_MAX_MB = float(os.getenv("M6_CODE_INTERPRETER_SESSION_HIBERNATE_MAX_MB", "1024"))
+SESSION_HIBERNATE_MAX_VARIABLE_MB = float(
+    os.getenv("M6_CODE_INTERPRETER_SESSION_HIBERNATE_MAX_VARIABLE_MB", "512")
+)
+SESSION_HIBERNATE_TIMEOUT = float(os.getenv("M6_CODE_INTERPRETER_SESSION_HIBERNATE_TIMEOUT", "120"))
+SESSION_HIBERNATE_TTL = float(os.getenv("M6_CODE_INTERPRETER_SESSION_HIBERNATE_TTL", "604800"))
+
+# 单次执行(每个 cell)返回的输出上限(字符)，超出的部分完整写入工作目录下的文件，返回中只保留开头和结尾；0 表示不限制
+OUTPUT_MAX_CHARS = int(os.getenv("M6_CODE_INTERPRETER_OUTPUT_MAX_CHARS", "100000"))
@@ -0,0 +1,157 @@
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from code_interpreter.config import DATASET_DIR
+from code_interpreter.logger import logging
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,127}$")
+# 会话工作目录下放数据集的子目录，kernel 里用 datasets/<name>/<file> 读取
+MOUNT_DIR_NAME = "datasets"
+
+
+class DatasetNotFound(Exception):
+    pass
+
+
+class DatasetStore:
+    """Named read-only datasets shared by every session.
+
+    A dataset is a directory of files under ``root``. Every registration
+    writes a new ``<name>/<version>`` directory, makes it read-only and then
+    points the ``<name>/current`` symlink at it, so a session never sees a
+    half-registered dataset. A session that asks for a dataset gets a
+    symlink ``datasets/<name>`` in its working directory instead of a copy:
+    all kernels read the same files and share one page-cache copy of them,
+    also when they memory-map them (``np.load(mmap_mode="r")``,
+    ``pd.read_parquet(memory_map=True)``).
+
+    All state is on disk, so the workers of one machine see the same datasets.
+
+    Datasets are read-only by file mode only, which root ignores: kernels
+    running as root can change them for every session. Run the kernels as
+    another user, or mount ``root`` read-only into their environment.
+    """
+
+    def __init__(self, root: str = DATASET_DIR):
+        self.root = root
+        self.staging_dir = os.path.join(root, ".staging")
+        os.makedirs(self.staging_dir, exist_ok=True)
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            logging.warning(
+                "Running as root: datasets are only read-only by file mode, "
+                "which kernels running as root can ignore"
+            )
+
+    @staticmethod
+    def check_name(name: str):
+        if not _NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid dataset name: {name!r}")
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name, "current")
+
+    def exists(self, name: str) -> bool:
+        return bool(_NAME_PATTERN.match(name)) and os.path.isdir(self.path(name))
+
+    def staging(self) -> str:
+        """A new empty directory to write the files of a registration into."""
+        return tempfile.mkdtemp(dir=self.staging_dir)
+
+    def commit(self, name: str, staging: str) -> Dict:
+        """Publish the files in ``staging`` as the new version of ``name``."""
+        self.check_name(name)
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        version_dir = os.path.join(self.root, name, version)
+        for entry in os.scandir(staging):
+            if entry.is_file(follow_symlinks=False):
+                os.chmod(entry.path, 0o444)
+        os.chmod(staging, 0o555)
+        os.rename(staging, version_dir)
+        # 先建好新的链接再原子替换，正在读旧版本的 kernel 不受影响(已打开的文件在删除后仍然可读)
+        link = os.path.join(self.root, name, f".current-{version}")
+        os.symlink(version, link)
+        os.replace(link, self.path(name))
+        for entry in os.scandir(os.path.join(self.root, name)):
+            if entry.name not in (version, "current") and entry.is_dir(follow_symlinks=False):
+                _remove_tree(entry.path)
+        logging.info(f"Registered dataset {name} ({version})")
+        return self.info(name)
+
+    def discard(self, staging: str):
+        _remove_tree(staging)
+
+    def remove(self, name: str):
+        if not self.exists(name):
+            raise DatasetNotFound(f"Unknown dataset: {name}")
+        # 先删掉链接，挂载了它的会话立即看不到；已打开的文件仍然可读
+        os.remove(self.path(name))
+        _remove_tree(os.path.join(self.root, name))
+
+    def info(self, name: str) -> Dict:
+        if not self.exists(name):
+            raise DatasetNotFound(f"Unknown dataset: {name}")
+        path = self.path(name)
+        files = [
+            {"name": entry.name, "size": entry.stat().st_size}
+            for entry in sorted(os.scandir(path), key=lambda e: e.name)
+            if entry.is_file()
+        ]
+        return {
+            "name": name,
+            "version": os.readlink(path),
+            "files": files,
+            "size": sum(f["size"] for f in files),
+        }
+
+    def list(self) -> List[Dict]:
+        datasets = []
+        for entry in sorted(os.scandir(self.root), key=lambda e: e.name):
+            if entry.name != ".staging" and self.exists(entry.name):
+                try:
+                    datasets.append(self.info(entry.name))
+                except (OSError, DatasetNotFound):
+                    # 同时被删除或重新注册
+                    continue
+        return datasets
+
+    def mount(self, names: List[str], work_dir: str) -> List[str]:
+        """Expose the datasets in ``work_dir`` and return their paths there."""
+        paths = []
+        for name in names:
+            if not self.exists(name):
+                raise DatasetNotFound(f"Unknown dataset: {name}")
+            mount_dir = os.path.join(work_dir, MOUNT_DIR_NAME)
+            os.makedirs(mount_dir, exist_ok=True)
+            mount_path = os.path.join(mount_dir, name)
+            # 指向 current，重新注册后会话自动看到新版本
+            target = self.path(name)
+            if not (os.path.islink(mount_path) and os.readlink(mount_path) == target):
+                tmp_link = f"{mount_path}.{uuid.uuid4().hex[:8]}"
+                os.symlink(target, tmp_link)
+                os.replace(tmp_link, mount_path)
+            paths.append(mount_path)
+        return paths
+
+
+def _remove_tree(path: str):
+    # 只读目录里的文件删不掉，先恢复写权限
+    for dir_path, _, _ in os.walk(path):
+        os.chmod(dir_path, stat.S_IRWXU)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+_DATASET_STORE: Optional[DatasetStore] = None
+
+
+def get_dataset_store() -> DatasetStore:
+    global _DATASET_STORE
+    if _DATASET_STORE is None:
+        _DATASET_STORE = DatasetStore()
+    return _DATASET_STORE
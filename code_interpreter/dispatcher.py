@@ -0,0 +1,139 @@
+import asyncio
+import queue
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from jupyter_client import AsyncKernelClient  # type: ignore
+
+from code_interpreter.utils import print_traceback
+
+
+class IopubDispatcher:
+    """Routes the iopub messages of one kernel to the executions they belong to.
+
+    A single task reads the iopub channel and puts every message on the queue
+    of the request named by its parent msg_id, so several executions can be
+    in flight on the same kernel without reading each other's output.
+    Messages of requests nobody waits for (e.g. kernel_info) are dropped.
+
+    The kernel runs execute requests one after another in the order they were
+    sent; ``started`` resolves once the requests sent before have finished,
+    which is when a timeout for the request should start counting.
+    """
+
+    def __init__(self, kc: AsyncKernelClient):
+        self.kc = kc
+        self.closed = False
+        self._queues: Dict[str, asyncio.Queue] = {}
+        # 已发送、kernel 还没执行完(没收到 idle)的请求，按发送顺序；第一个是 kernel 正在执行的
+        self._order: "OrderedDict[str, asyncio.Event]" = OrderedDict()
+        # finished() 等待中的请求
+        self._done: Dict[str, asyncio.Event] = {}
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._reader = asyncio.ensure_future(self._read())
+
+    def execute(self, code: str, **kwargs) -> str:
+        """Send an execute request and start collecting its messages."""
+        if self.closed:
+            raise RuntimeError("The kernel has been shut down")
+        msg_id = self.kc.execute(code, **kwargs)
+        # 读取任务与这里在同一个事件循环里，登记之前不会有这个请求的消息被读走
+        self._queues[msg_id] = asyncio.Queue()
+        started = asyncio.Event()
+        if not self._order:
+            started.set()
+        self._order[msg_id] = started
+        self._drained.clear()
+        return msg_id
+
+    async def started(self, msg_id: str):
+        """Wait until the kernel gets to ``msg_id`` (or the dispatcher is closed)."""
+        started = self._order.get(msg_id)
+        if started is not None:
+            await started.wait()
+
+    async def get(self, msg_id: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Next message of ``msg_id``; None once the dispatcher is closed.
+
+        Raises ``queue.Empty`` when ``timeout`` passes, like ``get_iopub_msg``.
+        """
+        messages = self._queues[msg_id]
+        if not messages.empty():
+            return messages.get_nowait()
+        try:
+            return await asyncio.wait_for(messages.get(), timeout)
+        except asyncio.TimeoutError:
+            raise queue.Empty
+
+    def discard(self, msg_id: str):
+        """Stop collecting the messages of ``msg_id``.
+
+        It still counts as in flight until the kernel is done with it.
+        """
+        self._queues.pop(msg_id, None)
+
+    async def finished(self, msg_id: str):
+        """Wait until the kernel is done with ``msg_id`` (or the dispatcher is closed)."""
+        if msg_id in self._order:
+            await self._done.setdefault(msg_id, asyncio.Event()).wait()
+
+    async def drained(self):
+        """Wait until the kernel is done with every request sent so far."""
+        await self._drained.wait()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._order.keys() | self._queues.keys())
+
+    def close(self):
+        """Stop reading; whoever still waits for a request gets None."""
+        if self.closed:
+            return
+        self.closed = True
+        self._reader.cancel()
+        self._abort()
+
+    def _abort(self):
+        for messages in self._queues.values():
+            messages.put_nowait(None)
+        for started in self._order.values():
+            started.set()
+        for done in self._done.values():
+            done.set()
+        self._order.clear()
+        self._done.clear()
+        self._drained.set()
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self.kc.get_iopub_msg()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 通道已经关闭或消息无法解析，交给等待中的请求按 kernel 异常处理
+                print_traceback()
+                self.closed = True
+                self._abort()
+                return
+            msg_id = msg["parent_header"].get("msg_id")
+            messages = self._queues.get(msg_id)
+            if messages is not None:
+                messages.put_nowait(msg)
+            if (
+                msg["msg_type"] == "status"
+                and msg["content"].get("execution_state") == "idle"
+                and msg_id in self._order
+            ):
+                self._finish(msg_id)
+
+    def _finish(self, msg_id: str):
+        del self._order[msg_id]
+        done = self._done.pop(msg_id, None)
+        if done is not None:
+            done.set()
+        if self._order:
+            next(iter(self._order.values())).set()
+        else:
+            self._drained.set()
@@ -0,0 +1,370 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from code_interpreter.config import (
+    DOWNLOAD_CACHE_DIR,
+    DOWNLOAD_CACHE_MAX_MB,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_MAX_WORKERS,
+    DOWNLOAD_TIMEOUT,
+)
+from code_interpreter.logger import logging
+from code_interpreter.metrics import InstrumentedThreadPoolExecutor
+from code_interpreter.utils import (
+    get_basename_from_url,
+    hash_sha256,
+    is_http_url,
+    print_traceback,
+    sanitize_chrome_file_path,
+)
+
+_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+# linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+class DownloadCache:
+    """Shared on-disk cache for the files passed to an execution.
+
+    Bodies are streamed through a pooled ``requests.Session`` into
+    ``blobs/<sha256 of content>``, and ``index/<sha256 of url>.json`` remembers
+    which blob a URL resolved to together with its ETag/Last-Modified, so a
+    repeated URL costs one conditional request. Blobs are reflinked into the
+    workspace where the file system supports it and copied otherwise, never
+    hard-linked, so the kernel can not change the cached copy. The least
+    recently used ones are evicted once the cache exceeds ``max_size_mb``.
+
+    The index is read from disk once and then kept in memory; entries other
+    workers add are picked up when their URL is requested. Blobs that are
+    being placed into a workspace are pinned and never evicted meanwhile.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DOWNLOAD_CACHE_DIR,
+        max_size_mb: float = DOWNLOAD_CACHE_MAX_MB,
+        max_workers: int = DOWNLOAD_MAX_WORKERS,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 2**20
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.index_dir = os.path.join(cache_dir, "index")
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+        for path in (self.blob_dir, self.index_dir, self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = _USER_AGENT
+        self._executor = InstrumentedThreadPoolExecutor("download", max_workers)
+        # 同一个 URL 同时只下载一次
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # 本地文件按 (路径, 大小, 修改时间) 记住内容摘要，不必每次重新计算
+        self._local_digests: Dict[tuple, str] = {}
+        # URL 的 sha256 -> 索引项，与 index/ 下的文件一致
+        self._index: Dict[str, Dict] = {}
+        for name in os.listdir(self.index_dir):
+            entry = self._read_entry(name[: -len(".json")])
+            if entry is not None:
+                self._index[name[: -len(".json")]] = entry
+        # 正在放入工作目录的 blob(内容摘要 -> 引用数)，不能淘汰
+        self._pins: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def save_all(self, urls: List[str], save_dir: str) -> List[Optional[str]]:
+        """Fetch ``urls`` concurrently into ``save_dir``; failed ones are None."""
+        return [None if p is None else p[0] for p in self.place_all(urls, save_dir)]
+
+    def place_all(self, urls: List[str], save_dir: str) -> List[Optional[Tuple[str, str]]]:
+        """Like ``save_all``, but with the (path, sha256) of every saved file."""
+        futures = [self._executor.submit(self.place, url, save_dir) for url in urls]
+        placed: List[Optional[Tuple[str, str]]] = []
+        for url, future in zip(urls, futures):
+            try:
+                placed.append(future.result())
+            except Exception:
+                logging.error(f"Failed to fetch {url}")
+                print_traceback()
+                placed.append(None)
+        return placed
+
+    def save(self, url: str, save_dir: str, save_filename: str = "") -> str:
+        return self.place(url, save_dir, save_filename)[0]
+
+    def place(self, url: str, save_dir: str, save_filename: str = "") -> Tuple[str, str]:
+        """Save ``url`` into ``save_dir`` and return its path and the sha256 of what was saved."""
+        if not save_filename:
+            save_filename = get_basename_from_url(url)
+        new_path = os.path.join(save_dir, save_filename)
+        start_time = time.time()
+        if is_http_url(url):
+            blob_path = self._fetch(url)
+            # blob 以内容的 sha256 命名
+            digest = os.path.basename(blob_path)
+            try:
+                link_file(blob_path, new_path)
+            finally:
+                self._unpin(digest)
+        else:
+            path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+            link_file(sanitize_chrome_file_path(path), new_path)
+            # 原文件随时可能被改，算复制出来的这一份
+            digest = _file_digest(new_path)
+        logging.info(
+            f"Saved {url} to {new_path}. Time spent: {time.time() - start_time} seconds."
+        )
+        return new_path, digest
+
+    def fetch(self, url: str) -> str:
+        """Return the path of an up-to-date cached copy of ``url``.
+
+        The copy may be evicted at any time after this returns.
+        """
+        blob_path = self._fetch(url)
+        self._unpin(os.path.basename(blob_path))
+        return blob_path
+
+    def _fetch(self, url: str) -> str:
+        """Like ``fetch``, but the blob stays pinned until ``_unpin`` is called."""
+        key = hash_sha256(url)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._load_entry(key)
+            if entry is not None:
+                # 固定之后再检查，条件请求期间它不会被淘汰
+                self._pin(entry["digest"])
+                if not self._blob_intact(entry):
+                    self._unpin(entry["digest"])
+                    self._remove_blob(entry["digest"])
+                    entry = None
+            headers = {}
+            if entry is not None:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+            try:
+                with self.session.get(
+                    url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+                ) as response:
+                    if entry is not None and response.status_code == 304:
+                        with self._lock:
+                            self.hits += 1
+                            self.revalidations += 1
+                    elif response.status_code == 200:
+                        with self._lock:
+                            self.misses += 1
+                        digest, size = self._write_blob(response)
+                        if entry is not None:
+                            self._unpin(entry["digest"])
+                        entry = {
+                            "url": url,
+                            "digest": digest,
+                            "size": size,
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                        }
+                    else:
+                        raise ValueError(
+                            "Can not download this file. "
+                            "Please check your network or the file link."
+                        )
+            except BaseException:
+                if entry is not None:
+                    self._unpin(entry["digest"])
+                raise
+            entry["last_used"] = time.time()
+            self._save_entry(key, entry)
+        self._evict()
+        return self._blob_path(entry["digest"])
+
+    def digest(self, url: str) -> str:
+        """sha256 of the current content of ``url`` (a URL or a local path)."""
+        if is_http_url(url):
+            # blob 以内容的 sha256 命名
+            return os.path.basename(self.fetch(url))
+        path = sanitize_chrome_file_path(urllib.parse.unquote(urllib.parse.urlparse(url).path))
+        st = os.stat(path)
+        memo_key = (path, st.st_size, st.st_mtime_ns)
+        digest = self._local_digests.get(memo_key)
+        if digest is None:
+            digest = self._local_digests[memo_key] = _file_digest(path)
+        return digest
+
+    def stats(self) -> Dict:
+        with self._lock:
+            # 多个 URL 可能指向同一个 blob
+            sizes = {e["digest"]: e["size"] for e in self._index.values()}
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "size_mb": sum(sizes.values()) / 2**20,
+                "max_size_mb": self.max_size / 2**20,
+                "pinned": len(self._pins),
+            }
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest)
+
+    def _remove_blob(self, digest: str):
+        try:
+            os.remove(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def _blob_intact(self, entry: Dict) -> bool:
+        # blob 只以 reflink 或复制的方式放进工作区，kernel 改不到它；可能已被其他 worker 淘汰
+        try:
+            return os.stat(self._blob_path(entry["digest"])).st_size == entry["size"]
+        except OSError:
+            return False
+
+    def _pin(self, digest: str):
+        with self._lock:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def _unpin(self, digest: str):
+        with self._lock:
+            self._pins[digest] -= 1
+            if not self._pins[digest]:
+                del self._pins[digest]
+
+    def _write_blob(self, response: requests.Response):
+        """Store the body of ``response`` as a blob; returns (digest, size) with the blob pinned."""
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    fout.write(chunk)
+            digest = sha256.hexdigest()
+            # 与淘汰互斥：放好之后立即固定，放入工作区之前不会被删掉
+            with self._lock:
+                if os.path.exists(self._blob_path(digest)):
+                    # 内容相同的 blob 已存在(另一个 URL 下载过)，保留原文件
+                    os.remove(tmp_path)
+                else:
+                    os.chmod(tmp_path, 0o444)
+                    os.replace(tmp_path, self._blob_path(digest))
+                self._pins[digest] = self._pins.get(digest, 0) + 1
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
+
+    def _load_entry(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._index.get(key)
+        if entry is None:
+            # 可能是其他 worker 下载的
+            entry = self._read_entry(key)
+            if entry is not None:
+                with self._lock:
+                    self._index[key] = entry
+        return None if entry is None else dict(entry)
+
+    def _read_entry(self, key: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.index_dir, f"{key}.json")) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
+
+    def _save_entry(self, key: str, entry: Dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, "w") as fout:
+            json.dump(entry, fout)
+        os.replace(tmp_path, os.path.join(self.index_dir, f"{key}.json"))
+        with self._lock:
+            self._index[key] = entry
+
+    def _evict(self):
+        if not self.max_size:
+            return
+        with self._lock:
+            entries = sorted(self._index.items(), key=lambda x: x[1].get("last_used", 0))
+            # 多个 URL 可能指向同一个 blob，按 blob 计算大小和引用数
+            sizes: Dict[str, int] = {}
+            refs: Dict[str, int] = {}
+            for _, entry in entries:
+                sizes[entry["digest"]] = entry["size"]
+                refs[entry["digest"]] = refs.get(entry["digest"], 0) + 1
+            total = sum(sizes.values())
+            for key, entry in entries:
+                if total <= self.max_size:
+                    break
+                if entry["digest"] in self._pins:
+                    continue
+                del self._index[key]
+                try:
+                    os.remove(os.path.join(self.index_dir, f"{key}.json"))
+                except OSError:
+                    pass
+                refs[entry["digest"]] -= 1
+                if refs[entry["digest"]] == 0:
+                    total -= sizes[entry["digest"]]
+                    self._remove_blob(entry["digest"])
+                logging.info(f"Evicted {entry['url']} from the download cache")
+
+
+def _file_digest(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(DOWNLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def link_file(src: str, dst: str):
+    """Place a writable copy of ``src`` at ``dst``: a reflink if possible, else a copy.
+
+    Never a hard link, which would let changes to ``dst`` reach ``src``.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return
+    except OSError as e:
+        if os.path.exists(dst):
+            os.remove(dst)
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS):
+            raise
+    shutil.copyfile(src, dst)
+
+
+_DOWNLOAD_CACHE: Optional[DownloadCache] = None
+_DOWNLOAD_CACHE_LOCK = threading.Lock()
+
+
+def get_download_cache() -> DownloadCache:
+    global _DOWNLOAD_CACHE
+    with _DOWNLOAD_CACHE_LOCK:
+        if _DOWNLOAD_CACHE is None:
+            _DOWNLOAD_CACHE = DownloadCache()
+        return _DOWNLOAD_CACHE
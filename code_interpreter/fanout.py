@@ -0,0 +1,281 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from code_interpreter.async_interpreter import AsyncCodeInterpreter
+from code_interpreter.config import FANOUT_MAX_KERNELS
+from code_interpreter.download_cache import get_download_cache
+from code_interpreter.interpreter import get_init_code, get_shared_work_dir
+from code_interpreter.logger import logging
+from code_interpreter.metrics import PHASE_SECONDS
+from code_interpreter.result_cache import ResultCache
+from code_interpreter.utils import print_traceback
+
+# 结果里引用的图片与完整输出文件
+_ARTIFACT_LINKS = re.compile(r"!\[fig-\d+\]\(([^)]+)\)|the complete output is in (\S+)\]")
+
+# 任务之间清空用户命名空间、关闭图像、回到工作目录，再重新执行初始化脚本；
+# 只有已经导入了 pyplot 才需要关闭图像，不为此导入 matplotlib
+_RESET_CODE = """
+import os as _m6_os
+import sys as _m6_sys
+if "matplotlib.pyplot" in _m6_sys.modules:
+    _m6_sys.modules["matplotlib.pyplot"].close("all")
+_m6_os.chdir({work_dir!r})
+# 与 %reset -f 相同，但不新开一个历史会话(那要写 history 数据库)
+get_ipython().reset(new_session=False)
+"""
+
+
+class FanOutExecutor:
+    """Runs independent snippets in parallel on a bounded set of kernels.
+
+    Kernels come from the kernel pool, are kept warm between calls and run one
+    task at a time; after each task the user namespace is reset in the
+    background, so the next task starts from a freshly initialized kernel.
+    At most ``max_kernels`` kernels are in use at once.
+
+    Every call gets its own directory under ``<work_dir>/runs``: its input
+    files are saved there, its snippets run with it as their cwd, and it is
+    removed when the call returns, so the files of one call are not seen
+    (or overwritten) by another.
+    """
+
+    def __init__(
+        self,
+        kernel_pool=None,
+        max_kernels: int = FANOUT_MAX_KERNELS,
+        work_dir: Optional[str] = None,
+        result_cache: Optional[ResultCache] = None,
+    ):
+        self.kernel_pool = kernel_pool
+        # 可选的结果缓存，无状态执行(execute)时使用
+        self.result_cache = result_cache
+        self.max_kernels = max(1, max_kernels)
+        self.work_dir: str = work_dir or (
+            kernel_pool.work_dir if kernel_pool is not None else get_shared_work_dir()
+        )
+        self.runs_dir = os.path.join(self.work_dir, "runs")
+        self._reset_code = _RESET_CODE.format(work_dir=self.work_dir) + get_init_code()
+        self._idle: List[AsyncCodeInterpreter] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._resets: Set[asyncio.Task] = set()
+        self.busy = 0
+        self.tasks = 0
+        self.resets = 0
+        self.reset_failures = 0
+
+    async def map(
+        self,
+        snippets: List[str],
+        setup: Optional[str] = None,
+        files: List[str] = [],
+        timeout: Optional[float] = 30,
+    ) -> List[Dict]:
+        """Run every snippet on its own clean kernel and return the results in order.
+
+        ``setup`` runs before each snippet on the same kernel; if it fails the
+        snippet is not run. ``timeout`` applies to setup and snippet separately.
+        Each result carries its ``queue_wait`` and ``duration`` in seconds.
+        """
+        async with self._run_dir() as run_dir:
+            if files:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._download_files, files, run_dir)
+            return await self._map_in(run_dir, snippets, setup, timeout)
+
+    async def execute(
+        self,
+        code: str,
+        files: List[str] = [],
+        timeout: Optional[float] = 30,
+        bypass_cache: bool = False,
+    ) -> Dict:
+        """Run ``code`` statelessly on a clean kernel, or return its memoized result.
+
+        Only results that completed without a timeout are cached, since those
+        are reproducible, and only if the files the code ran with are the ones
+        the key was computed from. ``bypass_cache`` skips the lookup and
+        refreshes the stored result. ``cached`` in the returned dict says
+        whether it was a hit.
+        """
+        if self.result_cache is None:
+            result = (await self.map([code], files=files, timeout=timeout))[0]
+            return _outcome(result, cached=False)
+        loop = asyncio.get_running_loop()
+        inputs: Optional[List[Tuple[str, str]]] = None
+        key: Optional[str] = None
+        try:
+            inputs = await loop.run_in_executor(None, self.result_cache.inputs, files)
+            key = self.result_cache.key(code, inputs, timeout)
+        except Exception:
+            # 文件取不到时不缓存，照常执行并由执行结果报告错误
+            print_traceback()
+        if key is not None and not bypass_cache:
+            cached = await loop.run_in_executor(
+                None, self.result_cache.get, key, self._artifacts_alive
+            )
+            if cached is not None:
+                return _outcome(cached, cached=True)
+        elif bypass_cache:
+            self.result_cache.bypass()
+        async with self._run_dir() as run_dir:
+            placed = (
+                await loop.run_in_executor(None, self._download_files, files, run_dir)
+                if files
+                else []
+            )
+            result = _outcome((await self._map_in(run_dir, [code], None, timeout))[0], cached=False)
+        if key is not None and result["recovery"] is None and _same_inputs(inputs, placed):
+            await loop.run_in_executor(None, self.result_cache.put, key, _stored(result))
+        return result
+
+    def _artifacts_alive(self, result: Dict) -> bool:
+        """Whether the files a cached result links to are still there.
+
+        They are touched, so the workspace GC keeps the files of results that
+        are still being served.
+        """
+        for image_url, output_path in _ARTIFACT_LINKS.findall(result["result"]):
+            if image_url.startswith("data:"):
+                continue
+            # 图片都在本执行器的图片目录下，链接可能带静态 URL 前缀
+            path = output_path or os.path.join(
+                self.work_dir, "images", os.path.basename(image_url)
+            )
+            try:
+                os.utime(path)
+            except OSError:
+                return False
+        return True
+
+    @asynccontextmanager
+    async def _run_dir(self) -> AsyncIterator[str]:
+        """A new private directory for one call, removed when the call is done."""
+        loop = asyncio.get_running_loop()
+        run_dir = await loop.run_in_executor(None, self._new_run_dir)
+        try:
+            yield run_dir
+        finally:
+            # kernel 的 cwd 可能还在这里，后台重置时会切回 work_dir
+            await loop.run_in_executor(None, shutil.rmtree, run_dir, True)
+
+    async def _map_in(
+        self, run_dir: str, snippets: List[str], setup: Optional[str], timeout: Optional[float]
+    ) -> List[Dict]:
+        return list(
+            await asyncio.gather(
+                *(self._run(snippet, setup, timeout, run_dir) for snippet in snippets)
+            )
+        )
+
+    async def _run(
+        self, code: str, setup: Optional[str], timeout: Optional[float], run_dir: str
+    ) -> Dict:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_kernels)
+        queued_at = time.perf_counter()
+        await self._slots.acquire()
+        self.busy += 1
+        started_at = time.perf_counter()
+        PHASE_SECONDS.observe(started_at - queued_at, "queue_wait")
+        worker = self._idle.pop() if self._idle else AsyncCodeInterpreter(
+            {"work_dir": self.work_dir}, kernel_pool=self.kernel_pool
+        )
+        try:
+            # 先切到这次调用自己的目录；%xmode Minimal 下报错不带行号，不影响 setup 的报错
+            enter = f"__import__('os').chdir({run_dir!r})\n"
+            cells = [enter + (setup or ""), code]
+            # setup 与代码一次性发给 kernel，setup 出错时 kernel 不再执行后面的代码
+            results = await worker.execute_batch(cells, timeout=timeout, stop_on_error=True)
+            result = results[-1]
+            if results[0]["status"] != "success":
+                result = {**results[0], "result": "setup failed:\n\n" + results[0]["result"]}
+        except Exception as e:
+            print_traceback()
+            result = {"result": str(e), "status": "error", "recovery": None}
+            await worker.stop()
+            worker = None
+        result["queue_wait"] = started_at - queued_at
+        result["duration"] = time.perf_counter() - started_at
+        self.tasks += 1
+        # 重置放到后台，结果先返回；重置完成后 kernel 才能被下一个任务使用
+        task = asyncio.ensure_future(self._recycle(worker))
+        self._resets.add(task)
+        task.add_done_callback(self._resets.discard)
+        return result
+
+    async def _recycle(self, worker: Optional[AsyncCodeInterpreter]):
+        try:
+            if worker is not None:
+                outcome = await worker.execute(json.dumps({"code": self._reset_code}), timeout=30)
+                self.resets += 1
+                if outcome["status"] == "success":
+                    self._idle.append(worker)
+                else:
+                    logging.warning(f"Resetting a fan-out kernel failed: {outcome['result']}")
+                    self.reset_failures += 1
+                    await worker.stop()
+        except Exception:
+            print_traceback()
+            self.reset_failures += 1
+        finally:
+            self.busy -= 1
+            self._slots.release()  # type: ignore
+
+    def _new_run_dir(self) -> str:
+        os.makedirs(self.runs_dir, exist_ok=True)
+        return tempfile.mkdtemp(dir=self.runs_dir)
+
+    def _download_files(self, files: List[str], run_dir: str) -> List[Optional[Tuple[str, str]]]:
+        """Save ``files`` into ``run_dir``; (file name, sha256) of each, None if it failed."""
+        # 同一次调用的各段代码共用这个目录，文件只需下载一次
+        with PHASE_SECONDS.time("download"):
+            placed = get_download_cache().place_all(files, run_dir)
+        return [None if p is None else (os.path.basename(p[0]), p[1]) for p in placed]
+
+    async def stop(self):
+        for task in list(self._resets):
+            task.cancel()
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            await worker.stop()
+
+    def stats(self) -> Dict:
+        return {
+            "max_kernels": self.max_kernels,
+            "idle": len(self._idle),
+            "busy": self.busy,
+            "tasks": self.tasks,
+            "resets": self.resets,
+            "reset_failures": self.reset_failures,
+            "result_cache": self.result_cache.stats() if self.result_cache is not None else None,
+        }
+
+
+def _same_inputs(
+    inputs: Optional[List[Tuple[str, str]]], placed: List[Optional[Tuple[str, str]]]
+) -> bool:
+    """Whether the code ran with exactly the files its cache key was computed from.
+
+    A file may have changed between computing the key and saving it, and of
+    two files with the same name the kernel only sees one.
+    """
+    if inputs is None:
+        return False
+    names = [name for name, _ in inputs]
+    return len(set(names)) == len(names) and placed == inputs
+
+
+def _stored(result: Dict) -> Dict:
+    return {k: result[k] for k in ("result", "status", "recovery")}
+
+
+def _outcome(result: Dict, cached: bool) -> Dict:
+    return {**_stored(result), "cached": cached}
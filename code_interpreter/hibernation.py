@@ -0,0 +1,98 @@
+import os
+
+from code_interpreter.utils import hash_sha256
+
+# 在 kernel 里执行：逐个序列化用户变量(有 cloudpickle 时连同函数、类一起)，写入快照文件，
+# 最后一行打印 JSON 报告。放在函数里执行，不污染用户的命名空间
+SAVE_NAMESPACE_CODE = """
+def _m6_save_namespace(path, max_bytes, max_variable_bytes, _m6_missing=object()):
+    import json, os, pickle, types
+    try:
+        import cloudpickle as dumper
+    except ImportError:
+        dumper = pickle
+    shell = get_ipython()
+    init_ns = shell.user_ns.get("_m6_init_ns", {})
+    variables, skipped, total = {}, {}, 0
+    for name, value in list(shell.user_ns.items()):
+        if name.startswith("_") or name in shell.user_ns_hidden:
+            continue
+        if isinstance(value, types.ModuleType) or init_ns.get(name, _m6_missing) is value:
+            continue
+        # 先按内存占用粗略判断，避免为了知道大小而序列化一个很大的对象
+        size = getattr(value, "nbytes", None)
+        if not isinstance(size, int) and callable(getattr(value, "memory_usage", None)):
+            try:
+                size = int(value.memory_usage(index=True).sum())
+            except Exception:
+                size = None
+        if isinstance(size, int) and size > max_variable_bytes:
+            skipped[name] = f"too large ({size} bytes)"
+            continue
+        try:
+            data = dumper.dumps(value, protocol=5)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"
+            continue
+        if len(data) > max_variable_bytes:
+            skipped[name] = f"too large ({len(data)} bytes)"
+        elif total + len(data) > max_bytes:
+            skipped[name] = "snapshot size limit reached"
+        else:
+            variables[name] = data
+            total += len(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as fout:
+        pickle.dump({"variables": variables, "skipped": skipped}, fout, protocol=5)
+    os.replace(path + ".tmp", path)
+    print(json.dumps({"saved": sorted(variables), "skipped": skipped, "bytes": total}))
+
+
+try:
+    _m6_save_namespace({{M6_SNAPSHOT_PATH}}, {{M6_MAX_BYTES}}, {{M6_MAX_VARIABLE_BYTES}})
+finally:
+    del _m6_save_namespace
+"""
+
+# 在新 kernel 里执行：从快照恢复变量，报告保存时跳过的和恢复失败的变量
+LOAD_NAMESPACE_CODE = """
+def _m6_load_namespace(path):
+    import json, pickle
+    try:
+        import cloudpickle  # noqa  快照可能依赖它重建函数和类
+    except ImportError:
+        pass
+    with open(path, "rb") as fin:
+        snapshot = pickle.load(fin)
+    restored, skipped = [], dict(snapshot["skipped"])
+    for name, data in snapshot["variables"].items():
+        try:
+            get_ipython().user_ns[name] = pickle.loads(data)
+            restored.append(name)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"
+    print(json.dumps({"restored": sorted(restored), "skipped": skipped}))
+
+
+try:
+    _m6_load_namespace({{M6_SNAPSHOT_PATH}})
+finally:
+    del _m6_load_namespace
+"""
+
+
+def snapshot_path(hibernate_dir: str, api_key: str) -> str:
+    """Where the namespace of ``api_key`` is saved; the same for every worker."""
+    return os.path.join(hibernate_dir, f"{hash_sha256(api_key)}.pkl")
+
+
+def save_namespace_code(path: str, max_bytes: int, max_variable_bytes: int) -> str:
+    return (
+        SAVE_NAMESPACE_CODE.replace("{{M6_SNAPSHOT_PATH}}", repr(path))
+        .replace("{{M6_MAX_BYTES}}", str(int(max_bytes)))
+        .replace("{{M6_MAX_VARIABLE_BYTES}}", str(int(max_variable_bytes)))
+    )
+
+
+def load_namespace_code(path: str) -> str:
+    return LOAD_NAMESPACE_CODE.replace("{{M6_SNAPSHOT_PATH}}", repr(path))
@@ -0,0 +1,168 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional, Set, Tuple
+
+from code_interpreter.config import IMAGE_INLINE_MAX_BYTES
+from code_interpreter.logger import logging
+from code_interpreter.metrics import PHASE_SECONDS, InstrumentedThreadPoolExecutor
+
+# 图片落盘在这里进行，不阻塞读取 iopub 消息的循环
+_WRITER = InstrumentedThreadPoolExecutor("image-store", max_workers=2)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp"}
+# 文件名即内容哈希，内容永远不会变，可以让浏览器/CDN 长期缓存
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ImageStore:
+    """Content-addressed store for figures produced by the kernel.
+
+    Images are written as-is (no decode/re-encode) under ``image_dir`` and named
+    by the hash of their bytes, so a figure that is produced again is stored
+    only once; storing it again refreshes its mtime, or writes it again if the
+    file is gone. Images up to ``inline_max_bytes`` are returned as data URIs
+    and never touch the disk.
+    """
+
+    def __init__(
+        self,
+        image_dir: str,
+        static_root: Optional[str] = None,
+        static_url: Optional[str] = None,
+        inline_max_bytes: int = IMAGE_INLINE_MAX_BYTES,
+    ):
+        self.image_dir = image_dir
+        self.static_root = static_root or os.path.dirname(image_dir)
+        self.static_url = (
+            os.getenv("M6_CODE_INTERPRETER_STATIC_URL", "")
+            if static_url is None
+            else static_url
+        )
+        self.inline_max_bytes = inline_max_bytes
+        self._known: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def save(
+        self, image_base64: str, mime_type: str = "image/png"
+    ) -> Tuple[str, Optional[Future]]:
+        """Store an image and return (url, pending write or None)."""
+        image_bytes = base64.b64decode(image_base64)
+        if len(image_bytes) <= self.inline_max_bytes:
+            data = base64.b64encode(image_bytes).decode()
+            return f"data:{mime_type};base64,{data}", None
+
+        ext = {"image/jpeg": ".jpg", "image/gif": ".gif"}.get(mime_type, ".png")
+        image_file = hashlib.sha256(image_bytes).hexdigest()[:32] + ext
+        local_image_file = os.path.join(self.image_dir, image_file)
+        future = None
+        with self._lock:
+            if image_file in self._known:
+                try:
+                    # 再次引用的图片按新图片计算保留时间，expire_images 不会删掉刚返回的链接
+                    os.utime(local_image_file)
+                except FileNotFoundError:
+                    # 被用户代码删掉了，或者还在写入；重新写一份(已存在时直接返回)
+                    self._known.discard(image_file)
+            if image_file not in self._known:
+                self._known.add(image_file)
+                future = _WRITER.submit(self._write, local_image_file, image_bytes)
+        return self._url(local_image_file), future
+
+    def _url(self, local_image_file: str) -> str:
+        if self.static_url:
+            rel_path = os.path.relpath(local_image_file, self.static_root)
+            return f"{self.static_url}/{rel_path}"
+        return local_image_file
+
+    def _write(self, path: str, image_bytes: bytes):
+        with PHASE_SECONDS.time("image_persist"):
+            self._write_file(path, image_bytes)
+
+    def _write_file(self, path: str, image_bytes: bytes):
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.image_dir, exist_ok=True)
+            # 先写临时文件再改名，静态路由不会读到写了一半的图片
+            fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(image_bytes)
+            os.replace(tmp_path, path)
+        except Exception:
+            with self._lock:
+                self._known.discard(os.path.basename(path))
+            logging.exception(f"Failed to write image {path}")
+            raise
+
+
+def resolve_static_file(static_root: str, rel_path: str) -> Optional[str]:
+    """Map a static URL path to an image file under ``static_root``, if allowed."""
+    root = os.path.realpath(static_root)
+    path = os.path.realpath(os.path.join(root, rel_path))
+    if not path.startswith(root + os.sep):
+        return None
+    if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+_STORES: Dict[str, ImageStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_image_store(work_dir: str, static_root: Optional[str] = None) -> ImageStore:
+    """Return the image store shared by every interpreter using ``work_dir``.
+
+    Static URLs are relative to ``static_root`` (``work_dir`` by default).
+    """
+    with _STORES_LOCK:
+        store = _STORES.get(work_dir)
+        if store is None:
+            store = ImageStore(
+                os.path.join(work_dir, "images"), static_root=static_root or work_dir
+            )
+            _STORES[work_dir] = store
+        return store
+
+
+def drop_image_store(work_dir: str):
+    """Forget the store of ``work_dir``, e.g. once the directory has been removed."""
+    with _STORES_LOCK:
+        _STORES.pop(work_dir, None)
+
+
+def expire_images(work_dir: str, max_age: float) -> int:
+    """Remove the images of ``work_dir`` older than ``max_age`` seconds."""
+    with _STORES_LOCK:
+        store = _STORES.get(work_dir)
+    image_dir = os.path.join(work_dir, "images")
+    try:
+        entries = list(os.scandir(image_dir))
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    removed = 0
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+            # 硬链接、改名不改 mtime，取较新的 ctime
+            if now - max(st.st_mtime, st.st_ctime) <= max_age:
+                continue
+            if store is None:
+                os.remove(entry.path)
+            else:
+                # 同时从已知集合中去掉，同一张图再次出现时会重新写入
+                with store._lock:
+                    store._known.discard(entry.name)
+                    os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
@@ -2,8 +2,6 @@ import asyncio
 import atexit
 import base64
 import glob
-import io
-import json
 import os
 import queue
 import re
@@ -12,30 +10,47 @@ import signal
 import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import uuid
+from concurrent.futures import Future, wait
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import json5
 import matplotlib
-import PIL.Image
-from jupyter_client import BlockingKernelClient  # type: ignore
-
-from code_interpreter.config import DEFAULT_WORKSPACE
+from jupyter_client import BlockingKernelClient, KernelManager  # type: ignore
+
+from code_interpreter.bootstrap import is_bootstrapped
+from code_interpreter.config import (
+    DEFAULT_WORKSPACE,
+    INTERRUPT_GRACE_PERIOD,
+    KERNEL_LAUNCHER,
+    KERNEL_PRELOAD_PROFILE,
+    KERNEL_STARTUP_TIMEOUT,
+    KERNEL_TRANSPORT,
+)
+from code_interpreter.datasets import get_dataset_store
+from code_interpreter.download_cache import get_download_cache
+from code_interpreter.image_store import get_image_store
 from code_interpreter.logger import logging
+from code_interpreter.metrics import (
+    KERNEL_DEATHS,
+    KERNEL_RESTARTS,
+    PHASE_SECONDS,
+    TIMEOUTS,
+    InstrumentedThreadPoolExecutor,
+)
+from code_interpreter.output_buffer import OutputBuffer, OutputList
+from code_interpreter.preload import INLINE_BACKEND, preload_modules, preloads_pyplot
 from code_interpreter.utils import (
     append_signal_handler,
     extract_code,
     has_chinese_chars,
     print_traceback,
-    save_url_to_local_work_dir,
 )
-
-LAUNCH_KERNEL_PY = """
-from ipykernel import kernelapp as app
-app.launch_new_instance()
-"""
+from code_interpreter.zygote import ZygoteProcess, get_zygote_launcher
 
 INIT_CODE_FILE = str(
     Path(__file__).absolute().parent / "resource" / "code_interpreter_init_kernel.py"
@@ -45,18 +60,31 @@ FONT_FILE = str(
 )
 
 
+_TIMEOUT_MESSAGE = "Timeout: Code execution exceeded the time limit."
+_UNEXPECTED_ERROR_MESSAGE = "The code interpreter encountered an unexpected error."
+# 结构化输出中按图片返回的 MIME 类型，按优先顺序
+_IMAGE_MIME_TYPES = ("image/png", "image/jpeg")
+
 _KERNEL_CLIENTS: Dict[str, BlockingKernelClient] = {}
 _MISC_SUBPROCESSES: Dict[str, subprocess.Popen] = {}
+_DOWNLOAD_EXECUTOR = InstrumentedThreadPoolExecutor("download-files")
+
+
+# 其他 worker 启动、本进程只是连上去的 kernel，退出时不能关掉它们
+_ATTACHED_KERNELS: Set[str] = set()
 
 
 def _kill_kernels_and_subprocesses(_sig_num=None, _frame=None):
-    for v in _KERNEL_CLIENTS.values():
-        v.shutdown()
+    for k, v in _KERNEL_CLIENTS.items():
+        if k not in _ATTACHED_KERNELS:
+            v.shutdown()
+            _cleanup_kernel_files(v)
     for k in list(_KERNEL_CLIENTS.keys()):
         del _KERNEL_CLIENTS[k]
 
-    for v in _MISC_SUBPROCESSES.values():
-        v.terminate()
+    for k, v in _MISC_SUBPROCESSES.items():
+        if k not in _ATTACHED_KERNELS:
+            v.terminate()
     for k in list(_MISC_SUBPROCESSES.keys()):
         del _MISC_SUBPROCESSES[k]
 
@@ -78,15 +106,34 @@ class CodeInterpreter:
         }
     ]
 
-    def __init__(self, cfg: Optional[Dict] = None):
+    def __init__(
+        self,
+        cfg: Optional[Dict] = None,
+        kernel_pool=None,
+        registry=None,
+        session_key: Optional[str] = None,
+    ):
         super().__init__()
         self.cfg = cfg or {}
-        default_work_dir = os.getenv(
-            "M6_CODE_INTERPRETER_WORK_DIR",
-            os.path.join(DEFAULT_WORKSPACE, "tools", "code_interpreter"),
-        )
-        self.work_dir: str = self.cfg.get("work_dir", default_work_dir)
+        self.work_dir: str = self.cfg.get("work_dir", get_default_work_dir())
+        self.kernel_launcher: str = self.cfg.get("kernel_launcher", KERNEL_LAUNCHER)
+        self.preload_profile: str = self.cfg.get("preload_profile", KERNEL_PRELOAD_PROFILE)
         self.instance_id: str = str(uuid.uuid4())
+        # 可选的预热 kernel 池（code_interpreter.kernel_pool.KernelPool）
+        self.kernel_pool = kernel_pool
+        # 可选的会话注册表（code_interpreter.session_registry.SessionRegistry），
+        # 同一个 session_key 在其他 worker 上已有 kernel 时直接连上去
+        self.registry = registry
+        self.session_key = session_key
+        # 会话的工作目录在默认工作目录之下，图片链接都相对默认工作目录，由同一个静态路由提供
+        root = os.path.abspath(get_default_work_dir())
+        in_root = os.path.abspath(self.work_dir).startswith(root + os.sep)
+        self.image_store = get_image_store(self.work_dir, root if in_root else None)
+        # 尚未写完的图片，执行结束前等待它们落盘
+        self._image_writes: List[Future] = []
+        # 同步接口可能在多个线程里同时调用；BlockingKernelClient 的 socket 不能多个线程同时读，
+        # 同一个 kernel 上的执行串行进行(异步接口见 AsyncCodeInterpreter，可以流水线执行)
+        self._call_lock = threading.Lock()
 
     @property
     def args_format(self) -> str:
@@ -111,64 +158,189 @@ class CodeInterpreter:
         timeout: Optional[int] = 30,
         **kwargs,
     ) -> str:
+        code = self._parse_code(params)
+        if not code.strip():
+            return ""
+        # download files from url, while the kernel is being acquired
+        downloads = _DOWNLOAD_EXECUTOR.submit(self._download_files, files) if files else None
+        fixed_code = self._prepare_code(code)
+        with self._call_lock:
+            kc = self._get_kernel()
+            if downloads is not None:
+                downloads.result()
+            with PHASE_SECONDS.time("execution"):
+                result = self._execute_code(kc, fixed_code, timeout)
+        # logging.info(
+        #     "\n&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&\n"
+        # )
+        return result if result.strip() else "Finished execution."
+
+    @staticmethod
+    def _parse_code(params: str) -> str:
         try:
             params = json5.loads(params)  # type: ignore
             code = params["code"]  # type: ignore
         except Exception:  # 只有报错的时候才用extract抽取
             code = extract_code(params)
-        if not code.strip():
-            return ""
-        # download files from url
+        return code
+
+    def _download_files(self, files: List[str]):
         if files:
             os.makedirs(self.work_dir, exist_ok=True)
-            for file in files:
-                try:
-                    save_url_to_local_work_dir(file, self.work_dir)
-                except Exception:
-                    print_traceback()
+            # 并发下载，已缓存的文件只做一次条件请求，再链接到工作目录
+            with PHASE_SECONDS.time("download"):
+                get_download_cache().save_all(files, self.work_dir)
 
-        kernel_id: str = f"{self.instance_id}_{os.getpid()}"
-        if kernel_id in _KERNEL_CLIENTS:
-            kc = _KERNEL_CLIENTS[kernel_id]
-        else:
-            _fix_matplotlib_cjk_font_issue()
-            self._fix_secure_write_for_code_interpreter()
-            kc, subproc = self._start_kernel(kernel_id)
-            with open(INIT_CODE_FILE) as fin:
-                start_code = fin.read()
-                start_code = start_code.replace(
-                    "{{M6_FONT_PATH}}", repr(FONT_FILE)[1:-1]
-                )
-                start_code += "\n%xmode Minimal"
-            logging.info(self._execute_code(kc, start_code))
-            _KERNEL_CLIENTS[kernel_id] = kc
-            _MISC_SUBPROCESSES[kernel_id] = subproc
-
-        if timeout:
-            code = f"_M6CountdownTimer.start({timeout})\n{code}"
+    def _mount_datasets(self, datasets: List[str]):
+        # 共享数据集以符号链接的形式出现在工作目录的 datasets/ 下，不复制文件
+        if datasets:
+            get_dataset_store().mount(datasets, self.work_dir)
 
+    @staticmethod
+    def _prepare_code(code: str) -> str:
         fixed_code = []
         for line in code.split("\n"):
             fixed_code.append(line)
         fixed_code = "\n".join(fixed_code)
         fixed_code += "\n\n"  # Prevent code not executing in notebook due to no line breaks at the end
-        result = self._execute_code(kc, fixed_code)
-        if timeout:
-            self._execute_code(kc, "_M6CountdownTimer.cancel()")
-        # logging.info(
-        #     "\n&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&\n"
-        # )
-        return result if result.strip() else "Finished execution."
+        return fixed_code
 
-    def __del__(self):
-        # Recycle the jupyter subprocess:
-        k: str = f"{self.instance_id}_{os.getpid()}"
+    @property
+    def kernel_id(self) -> str:
+        return f"{self.instance_id}_{os.getpid()}"
+
+    @property
+    def kernel_pid(self) -> Optional[int]:
+        """PID of the kernel process, or None if no kernel has been started yet."""
+        subproc = _MISC_SUBPROCESSES.get(self.kernel_id)
+        if subproc is None or subproc.poll() is not None:
+            return None
+        return subproc.pid
+
+    def _get_kernel(self) -> BlockingKernelClient:
+        kernel_id = self.kernel_id
+        if kernel_id in _KERNEL_CLIENTS:
+            if self.kernel_pid is not None:
+                return _KERNEL_CLIENTS[kernel_id]
+            # kernel 进程已退出，换一个新的
+            logging.warning(f"Kernel {kernel_id} died, starting a new one")
+            KERNEL_DEATHS.inc()
+            self.shutdown_kernel(now=True)
+        if not self._registered:
+            return self._acquire_kernel(kernel_id)
+        with self.registry.claim(self.session_key):
+            return self._acquire_kernel(kernel_id)
+
+    def _acquire_kernel(self, kernel_id: str) -> BlockingKernelClient:
+        kernel = self._attach_kernel(kernel_id)
+        if kernel is None and self.kernel_pool is not None:
+            kernel = self.kernel_pool.acquire()
+            if kernel is not None and self.kernel_pool.work_dir != self.work_dir:
+                self._enter_work_dir(kernel[0])
+        if kernel is None:
+            kernel = self._create_kernel(kernel_id)
+        kc, subproc = kernel
+        _KERNEL_CLIENTS[kernel_id] = kc
+        _MISC_SUBPROCESSES[kernel_id] = subproc
+        if self._registered and kernel_id not in _ATTACHED_KERNELS:
+            self.registry.publish(self.session_key, subproc.pid, kc.connection_file)
+        return kc
+
+    def _enter_work_dir(self, kc: BlockingKernelClient):
+        # 池中 kernel 的 cwd 是池的 work_dir，交给会话前换到会话自己的工作目录
+        os.makedirs(self.work_dir, exist_ok=True)
+        code = f"__import__('os').chdir({os.path.abspath(self.work_dir)!r})"
+        self._execute_code(kc, code)
+
+    @property
+    def _registered(self) -> bool:
+        return self.registry is not None and bool(self.session_key)
+
+    @property
+    def kernel_attached(self) -> bool:
+        """Whether the kernel was started by another worker and only attached to."""
+        return self.kernel_id in _ATTACHED_KERNELS
+
+    def _attach_kernel(
+        self, kernel_id: str
+    ) -> Optional[Tuple[BlockingKernelClient, ZygoteProcess]]:
+        """Connect to the kernel another worker started for this session, if any."""
+        if not self._registered:
+            return None
+        record = self.registry.lookup(self.session_key)
+        if record is None or record.worker_pid == os.getpid():
+            return None
+        logging.info(
+            f"Attaching to kernel {record.kernel_pid} of worker {record.worker_pid}"
+        )
+        kc = BlockingKernelClient(connection_file=record.connection_file)
+        asyncio.set_event_loop_policy(AnyThreadEventLoopPolicy())
+        kc.load_connection_file()
+        kc.start_channels()
+        kc.wait_for_ready()
+        _ATTACHED_KERNELS.add(kernel_id)
+        # 不是本进程的子进程，按 pid 发信号即可
+        return kc, ZygoteProcess(record.kernel_pid)
+
+    def _create_kernel(
+        self, kernel_id: str
+    ) -> Tuple[BlockingKernelClient, subprocess.Popen]:
+        """Start a kernel and run the init script, i.e. the whole cold start."""
+        _fix_matplotlib_cjk_font_issue()
+        self._fix_secure_write_for_code_interpreter()
+        with PHASE_SECONDS.time("kernel_start"):
+            kc, subproc = self._start_kernel(kernel_id)
+        with PHASE_SECONDS.time("init_script"):
+            logging.info(self._execute_code(kc, get_init_code(self.preload_profile)))
+        return kc, subproc
+
+    def interrupt_kernel(self):
+        # 与 KernelManager 的 signal 中断方式相同：向 kernel 进程发送 SIGINT
+        subproc = _MISC_SUBPROCESSES.get(self.kernel_id)
+        if subproc is not None and subproc.poll() is None:
+            subproc.send_signal(signal.SIGINT)
+
+    def shutdown_kernel(self, now: bool = False):
+        """Shut the kernel down; ``now`` kills it without asking, e.g. when it hangs."""
+        k: str = self.kernel_id
+        _ATTACHED_KERNELS.discard(k)
         if k in _KERNEL_CLIENTS:
-            _KERNEL_CLIENTS[k].shutdown()
-            del _KERNEL_CLIENTS[k]
+            kc = _KERNEL_CLIENTS.pop(k)
+            if not now:
+                kc.shutdown()
+            kc.stop_channels()
+            _cleanup_kernel_files(kc)
         if k in _MISC_SUBPROCESSES:
-            _MISC_SUBPROCESSES[k].terminate()
-            del _MISC_SUBPROCESSES[k]
+            subproc = _MISC_SUBPROCESSES.pop(k)
+            if now:
+                subproc.kill()
+            else:
+                subproc.terminate()
+            if self._registered:
+                self.registry.unpublish(self.session_key, subproc.pid)
+
+    def detach_kernel(self):
+        """Forget the kernel without shutting it down."""
+        k: str = self.kernel_id
+        _ATTACHED_KERNELS.discard(k)
+        kc = _KERNEL_CLIENTS.pop(k, None)
+        if kc is not None:
+            kc.stop_channels()
+        _MISC_SUBPROCESSES.pop(k, None)
+
+    def close(self, release: bool = False):
+        """Shut the kernel down, or only detach from it if another worker owns it.
+
+        ``release`` shuts it down in any case, e.g. when the session is released.
+        """
+        if self.kernel_attached and not release:
+            self.detach_kernel()
+        else:
+            self.shutdown_kernel()
+
+    def __del__(self):
+        # Recycle the jupyter subprocess:
+        self.close()
 
     def _fix_secure_write_for_code_interpreter(self):
         if "linux" in sys.platform.lower():
@@ -191,122 +363,288 @@ class CodeInterpreter:
     def _start_kernel(
         self, kernel_id: str
     ) -> Tuple[BlockingKernelClient, subprocess.Popen]:
-        connection_file = os.path.join(
-            self.work_dir, f"kernel_connection_file_{kernel_id}.json"
+        """Launch a kernel process and wait until it answers.
+
+        The connection file is written before the kernel starts, so there is
+        nothing to poll for: the kernel is ready once its kernel_info reply
+        arrives. It fails after ``KERNEL_STARTUP_TIMEOUT`` seconds, or as soon
+        as the process exits.
+        """
+        # 连接文件不放在工作目录：kernel 里的代码看不到它，进程退出后也能整目录清理
+        connection_dir = get_connection_dir()
+        connection_file = os.path.abspath(
+            os.path.join(connection_dir, f"kernel_connection_file_{kernel_id}.json")
         )
-        launch_kernel_script = os.path.join(
-            self.work_dir, f"launch_kernel_{kernel_id}.py"
-        )
-        for f in [connection_file, launch_kernel_script]:
-            if os.path.exists(f):
-                logging.info(f"WARNING: {f} already exists")
-                os.remove(f)
+        if os.path.exists(connection_file):
+            logging.info(f"WARNING: {connection_file} already exists")
+            os.remove(connection_file)
 
+        os.makedirs(connection_dir, exist_ok=True)
         os.makedirs(self.work_dir, exist_ok=True)
-        with open(launch_kernel_script, "w") as fout:
-            fout.write(LAUNCH_KERNEL_PY)
-
-        kernel_process = subprocess.Popen(
-            [
-                sys.executable,
-                os.path.abspath(launch_kernel_script),
-                "--IPKernelApp.connection_file",
-                os.path.abspath(connection_file),
-                "--matplotlib=inline",
-                "--quiet",
-            ],
-            cwd=os.path.abspath(self.work_dir),
+        km = KernelManager(
+            connection_file=connection_file, transport=KERNEL_TRANSPORT, cache_ports=False
         )
+        if KERNEL_TRANSPORT == "ipc":
+            # Unix socket 路径长度有限，放在临时目录下而不是工作目录
+            km.ip = os.path.join(tempfile.gettempdir(), f"m6-kernel-{kernel_id}")
+        kernel_args = ["--quiet"]
+        # 预加载 pyplot 时在 kernel 启动阶段就切到 inline 后端；否则只通过环境变量指定，
+        # 不用的 kernel 不必为此导入 matplotlib
+        if preloads_pyplot(self.preload_profile):
+            kernel_args.append("--matplotlib=inline")
+        env = dict(os.environ, MPLBACKEND=INLINE_BACKEND)
+        cwd = os.path.abspath(self.work_dir)
+        if self.kernel_launcher == "zygote":
+            km.write_connection_file()
+            kernel_process = get_zygote_launcher(self.preload_profile).launch(
+                ["-f", connection_file] + kernel_args, cwd=cwd, env=env
+            )
+        else:
+            # KernelManager 写好连接文件后按 kernelspec 直接启动 ipykernel，不需要额外的启动脚本
+            km.start_kernel(extra_arguments=kernel_args, cwd=cwd, env=env)
+            kernel_process = km.provisioner.process  # type: ignore
         logging.info(f"INFO: kernel process's PID = {kernel_process.pid}")
-
-        # Wait for kernel connection file to be written
-        while True:
-            if not os.path.isfile(connection_file):
-                time.sleep(0.1)
-            else:
-                # Keep looping if JSON parsing fails, file may be partially written
-                try:
-                    with open(connection_file, "r") as fp:
-                        json.load(fp)
-                    break
-                except json.JSONDecodeError:
-                    pass
+        # 尽早登记，启动到一半时进程退出也能回收
+        _MISC_SUBPROCESSES[kernel_id] = kernel_process
 
         # Client
         kc = BlockingKernelClient(connection_file=connection_file)
         asyncio.set_event_loop_policy(AnyThreadEventLoopPolicy())
         kc.load_connection_file()
         kc.start_channels()
-        kc.wait_for_ready()
+        try:
+            _wait_for_ready(kc, kernel_process, KERNEL_STARTUP_TIMEOUT)
+        except Exception:
+            kc.stop_channels()
+            _MISC_SUBPROCESSES.pop(kernel_id, None)
+            kernel_process.kill()
+            _cleanup_kernel_files(kc)
+            raise
         return kc, kernel_process
 
-    def _execute_code(self, kc: BlockingKernelClient, code: str) -> str:
-        kc.wait_for_ready()
-        kc.execute(code)
-        result = ""
-        image_idx = 0
+    def _execute_code(
+        self, kc: BlockingKernelClient, code: str, timeout: Optional[float] = None
+    ) -> str:
+        """Run ``code`` with a single execute request and collect its outputs.
+
+        The kernel is known to be ready (that is checked when it is acquired),
+        and ``timeout`` is enforced here: the kernel is interrupted when it
+        passes, and restarted if it is still busy after the grace period.
+        """
+        msg_id = kc.execute(code)
+        deadline = time.time() + timeout if timeout else None
+        interrupted = False
+        output = self._new_output_buffer()
         while True:
-            text = ""
-            finished = False
-            msg_type = "error"
             try:
-                msg = kc.get_iopub_msg()
-                msg_type = msg["msg_type"]
-                if msg_type == "status":
-                    if msg["content"].get("execution_state") == "idle":
-                        finished = True
-                elif msg_type == "execute_result":
-                    text = msg["content"]["data"].get("text/plain", "")
-                    if "image/png" in msg["content"]["data"]:
-                        image_b64 = msg["content"]["data"]["image/png"]
-                        image_url = self._serve_image(image_b64)
-                        image_idx += 1
-                        image = "![fig-%03d](%s)" % (image_idx, image_url)
-                elif msg_type == "display_data":
-                    if "image/png" in msg["content"]["data"]:
-                        image_b64 = msg["content"]["data"]["image/png"]
-                        image_url = self._serve_image(image_b64)
-                        image_idx += 1
-                        image = "![fig-%03d](%s)" % (image_idx, image_url)
-                    else:
-                        text = msg["content"]["data"].get("text/plain", "")
-                elif msg_type == "stream":
-                    msg_type = msg["content"]["name"]
-                    text = msg["content"]["text"]  # stdout, stderr
-                elif msg_type == "error":
-                    text = _escape_ansi("\n".join(msg["content"]["traceback"]))
-                    if "M6_CODE_INTERPRETER_TIMEOUT" in text:
-                        text = "Timeout: Code execution exceeded the time limit."
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    raise queue.Empty
+                msg = kc.get_iopub_msg(timeout=wait)
+                if msg["parent_header"].get("msg_id") != msg_id:
+                    continue
+                msg_type, text, image_url, finished = self._parse_iopub_msg(msg)
+                if interrupted and msg_type == "error":
+                    # The KeyboardInterrupt traceback, already reported as a timeout.
+                    text = ""
             except queue.Empty:
-                text = "Timeout: Code execution exceeded the time limit."
-                finished = True
+                if not interrupted:
+                    logging.warning(f"Execution exceeded {timeout}s, interrupting kernel")
+                    TIMEOUTS.inc()
+                    self.interrupt_kernel()
+                    interrupted = True
+                    deadline = time.time() + INTERRUPT_GRACE_PERIOD
+                    output.add("error", _TIMEOUT_MESSAGE)
+                    continue
+                logging.warning("Kernel did not respond to the interrupt, restarting it")
+                KERNEL_RESTARTS.inc()
+                self.shutdown_kernel(now=True)
+                self._get_kernel()
+                break
             except Exception:
-                text = "The code interpreter encountered an unexpected error."
+                msg_type, text, image_url = "error", _UNEXPECTED_ERROR_MESSAGE, ""
                 print_traceback()
                 finished = True
-            if text:
-                result += f"\n\n{msg_type}:\n\n```\n{text}\n```"
+            output.add(msg_type, text)
+            if image_url:
+                output.add_image(image_url)
             if finished:
                 break
-        result = result.lstrip("\n")
-        return result
+        self._wait_image_writes()
+        return output.getvalue()
+
+    def _new_output_buffer(self) -> OutputBuffer:
+        # 超出上限的输出写到工作目录下，kernel 里也能直接读取
+        return OutputBuffer(spill_dir=os.path.join(self.work_dir, "outputs"))
+
+    def _new_output_list(self) -> OutputList:
+        return OutputList(spill_dir=os.path.join(self.work_dir, "outputs"))
+
+    def _parse_iopub_msg(self, msg: Dict) -> Tuple[str, str, str, bool]:
+        """Turn an iopub message into (msg_type, text, image_url, finished)."""
+        msg_type = msg["msg_type"]
+        text = ""
+        image_url = ""
+        finished = False
+        if msg_type == "status":
+            if msg["content"].get("execution_state") == "idle":
+                finished = True
+        elif msg_type == "execute_result":
+            text = msg["content"]["data"].get("text/plain", "")
+            if "image/png" in msg["content"]["data"]:
+                image_url = self._serve_image(msg["content"]["data"]["image/png"])
+        elif msg_type == "display_data":
+            if "image/png" in msg["content"]["data"]:
+                image_url = self._serve_image(msg["content"]["data"]["image/png"])
+            else:
+                text = msg["content"]["data"].get("text/plain", "")
+        elif msg_type == "stream":
+            msg_type = msg["content"]["name"]
+            text = msg["content"]["text"]  # stdout, stderr
+        elif msg_type == "error":
+            text = _escape_ansi("\n".join(msg["content"]["traceback"]))
+        return msg_type, text, image_url, finished
+
+    def _parse_output(self, msg: Dict, image_data: bool = False) -> Optional[Dict]:
+        """Turn an iopub message into an output of the structured format, or None.
+
+        Images are stored as in the markdown format and referred to by
+        ``url``; with ``image_data`` they are returned as raw bytes in
+        ``data`` instead and never written to disk. ``execute_input`` only
+        carries the execution count (see OutputList).
+        """
+        msg_type = msg["msg_type"]
+        content = msg["content"]
+        if msg_type == "stream":
+            return {
+                "kind": "stream",
+                "name": content["name"],
+                "mime": "text/plain",
+                "text": content["text"],
+            }
+        if msg_type in ("execute_result", "display_data"):
+            data = content["data"]
+            output: Dict = {"kind": msg_type}
+            if msg_type == "execute_result":
+                output["execution_count"] = content.get("execution_count")
+            mime = next((m for m in _IMAGE_MIME_TYPES if m in data), None)
+            if mime is not None:
+                output["mime"] = mime
+                if image_data:
+                    output["data"] = base64.b64decode(data[mime])
+                else:
+                    output["url"] = self._serve_image(data[mime], mime)
+            elif "text/plain" in data:
+                output.update(mime="text/plain", text=data["text/plain"])
+            else:
+                return None
+            return output
+        if msg_type == "error":
+            return {
+                "kind": "error",
+                "mime": "text/plain",
+                "ename": content.get("ename", ""),
+                "evalue": content.get("evalue", ""),
+                "text": _escape_ansi("\n".join(content.get("traceback", []))),
+            }
+        if msg_type == "execute_input":
+            return {"kind": "execute_input", "execution_count": content.get("execution_count")}
+        return None
+
+    def _serve_image(self, image_base64: str, mime_type: str = "image/png") -> str:
+        image_url, future = self.image_store.save(image_base64, mime_type)
+        if future is not None:
+            self._image_writes.append(future)
+        return image_url
+
+    def _wait_image_writes(self):
+        futures, self._image_writes = self._image_writes, []
+        wait(futures)
+
+
+def get_default_work_dir() -> str:
+    return os.getenv(
+        "M6_CODE_INTERPRETER_WORK_DIR",
+        os.path.join(DEFAULT_WORKSPACE, "tools", "code_interpreter"),
+    )
+
+
+def get_shared_work_dir() -> str:
+    """Working directory of pooled kernels and stateless executions."""
+    return os.path.join(get_default_work_dir(), "shared")
+
+
+def get_connection_dir(pid: Optional[int] = None) -> str:
+    """Where the process ``pid`` (this one by default) writes kernel connection files."""
+    return os.path.join(get_default_work_dir(), "connections", str(pid or os.getpid()))
+
+
+def get_init_code(profile: str = KERNEL_PRELOAD_PROFILE) -> str:
+    """The code every new kernel runs before it is handed out."""
+    with open(INIT_CODE_FILE) as fin:
+        start_code = fin.read()
+    start_code = start_code.replace("{{M6_FONT_PATH}}", repr(FONT_FILE)[1:-1])
+    start_code = start_code.replace("{{M6_PRELOAD_MODULES}}", repr(preload_modules(profile)))
+    start_code += "\n%xmode Minimal"
+    # 记下初始化脚本定义的变量，休眠时不必保存这些没被改过的
+    start_code += "\n_m6_init_ns = dict(globals())"
+    return start_code
+
+
+def _wait_for_ready(
+    kc: BlockingKernelClient, kernel_process: subprocess.Popen, timeout: float
+):
+    """Block until a new kernel replies to kernel_info and its iopub is connected.
+
+    Unlike ``kc.wait_for_ready`` this doesn't poll the heartbeat first, and it
+    gives up when the kernel process exits instead of waiting for the timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+        # 请求在 kernel 绑定端口之前就会排队，回复一到就返回
+        kc.kernel_info()
+        try:
+            msg = kc.get_shell_msg(timeout=max(0.01, min(0.25, deadline - time.time())))
+        except queue.Empty:
+            pass
+        else:
+            if msg["msg_type"] == "kernel_info_reply":
+                # iopub 收到了这次请求的 status 才算订阅成功，否则重新请求
+                try:
+                    kc.get_iopub_msg(timeout=0.2)
+                except queue.Empty:
+                    pass
+                else:
+                    return
+        if kernel_process.poll() is not None:
+            raise RuntimeError(
+                f"Kernel exited during startup with code {kernel_process.poll()}"
+            )
+        if time.time() > deadline:
+            raise RuntimeError(f"Kernel did not become ready within {timeout} seconds")
+
 
-    def _serve_image(self, image_base64: str) -> str:
-        image_file = f"{uuid.uuid4()}.png"
-        local_image_file = os.path.join(self.work_dir, image_file)
+def _cleanup_kernel_files(kc: BlockingKernelClient):
+    """Remove the connection file (and IPC sockets) of a kernel we started."""
+    try:
+        os.remove(kc.connection_file)
+    except OSError:
+        pass
+    kc.cleanup_ipc_files()
 
-        png_bytes = base64.b64decode(image_base64)
-        assert isinstance(png_bytes, bytes)
-        bytes_io = io.BytesIO(png_bytes)
-        PIL.Image.open(bytes_io).save(local_image_file, "png")
 
-        image_server_url = os.getenv("M6_CODE_INTERPRETER_STATIC_URL", "")
-        if image_server_url:
-            return f"{image_server_url}/{image_file}"
-        return local_image_file
+_FONT_CHECKED = False
 
 
 def _fix_matplotlib_cjk_font_issue():
+    global _FONT_CHECKED
+    # 镜像构建时已经执行过 python -m code_interpreter.bootstrap，或者本进程已经检查过，
+    # 就不必在每个新 kernel 之前再检查字体与字体缓存
+    if _FONT_CHECKED:
+        return
+    _FONT_CHECKED = True
+    if is_bootstrapped(FONT_FILE):
+        return
     ttf_name = os.path.basename(FONT_FILE)
     local_ttf = os.path.join(
         os.path.abspath(os.path.join(matplotlib.matplotlib_fname(), os.path.pardir)),
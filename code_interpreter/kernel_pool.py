@@ -0,0 +1,213 @@
+import subprocess
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from jupyter_client import BlockingKernelClient  # type: ignore
+
+from code_interpreter.config import (
+    KERNEL_POOL_MAX_SIZE,
+    KERNEL_POOL_MIN_SIZE,
+    KERNEL_POOL_REFILL_RATE,
+)
+from code_interpreter.interpreter import (
+    _KERNEL_CLIENTS,
+    _MISC_SUBPROCESSES,
+    CodeInterpreter,
+    _cleanup_kernel_files,
+    get_shared_work_dir,
+)
+from code_interpreter.logger import logging
+from code_interpreter.metrics import KERNEL_DEATHS
+from code_interpreter.utils import print_traceback
+
+Kernel = Tuple[BlockingKernelClient, subprocess.Popen]
+
+# 启动 kernel 连续失败时的重试间隔上限(秒)，间隔从 1 秒开始翻倍
+REFILL_MAX_BACKOFF = 60.0
+
+
+class KernelPool:
+    """A pool of started and initialized kernels, refilled in the background.
+
+    ``min_size`` idle kernels are kept warm and at most ``refill_rate`` new
+    kernels are started per second. Each miss raises the number kept warm by
+    one, up to ``max_size`` idle and starting kernels, and each hit that
+    leaves other kernels idle lowers it again towards ``min_size``. Kernels
+    are never handed back: a used kernel holds another session's state, so
+    it is shut down instead.
+    After failed starts the pool waits 1, 2, 4, ... seconds (at most
+    ``REFILL_MAX_BACKOFF``) before trying again.
+    """
+
+    def __init__(
+        self,
+        work_dir: Optional[str] = None,
+        min_size: int = KERNEL_POOL_MIN_SIZE,
+        max_size: int = KERNEL_POOL_MAX_SIZE,
+        refill_rate: float = KERNEL_POOL_REFILL_RATE,
+    ):
+        self.work_dir: str = work_dir or get_shared_work_dir()
+        self.min_size = max(0, min_size)
+        self.max_size = max(self.min_size, max_size)
+        # 当前保持的空闲与启动中的 kernel 数，随未命中/命中在 min_size 与 max_size 之间调整
+        self.target = self.min_size
+        self.refill_rate = refill_rate
+        # 只用来拉起 kernel，不对外执行代码
+        self._launcher = CodeInterpreter({"work_dir": self.work_dir})
+
+        self._idle: List[Tuple[str, Kernel]] = []
+        self._starting = 0
+        self._cond = threading.Condition()
+        self._stopped = True
+        self._thread: Optional[threading.Thread] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.refill_latency_total = 0.0
+        self.refill_latency_last = 0.0
+        self.refill_latency_max = 0.0
+
+    def start(self):
+        with self._cond:
+            if not self._stopped:
+                return
+            self._stopped = False
+        self._thread = threading.Thread(
+            target=self._refill_loop, name="kernel-pool-refill", daemon=True
+        )
+        self._thread.start()
+        logging.info(
+            f"Kernel pool started: min={self.min_size}, max={self.max_size}, "
+            f"refill_rate={self.refill_rate}/s"
+        )
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for pool_id, kernel in idle:
+            self._discard(pool_id, kernel)
+
+    def acquire(self) -> Optional[Kernel]:
+        """Take a ready kernel, or return None (a miss) if none is available.
+
+        Its cwd is the pool's ``work_dir``; callers with another working
+        directory change into theirs.
+        """
+        while True:
+            with self._cond:
+                if not self._idle:
+                    self.misses += 1
+                    self.target = min(self.max_size, self.target + 1)
+                    self._cond.notify_all()
+                    return None
+                pool_id, kernel = self._idle.pop(0)
+                if self._idle and self.target > self.min_size:
+                    self.target -= 1
+                self._cond.notify_all()
+            _KERNEL_CLIENTS.pop(pool_id, None)
+            _MISC_SUBPROCESSES.pop(pool_id, None)
+            if kernel[1].poll() is None:
+                with self._cond:
+                    self.hits += 1
+                return kernel
+            logging.warning(f"Dropping dead pooled kernel {pool_id}")
+            KERNEL_DEATHS.inc()
+            self._discard(pool_id, kernel)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "idle": len(self._idle),
+                "starting": self._starting,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "target": self.target,
+                "refill_rate": self.refill_rate,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refills": self.refills,
+                "refill_failures": self.refill_failures,
+                "refill_latency_last": self.refill_latency_last,
+                "refill_latency_max": self.refill_latency_max,
+                "refill_latency_avg": (
+                    self.refill_latency_total / self.refills if self.refills else 0.0
+                ),
+            }
+
+    def _refill_loop(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                    len(self._idle) + self._starting >= self.target
+                ):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._starting += 1
+            start_time = time.time()
+            pool_id = f"pool_{uuid.uuid4()}"
+            kernel = None
+            try:
+                kernel = self._launcher._create_kernel(pool_id)
+            except Exception:
+                print_traceback()
+                subproc = _MISC_SUBPROCESSES.pop(pool_id, None)
+                if subproc is not None:
+                    subproc.terminate()
+            elapsed = time.time() - start_time
+            failed = kernel is None
+            with self._cond:
+                self._starting -= 1
+                if kernel is None:
+                    self.refill_failures += 1
+                else:
+                    self.refills += 1
+                    self.refill_latency_total += elapsed
+                    self.refill_latency_last = elapsed
+                    self.refill_latency_max = max(self.refill_latency_max, elapsed)
+                    if not self._stopped:
+                        self._register(pool_id, kernel)
+                        self._idle.append((pool_id, kernel))
+                        kernel = None
+                self._cond.notify_all()
+            if kernel is not None:
+                self._discard(pool_id, kernel)
+                return
+            if failed:
+                failures += 1
+                delay = min(REFILL_MAX_BACKOFF, 2.0 ** (failures - 1))
+                logging.warning(f"Kernel pool refill failed, retrying in {delay:.0f} seconds")
+            else:
+                failures = 0
+                logging.info(f"Kernel pool refill {pool_id} took {elapsed:.2f} seconds")
+                delay = 1.0 / self.refill_rate - elapsed if self.refill_rate > 0 else 0.0
+            deadline = time.time() + delay
+            with self._cond:
+                # 其他线程也会 notify，等到期限为止；stop() 时立即退出
+                while not self._stopped and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+
+    @staticmethod
+    def _register(pool_id: str, kernel: Kernel):
+        # 登记到全局表里，保证进程退出时池中的 kernel 也会被回收
+        _KERNEL_CLIENTS[pool_id] = kernel[0]
+        _MISC_SUBPROCESSES[pool_id] = kernel[1]
+
+    @staticmethod
+    def _discard(pool_id: str, kernel: Kernel):
+        _KERNEL_CLIENTS.pop(pool_id, None)
+        _MISC_SUBPROCESSES.pop(pool_id, None)
+        kc, subproc = kernel
+        try:
+            kc.shutdown()
+        except Exception:
+            print_traceback(is_error=False)
+        subproc.terminate()
+        _cleanup_kernel_files(kc)
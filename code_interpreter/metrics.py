@@ -0,0 +1,280 @@
+import bisect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # 记录只是在锁内做一次加法，热路径上可以一直开着
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _label_str(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in values]
+
+
+class Gauge(_Metric):
+    """A gauge that is either set explicitly or computed by ``fn`` when scraped."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        fn: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self.fn = fn
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def collect(self) -> List[str]:
+        if self.fn is not None:
+            values = list(self.fn().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：各个桶(不累计)的计数 + 总和
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels) or self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[i] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *labels)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = [(k, (list(c), t[0])) for k, (c, t) in self._values.items()]
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = self._label_str(labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(labels)} {total}")
+            lines.append(f"{self.name}_count{self._label_str(labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def generate_latest(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = MetricsRegistry()
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that reports how many of its tasks run or wait."""
+
+    def __init__(self, name: str, max_workers: Optional[int] = None):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.active = 0
+        self.queued = 0
+        self._count_lock = threading.Lock()
+        _THREAD_POOLS.append(self)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._count_lock:
+            self.queued += 1
+        return super().submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        with self._count_lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._count_lock:
+                self.active -= 1
+
+
+_THREAD_POOLS: List[InstrumentedThreadPoolExecutor] = []
+
+
+def _thread_pool_stats(attr: str) -> Callable[[], Dict[LabelValues, float]]:
+    return lambda: {(p.name,): getattr(p, attr) for p in _THREAD_POOLS}
+
+
+PHASE_SECONDS = Histogram(
+    "m6_code_interpreter_phase_seconds",
+    "Time spent in each phase of serving a request.",
+    ["phase"],
+)
+TIMEOUTS = Counter(
+    "m6_code_interpreter_timeouts_total",
+    "Executions that exceeded their timeout (the kernel was interrupted).",
+)
+KERNEL_RESTARTS = Counter(
+    "m6_code_interpreter_kernel_restarts_total",
+    "Kernels restarted because they did not respond to an interrupt.",
+)
+EVICTIONS = Counter(
+    "m6_code_interpreter_evictions_total",
+    "Sessions whose kernel was evicted, by reason.",
+    ["reason"],
+)
+KERNEL_DEATHS = Counter(
+    "m6_code_interpreter_kernel_deaths_total",
+    "Kernels found dead when a session tried to use them.",
+)
+RESULT_CACHE_LOOKUPS = Counter(
+    "m6_code_interpreter_result_cache_lookups_total",
+    "Stateless executions by result cache outcome: hit, disk_hit, miss or bypass.",
+    ["result"],
+)
+HIBERNATIONS = Counter(
+    "m6_code_interpreter_hibernations_total",
+    "Session namespaces saved (hibernate), restored (restore) or lost because saving failed (failed).",
+    ["operation"],
+)
+ADMISSIONS = Counter(
+    "m6_code_interpreter_admissions_total",
+    "Requests admitted to execution or rejected because the queue was full.",
+    ["result"],
+)
+THREAD_POOL_ACTIVE = Gauge(
+    "m6_code_interpreter_thread_pool_active",
+    "Tasks currently running in each thread pool.",
+    ["pool"],
+    fn=_thread_pool_stats("active"),
+)
+THREAD_POOL_QUEUED = Gauge(
+    "m6_code_interpreter_thread_pool_queued",
+    "Tasks waiting for a thread in each thread pool.",
+    ["pool"],
+    fn=_thread_pool_stats("queued"),
+)
+KERNELS = Gauge(
+    "m6_code_interpreter_kernels",
+    "Kernels of this worker: live and busy session kernels, idle and starting pooled "
+    "ones, idle and busy fan-out ones.",
+    ["state"],
+)
+SCHEDULED_REQUESTS = Gauge(
+    "m6_code_interpreter_scheduled_requests",
+    "Requests holding an execution slot (running) or waiting for one (queued).",
+    ["state"],
+)
+
+
+def track_server(kernel_pool, sessions, fanout=None, scheduler=None):
+    """Export the kernels of a server's pool, session table and fan-out executor
+    through KERNELS, and the scheduler's queue through SCHEDULED_REQUESTS."""
+
+    def kernels():
+        pool = kernel_pool.stats()
+        session_stats = sessions.stats()
+        values = {
+            ("live",): session_stats["live_kernels"],
+            ("busy",): session_stats["busy_kernels"],
+            ("pool_idle",): pool["idle"],
+            ("pool_starting",): pool["starting"],
+        }
+        if fanout is not None:
+            fanout_stats = fanout.stats()
+            values[("fanout_idle",)] = fanout_stats["idle"]
+            values[("fanout_busy",)] = fanout_stats["busy"]
+        return values
+
+    KERNELS.fn = kernels
+    if scheduler is not None:
+        SCHEDULED_REQUESTS.fn = lambda: {
+            ("running",): scheduler.running,
+            ("queued",): scheduler.stats()["queued"],
+        }
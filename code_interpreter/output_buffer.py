@@ -0,0 +1,309 @@
+import os
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, TextIO, Tuple
+
+from code_interpreter.config import OUTPUT_MAX_CHARS
+from code_interpreter.utils import print_traceback
+
+# (msg_type, text)；图片的 msg_type 为 "image"，text 为 markdown 图片链接
+Fragment = Tuple[str, str]
+
+_STREAMS = ("stdout", "stderr")
+
+
+class OutputBuffer:
+    """Collects the outputs of one cell and renders them as markdown.
+
+    Fragments are appended to a list and joined once at the end, and
+    consecutive stdout (or stderr) fragments are merged into one block, so a
+    chatty cell costs linear time. Once the outputs exceed ``max_chars``, the
+    complete markdown is streamed to a file under ``spill_dir`` and only the
+    first and last ``max_chars / 2`` characters are kept in memory; the
+    rendered result then points to that file.
+    """
+
+    def __init__(self, max_chars: int = OUTPUT_MAX_CHARS, spill_dir: Optional[str] = None):
+        self.max_chars = max_chars
+        self.spill_dir = spill_dir
+        self.spill_path: Optional[str] = None
+        self._fragments: List[Fragment] = []
+        self._size = 0
+        self._images = 0
+        # 超出上限后：开头部分固定，结尾部分只保留最近的片段
+        self._overflowed = False
+        self._tail: Deque[Fragment] = deque()
+        self._tail_size = 0
+        self._total = 0
+        self._spill: Optional[_SpillWriter] = None
+
+    def add(self, msg_type: str, text: str):
+        if text:
+            self._append((msg_type, text))
+
+    def add_image(self, image_url: str):
+        self._images += 1
+        self._append(("image", "![fig-%03d](%s)" % (self._images, image_url)))
+
+    def getvalue(self) -> str:
+        if not self._overflowed:
+            return _render(self._fragments).lstrip("\n")
+        if self._spill is not None:
+            self._spill.close()
+        # 结尾部分最左边的片段可能只需要保留后半截
+        half = self.max_chars // 2
+        tail = list(self._tail)
+        excess = self._tail_size - half
+        if excess > 0 and tail and tail[0][0] != "image":
+            tail[0] = (tail[0][0], tail[0][1][excess:])
+        kept = self._size + sum(len(text) for _, text in tail)
+        note = f"[{self._total - kept} characters of output omitted"
+        if self.spill_path is not None:
+            note += f"; the complete output is in {self.spill_path}"
+        note += "]"
+        return (_render(self._fragments) + "\n\n" + note + _render(tail)).lstrip("\n")
+
+    def _append(self, fragment: Fragment):
+        size = len(fragment[1])
+        self._total += size
+        if not self._overflowed:
+            self._fragments.append(fragment)
+            self._size += size
+            if not self.max_chars or self._size <= self.max_chars:
+                return
+            self._overflow()
+        else:
+            if self._spill is not None:
+                self._spill.write(fragment)
+            self._tail.append(fragment)
+            self._tail_size += size
+        half = self.max_chars // 2
+        while self._tail and self._tail_size - len(self._tail[0][1]) >= half:
+            self._tail_size -= len(self._tail.popleft()[1])
+
+    def _overflow(self):
+        self._overflowed = True
+        if self.spill_dir is not None:
+            try:
+                self._spill = _SpillWriter(self.spill_dir)
+                self.spill_path = self._spill.path
+                for fragment in self._fragments:
+                    self._spill.write(fragment)
+            except OSError:
+                print_traceback()
+                self._spill = None
+        # 已有的片段里，前一半作为开头，其余的进入结尾部分
+        fragments, self._fragments, self._size = self._fragments, [], 0
+        half = self.max_chars // 2
+        for msg_type, text in fragments:
+            if self._size < half:
+                if msg_type == "image" or self._size + len(text) <= half:
+                    self._fragments.append((msg_type, text))
+                    self._size += len(text)
+                    continue
+                head = text[: half - self._size]
+                self._fragments.append((msg_type, head))
+                self._size += len(head)
+                text = text[len(head):]
+            self._tail.append((msg_type, text))
+            self._tail_size += len(text)
+
+
+class OutputList:
+    """Collects the outputs of one cell for the structured format.
+
+    Outputs are kept in order as dicts with their ``kind`` and ``mime`` (see
+    CodeInterpreter._parse_output); consecutive stdout (or stderr) outputs
+    are merged into one. Text is truncated like OutputBuffer does: once it
+    exceeds ``max_chars``, the complete outputs are streamed as markdown to a
+    file under ``spill_dir`` and only the first and last ``max_chars / 2``
+    characters of text are kept. The result then counts the dropped text in
+    ``omitted_chars`` and points to the file in ``output_path``; images and
+    errors are always kept.
+    """
+
+    def __init__(self, max_chars: int = OUTPUT_MAX_CHARS, spill_dir: Optional[str] = None):
+        self.max_chars = max_chars
+        self.spill_dir = spill_dir
+        self.spill_path: Optional[str] = None
+        self.execution_count: Optional[int] = None
+        self.error: Optional[Dict] = None
+        # stdout/stderr 的片段各自保存，结束时才合并
+        self._head: List[Dict] = []
+        self._size = 0
+        self._images = 0
+        # 超出上限后：开头部分固定，结尾部分只保留最近的文本，其间的图片与报错另外保留
+        self._overflowed = False
+        self._middle: List[Dict] = []
+        self._tail: Deque[Dict] = deque()
+        self._tail_size = 0
+        self._total = 0
+        self._spill: Optional[_SpillWriter] = None
+
+    def add(self, output: Dict):
+        kind = output["kind"]
+        if kind == "execute_input":
+            self.execution_count = output["execution_count"]
+            return
+        if kind == "error":
+            self.error = output
+        elif "text" in output and not output["text"]:
+            return
+        size = _text_size(output)
+        self._total += size
+        if not self._overflowed:
+            self._head.append(output)
+            self._size += size
+            if not self.max_chars or self._size <= self.max_chars:
+                return
+            self._overflow()
+        else:
+            if self._spill is not None:
+                self._write_spill(output)
+            self._tail.append(output)
+            self._tail_size += size
+        half = self.max_chars // 2
+        while self._tail and self._tail_size - _text_size(self._tail[0]) >= half:
+            output = self._tail.popleft()
+            size = _text_size(output)
+            if not size:
+                self._middle.append(output)
+            self._tail_size -= size
+
+    def result(self) -> Dict:
+        if self._spill is not None:
+            self._spill.close()
+        # 结尾部分最左边的输出可能只需要保留后半截
+        tail = list(self._tail)
+        excess = self._tail_size - self.max_chars // 2
+        if excess > 0 and tail:
+            tail[0] = {**tail[0], "text": tail[0]["text"][excess:]}
+        kept = self._size + sum(_text_size(output) for output in tail)
+        result = {
+            "outputs": _merge_streams(self._head) + self._middle + _merge_streams(tail),
+            "execution_count": self.execution_count,
+            "ename": self.error["ename"] if self.error else None,
+            "evalue": self.error["evalue"] if self.error else None,
+        }
+        if self._total > kept:
+            result["omitted_chars"] = self._total - kept
+            if self.spill_path is not None:
+                result["output_path"] = self.spill_path
+        return result
+
+    def _overflow(self):
+        self._overflowed = True
+        if self.spill_dir is not None:
+            try:
+                self._spill = _SpillWriter(self.spill_dir)
+                self.spill_path = self._spill.path
+                for output in self._head:
+                    self._write_spill(output)
+            except OSError:
+                print_traceback()
+                self._spill = None
+        # 已有的输出里，前一半文本作为开头，其余的进入结尾部分
+        outputs, self._head, self._size = self._head, [], 0
+        half = self.max_chars // 2
+        for output in outputs:
+            size = _text_size(output)
+            if self._size < half:
+                if self._size + size <= half:
+                    self._head.append(output)
+                    self._size += size
+                    continue
+                head = output["text"][: half - self._size]
+                self._head.append({**output, "text": head})
+                self._size += len(head)
+                output = {**output, "text": output["text"][len(head):]}
+                size -= len(head)
+            self._tail.append(output)
+            self._tail_size += size
+
+    def _write_spill(self, output: Dict):
+        # 与 markdown 格式的输出相同；以字节返回的图片没有链接，写出它的类型
+        kind = output["kind"]
+        if "text" in output:
+            self._spill.write((output["name"] if kind == "stream" else kind, output["text"]))
+        else:
+            self._images += 1
+            link = output.get("url", output["mime"])
+            self._spill.write(("image", "![fig-%03d](%s)" % (self._images, link)))
+
+
+class _SpillWriter:
+    """Writes the same markdown as _render, incrementally, to a file."""
+
+    def __init__(self, spill_dir: str):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.path = os.path.join(spill_dir, f"output_{uuid.uuid4().hex}.md")
+        self._file: TextIO = open(self.path, "w")
+        self._open_type: Optional[str] = None
+        self._first = True
+
+    def write(self, fragment: Fragment):
+        msg_type, text = fragment
+        if msg_type in _STREAMS and msg_type == self._open_type:
+            self._file.write(text)
+            return
+        self._close_block()
+        prefix = "" if self._first else "\n\n"
+        self._first = False
+        if msg_type == "image":
+            self._file.write(prefix + text)
+        else:
+            self._file.write(f"{prefix}{msg_type}:\n\n```\n{text}")
+            self._open_type = msg_type
+
+    def close(self):
+        if not self._file.closed:
+            self._close_block()
+            self._file.close()
+
+    def _close_block(self):
+        if self._open_type is not None:
+            self._file.write("\n```")
+            self._open_type = None
+
+
+def _render(fragments: List[Fragment]) -> str:
+    parts: List[str] = []
+    i = 0
+    while i < len(fragments):
+        msg_type, text = fragments[i]
+        i += 1
+        if msg_type == "image":
+            parts.append(f"\n\n{text}")
+            continue
+        block = [text]
+        # 连续的 stdout(或 stderr)片段合并成一个代码块
+        while msg_type in _STREAMS and i < len(fragments) and fragments[i][0] == msg_type:
+            block.append(fragments[i][1])
+            i += 1
+        parts.append(f"\n\n{msg_type}:\n\n```\n{''.join(block)}\n```")
+    return "".join(parts)
+
+
+def _text_size(output: Dict) -> int:
+    # 报错总是保留，不计入文本长度
+    return len(output["text"]) if "text" in output and output["kind"] != "error" else 0
+
+
+def _merge_streams(outputs: List[Dict]) -> List[Dict]:
+    merged: List[Dict] = []
+    parts: List[List[str]] = []
+    for output in outputs:
+        last = merged[-1] if merged else None
+        if (
+            last is not None
+            and output["kind"] == last["kind"] == "stream"
+            and output["name"] == last["name"]
+        ):
+            parts[-1].append(output["text"])
+            continue
+        merged.append(output)
+        parts.append([output.get("text", "")])
+    return [
+        {**output, "text": "".join(texts)} if len(texts) > 1 else output
+        for output, texts in zip(merged, parts)
+    ]
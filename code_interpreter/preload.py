@@ -0,0 +1,41 @@
+"""
+Preload profiles, i.e. which libraries a new kernel imports before it is handed
+out. Libraries that a profile doesn't preload are bound as lazy proxies by the
+init script and imported the first time user code touches them.
+
+This module is imported by the zygote, keep it free of heavy imports.
+"""
+
+from typing import List
+
+# 各配置在 kernel 初始化时导入的库，其余的库第一次使用时才导入
+PRELOAD_PROFILES = {
+    "minimal": [],
+    "dataframe": ["numpy", "pandas"],
+    "plotting": ["numpy", "matplotlib", "matplotlib.pyplot"],
+    "full": ["numpy", "pandas", "matplotlib", "matplotlib.pyplot", "sympy"],
+}
+
+# 不预加载 pyplot 时通过环境变量指定 inline 后端，第一次 import matplotlib 时才生效
+INLINE_BACKEND = "module://matplotlib_inline.backend_inline"
+
+
+def preload_modules(profile: str) -> List[str]:
+    try:
+        return PRELOAD_PROFILES[profile]
+    except KeyError:
+        raise ValueError(
+            f"Unknown preload profile {profile!r}, expected one of {sorted(PRELOAD_PROFILES)}"
+        )
+
+
+def preloads_pyplot(profile: str) -> bool:
+    return "matplotlib.pyplot" in preload_modules(profile)
+
+
+def zygote_modules(profile: str) -> List[str]:
+    """Modules the zygote imports before forking kernels for ``profile``."""
+    modules = ["ipykernel.kernelapp", "ipykernel.ipkernel"] + preload_modules(profile)
+    if preloads_pyplot(profile):
+        modules += ["matplotlib_inline.backend_inline", "matplotlib.font_manager"]
+    return modules
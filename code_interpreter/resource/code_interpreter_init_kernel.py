@@ -1,51 +1,107 @@
+import importlib as _m6_importlib
 import json  # noqa
 import math  # noqa
 import os  # noqa
 import re  # noqa
-import signal
-
-import matplotlib  # noqa
-import matplotlib.pyplot as plt
-import numpy as np  # noqa
-import pandas as pd  # noqa
-from matplotlib.font_manager import FontProperties
-from sympy import Eq, solve, symbols  # noqa
+import sys as _m6_sys
+from importlib.util import find_spec as _m6_find_spec
+
+# 由 get_init_code() 按预加载配置填入
+_m6_preload = {{M6_PRELOAD_MODULES}}
+
+
+class _M6LazyImport:
+    """Stands in for a library that is not preloaded and imports it on first use."""
+
+    def __init__(self, name, module, attr=None):
+        self._m6_name = name
+        self._m6_module = module
+        self._m6_attr = attr
+
+    def _m6_load(self):
+        value = _m6_importlib.import_module(self._m6_module)
+        if self._m6_attr is not None:
+            value = getattr(value, self._m6_attr)
+        # 之后直接使用真正的模块，不再经过代理
+        if globals().get(self._m6_name) is self:
+            globals()[self._m6_name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith("_m6_"):  # 例如 copy/pickle 时还没有执行 __init__
+            raise AttributeError(name)
+        return getattr(self._m6_load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._m6_load()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._m6_load())
+
+    def __repr__(self):
+        name = self._m6_module + ("." + self._m6_attr if self._m6_attr else "")
+        return f"<lazy import of {name}>"
+
+
+# 名字 -> (模块, 属性)
+_m6_names = {
+    "np": ("numpy", None),
+    "pd": ("pandas", None),
+    "matplotlib": ("matplotlib", None),
+    "plt": ("matplotlib.pyplot", None),
+    "Eq": ("sympy", "Eq"),
+    "solve": ("sympy", "solve"),
+    "symbols": ("sympy", "symbols"),
+}
+for _m6_name, (_m6_module, _m6_attr) in _m6_names.items():
+    # 已经导入过的(例如 zygote 预加载的)库不必再走代理
+    if _m6_module in _m6_preload or _m6_module in _m6_sys.modules:
+        _m6_value = _m6_importlib.import_module(_m6_module)
+        globals()[_m6_name] = getattr(_m6_value, _m6_attr) if _m6_attr else _m6_value
+    else:
+        globals()[_m6_name] = _M6LazyImport(_m6_name, _m6_module, _m6_attr)
+del _m6_names, _m6_name, _m6_module, _m6_attr
 
 
 def input(*args, **kwargs):  # noqa
     raise NotImplementedError("Python input() function is disabled.")
 
 
-def _m6_timout_handler(_signum=None, _frame=None):
-    raise TimeoutError("M6_CODE_INTERPRETER_TIMEOUT")
+## 设置中文字体
+def _m6_setup_font():
+    try:
+        from matplotlib import rcParams
+        from matplotlib.font_manager import FontProperties
 
+        rcParams["font.family"] = FontProperties(fname="{{M6_FONT_PATH}}").get_name()
+    except Exception as e:
+        print(f"Failed to set the CJK font: {e}", file=_m6_sys.stderr)
 
-try:
-    signal.signal(signal.SIGALRM, _m6_timout_handler)
-except AttributeError:  # windows
-    pass
 
+class _M6FontHook:
+    """Sets the font once matplotlib gets imported, however it is imported."""
 
-class _M6CountdownTimer:
+    def find_spec(self, fullname, path, target=None):
+        if fullname != "matplotlib":
+            return None
+        _m6_sys.meta_path.remove(self)
+        spec = _m6_find_spec(fullname)
+        exec_module = spec.loader.exec_module
 
-    @classmethod
-    def start(cls, timeout: int):
-        try:
-            signal.alarm(timeout)
-        except AttributeError:  # windows
-            pass  # I haven't found a timeout solution that works with windows + jupyter yet.
+        def _exec_module(module):
+            exec_module(module)
+            _m6_setup_font()
 
-    @classmethod
-    def cancel(cls):
-        try:
-            signal.alarm(0)
-        except AttributeError:  # windows
-            pass
+        spec.loader.exec_module = _exec_module
+        return spec
 
 
-## 设置中文字体
-_m6_font_prop = FontProperties(fname="{{M6_FONT_PATH}}")
-plt.rcParams["font.family"] = _m6_font_prop.get_name()
+# 重新执行初始化脚本(例如 reset 之后)时不要重复安装
+_m6_sys.meta_path[:] = [x for x in _m6_sys.meta_path if type(x).__name__ != "_M6FontHook"]
+if "matplotlib" in _m6_sys.modules:
+    _m6_setup_font()
+else:
+    _m6_sys.meta_path.insert(0, _M6FontHook())
 
 
 # import warnings
@@ -0,0 +1,209 @@
+import importlib.metadata
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from code_interpreter.config import (
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_DISK_MB,
+    RESULT_CACHE_MEMORY_MB,
+)
+from code_interpreter.download_cache import get_download_cache
+from code_interpreter.interpreter import get_init_code
+from code_interpreter.logger import logging
+from code_interpreter.metrics import RESULT_CACHE_LOOKUPS
+from code_interpreter.utils import get_basename_from_url, hash_sha256, print_traceback
+
+# 这些包的版本变了，同样的代码可能得到不同的结果
+_KERNEL_PACKAGES = ("ipykernel", "ipython", "numpy", "pandas", "matplotlib", "sympy")
+
+
+class ResultCache:
+    """Memoized results of stateless executions.
+
+    Results are keyed by the code, the content of its input files, the
+    timeout and the version of the kernel environment. The most recently used
+    ones are kept in memory up to ``memory_mb``; older ones spill over to
+    ``cache_dir`` on disk, which is in turn bounded by ``disk_mb``.
+    Images in a result are links into the content-addressed image store, so
+    the stored markdown is all that needs to be kept. Those files are
+    subject to the workspace GC though; ``get`` takes a ``validate`` check
+    and treats a result whose files are gone as a miss.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = RESULT_CACHE_DIR,
+        memory_mb: float = RESULT_CACHE_MEMORY_MB,
+        disk_mb: float = RESULT_CACHE_DISK_MB,
+    ):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_mb * 2**20
+        self.disk_limit = disk_mb * 2**20
+        os.makedirs(cache_dir, exist_ok=True)
+        self.env_version = kernel_env_version()
+        # 最久未使用的在最前面；值为序列化后的结果
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    @staticmethod
+    def inputs(files: List[str]) -> List[Tuple[str, str]]:
+        """(file name, sha256 of content) of ``files``; fetches (or revalidates) them."""
+        cache = get_download_cache()
+        # kernel 里按文件名读取，文件名和内容都算在 key 里
+        return [(get_basename_from_url(url), cache.digest(url)) for url in files]
+
+    def key(self, code: str, inputs: List[Tuple[str, str]], timeout: Optional[float]) -> str:
+        """Cache key of an execution with the input files ``inputs`` (see ``inputs``)."""
+        return hash_sha256(
+            json.dumps(
+                {"code": code, "files": inputs, "timeout": timeout, "env": self.env_version},
+                sort_keys=True,
+            )
+        )
+
+    def get(
+        self, key: str, validate: Optional[Callable[[Dict], bool]] = None
+    ) -> Optional[Dict]:
+        """The stored result of ``key``; None if there is none or ``validate`` rejects it."""
+        lookup = "hit"
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+        if value is None:
+            lookup = "disk_hit"
+            value = self._read_disk(key)
+        result = None if value is None else json.loads(value)
+        if result is not None and validate is not None and not validate(result):
+            # 结果链接的图片等文件已经被清理，重新执行
+            logging.info(f"Dropped stale result {key} from the result cache")
+            self._discard(key)
+            result = None
+        with self._lock:
+            if result is None:
+                lookup = "miss"
+                self.misses += 1
+            else:
+                self.hits += 1
+                if lookup == "disk_hit":
+                    self.disk_hits += 1
+                    self._put_memory(key, value)  # type: ignore
+        RESULT_CACHE_LOOKUPS.inc(lookup)
+        return result
+
+    def put(self, key: str, result: Dict):
+        value = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            spilled = self._put_memory(key, value)
+        for spilled_key, spilled_value in spilled:
+            self._write_disk(spilled_key, spilled_value)
+        if spilled:
+            self._evict_disk()
+
+    def bypass(self):
+        with self._lock:
+            self.bypasses += 1
+        RESULT_CACHE_LOOKUPS.inc("bypass")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "memory_entries": len(self._memory),
+                "memory_mb": self._memory_size / 2**20,
+                "env_version": self.env_version,
+            }
+
+    def _put_memory(self, key: str, value: str) -> List[Tuple[str, str]]:
+        """Insert into the memory LRU and return the entries pushed out of it."""
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = value
+        self._memory_size += len(value)
+        spilled = []
+        while self._memory_size > self.memory_limit and self._memory:
+            spilled_key, spilled_value = self._memory.popitem(last=False)
+            self._memory_size -= len(spilled_value)
+            spilled.append((spilled_key, spilled_value))
+        return spilled
+
+    def _discard(self, key: str):
+        with self._lock:
+            value = self._memory.pop(key, None)
+            if value is not None:
+                self._memory_size -= len(value)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path) as fin:
+                value = fin.read()
+            # 用修改时间记录最近使用，磁盘部分按它淘汰
+            os.utime(path)
+            return value
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, value: str):
+        if not self.disk_limit:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as fout:
+                fout.write(value)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            print_traceback()
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.disk_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            logging.info(f"Evicted {os.path.basename(path)} from the result cache")
+
+
+def kernel_env_version() -> str:
+    """Fingerprint of what a fresh kernel runs with: Python, key packages, init script."""
+    versions = []
+    for package in _KERNEL_PACKAGES:
+        try:
+            versions.append(f"{package}=={importlib.metadata.version(package)}")
+        except importlib.metadata.PackageNotFoundError:
+            versions.append(f"{package}==")
+    return hash_sha256("\n".join([sys.version, *versions, get_init_code()]))[:16]
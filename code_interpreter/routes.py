@@ -0,0 +1,112 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.security import APIKeyHeader
+
+from code_interpreter.config import DATASET_ADMIN_KEYS, UPLOAD_MAX_MB
+from code_interpreter.datasets import DatasetNotFound, get_dataset_store
+from code_interpreter.logger import logging
+from code_interpreter.metrics import PHASE_SECONDS
+from code_interpreter.session_manager import SessionManager
+from code_interpreter.uploads import UploadError, save_multipart
+from code_interpreter.workspace import RESERVED_NAMES, QuotaExceeded, WorkspaceManager
+
+API_KEY_HEADER = APIKeyHeader(name="X-API-Key")
+
+
+def over_quota(e: QuotaExceeded) -> HTTPException:
+    return HTTPException(status_code=507, detail=str(e))
+
+
+def get_dataset_admin(api_key: str = Depends(API_KEY_HEADER)) -> str:
+    # 数据集所有会话共享，只有配置的 API key 可以注册、删除
+    if api_key not in DATASET_ADMIN_KEYS:
+        raise HTTPException(status_code=403, detail="This API key can not manage datasets")
+    return api_key
+
+
+def file_routes(sessions: SessionManager, workspaces: WorkspaceManager) -> APIRouter:
+    """Uploads, shared datasets and workspace usage, served by both apps.
+
+    ``sessions`` and ``workspaces`` are those of the app including the router.
+    """
+    router = APIRouter()
+    dataset_store = get_dataset_store()
+
+    @router.get("/workspace")
+    async def workspace_usage(api_key: str = Depends(API_KEY_HEADER)):
+        # 现在重新统计，不用后台清理时的数字
+        await asyncio.get_running_loop().run_in_executor(None, workspaces.measure, [api_key])
+        return {
+            "path": workspaces.path(api_key),
+            "usage_mb": workspaces.usage(api_key) / 2**20,
+            "quota_mb": workspaces.quota / 2**20,
+        }
+
+    @router.post("/upload")
+    async def upload_files(request: Request, api_key: str = Depends(API_KEY_HEADER)):
+        # 边接收边写盘，文件出现在会话的工作目录下；先建立会话，工作目录不会被当作无主的清理掉
+        work_dir = sessions.get(api_key).interpreter.work_dir
+        try:
+            workspaces.check(api_key)
+            with PHASE_SECONDS.time("upload"):
+                files = await save_multipart(
+                    request.stream(),
+                    request.headers.get("content-type", ""),
+                    work_dir,
+                    # 不超过配额剩下的空间
+                    workspaces.upload_limit(api_key, UPLOAD_MAX_MB * 2**20),
+                    reserved_names=RESERVED_NAMES,
+                )
+        except QuotaExceeded as e:
+            raise over_quota(e)
+        except UploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        workspaces.add(api_key, sum(f["size"] for f in files))
+        return {
+            "status": "success",
+            "files": [{"name": f["name"], "size": f["size"]} for f in files],
+        }
+
+    @router.get("/datasets")
+    def list_datasets():
+        return {"datasets": dataset_store.list()}
+
+    @router.put("/datasets/{name}")
+    async def register_dataset(
+        name: str, request: Request, api_key: str = Depends(get_dataset_admin)
+    ):
+        try:
+            dataset_store.check_name(name)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        staging = dataset_store.staging()
+        try:
+            with PHASE_SECONDS.time("upload"):
+                files = await save_multipart(
+                    request.stream(), request.headers.get("content-type", ""), staging
+                )
+            if not files:
+                raise UploadError("The upload contains no files")
+            # 删除旧版本可能要一点时间，不在事件循环里做
+            info = await asyncio.get_running_loop().run_in_executor(
+                None, dataset_store.commit, name, staging
+            )
+        except UploadError as e:
+            dataset_store.discard(staging)
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        except BaseException:
+            dataset_store.discard(staging)
+            raise
+        logging.info(f"Dataset {name} registered by API key: {api_key}")
+        return {"status": "success", **info}
+
+    @router.delete("/datasets/{name}")
+    def remove_dataset(name: str, api_key: str = Depends(get_dataset_admin)):
+        try:
+            dataset_store.remove(name)
+        except DatasetNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        return {"status": "success"}
+
+    return router
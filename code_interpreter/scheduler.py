@@ -0,0 +1,192 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from code_interpreter.config import (
+    SCHEDULER_MAX_CONCURRENCY,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_QUEUE_PER_KEY,
+)
+from code_interpreter.metrics import ADMISSIONS, PHASE_SECONDS
+
+# 当前请求占用的执行名额，见 kernel_started
+_CURRENT_SLOT: "ContextVar[Optional[_Slot]]" = ContextVar("m6_current_slot", default=None)
+
+
+class SchedulerFull(Exception):
+    """The request was not queued; ``retry_after`` is a hint in seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Slot:
+    def __init__(self, timing: Dict[str, float]):
+        self.timing = timing
+        # 在 kernel 里排队等待的秒数；None 表示 kernel 还没开始执行这个请求
+        self.kernel_wait: Optional[float] = None
+
+
+def kernel_started(waited: float):
+    """Count the ``waited`` seconds the current request queued in its kernel as queue_wait.
+
+    Executions on a session are pipelined (see IopubDispatcher), so a request
+    that holds a slot may still wait in the kernel behind earlier requests of
+    its session. The interpreter calls this when the kernel starts on it; only
+    the first call in a slot counts, e.g. for the first cell of a batch.
+    """
+    slot = _CURRENT_SLOT.get()
+    if slot is not None and slot.kernel_wait is None:
+        slot.kernel_wait = waited
+        slot.timing["queue_wait"] += waited
+
+
+class ExecutionScheduler:
+    """Admission control and fair queuing for executions.
+
+    At most ``max_concurrency`` requests execute at once. The others wait in
+    one queue per API key, and a freed slot goes to the waiting key that was
+    served longest ago, so a key with many queued requests gets the same
+    share as a key with one. When
+    ``max_queue`` requests are waiting in total, or ``max_queue_per_key`` for
+    one key, ``slot`` fails right away with ``SchedulerFull`` instead of
+    letting the latency grow without bound.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        max_queue_per_key: int = SCHEDULER_MAX_QUEUE_PER_KEY,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_per_key = max(0, max_queue_per_key)
+        self.running = 0
+        # API key -> 等待中的请求
+        self._queues: Dict[str, Deque[asyncio.Future]] = {}
+        self._waiting = 0
+        # 还有请求在执行或排队的 key 最近一次拿到名额的序号，空出的名额给序号最小的 key
+        self._served: Dict[str, int] = {}
+        self._running_by_key: Dict[str, int] = {}
+        self._seq = 0
+        # 每个请求占用执行名额的平均时长(指数滑动平均)，用来估计 Retry-After
+        self._avg_duration = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+
+    @asynccontextmanager
+    async def slot(self, key: str) -> AsyncIterator[Dict[str, float]]:
+        """Hold an execution slot for ``key``.
+
+        Yields a dict with the seconds spent queuing (``queue_wait``), which
+        grows by the time the request then waits in its kernel (see
+        ``kernel_started``); the seconds the slot was held apart from that
+        (``duration``) are added when it is released.
+        """
+        queued_at = time.perf_counter()
+        await self._acquire(key)
+        started_at = time.perf_counter()
+        timing = {"queue_wait": started_at - queued_at}
+        self.admitted += 1
+        self.queue_wait_total += timing["queue_wait"]
+        ADMISSIONS.inc("admitted")
+        PHASE_SECONDS.observe(timing["queue_wait"], "scheduler_wait")
+        slot = _Slot(timing)
+        token = _CURRENT_SLOT.set(slot)
+        try:
+            yield timing
+        finally:
+            _CURRENT_SLOT.reset(token)
+            held = time.perf_counter() - started_at
+            timing["duration"] = held - (slot.kernel_wait or 0.0)
+            self._avg_duration = 0.9 * self._avg_duration + 0.1 * held
+            self._release(key)
+
+    def retry_after(self) -> int:
+        # 排在前面的请求按平均时长、以全部并发名额执行完大约需要的时间
+        estimate = (self._waiting + 1) * self._avg_duration / self.max_concurrency
+        return max(1, min(60, math.ceil(estimate)))
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "max_queue_per_key": self.max_queue_per_key,
+            "running": self.running,
+            "queued": self._waiting,
+            "queued_keys": len(self._queues),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait_avg": self.queue_wait_total / self.admitted if self.admitted else 0.0,
+        }
+
+    async def _acquire(self, key: str):
+        if self.running < self.max_concurrency and not self._waiting:
+            self._grant(key)
+            return
+        queue = self._queues.get(key)
+        if self._waiting >= self.max_queue or (
+            queue is not None and len(queue) >= self.max_queue_per_key
+        ):
+            self.rejected += 1
+            ADMISSIONS.inc("rejected")
+            raise SchedulerFull("Too many queued requests, retry later.", self.retry_after())
+        if queue is None:
+            queue = self._queues[key] = deque()
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        self._waiting += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已经分给了这个请求，转交给下一个
+                self._release(key)
+            else:
+                self._remove(key, waiter)
+            raise
+
+    def _grant(self, key: str):
+        self.running += 1
+        self._running_by_key[key] = self._running_by_key.get(key, 0) + 1
+        self._seq += 1
+        self._served[key] = self._seq
+
+    def _release(self, key: str):
+        self.running -= 1
+        self._running_by_key[key] -= 1
+        if not self._running_by_key[key]:
+            del self._running_by_key[key]
+            if key not in self._queues:
+                self._served.pop(key, None)
+        while self._queues and self.running < self.max_concurrency:
+            next_key = min(self._queues, key=lambda k: self._served.get(k, 0))
+            queue = self._queues[next_key]
+            waiter = queue.popleft()
+            self._waiting -= 1
+            if not queue:
+                del self._queues[next_key]
+            if not waiter.done():
+                self._grant(next_key)
+                waiter.set_result(None)
+            elif next_key not in self._queues and next_key not in self._running_by_key:
+                # 取消了的请求
+                self._served.pop(next_key, None)
+
+    def _remove(self, key: str, waiter: asyncio.Future):
+        queue = self._queues.get(key)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self._waiting -= 1
+        if not queue:
+            del self._queues[key]
+            if key not in self._running_by_key:
+                self._served.pop(key, None)
@@ -0,0 +1,309 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import psutil  # installed together with ipykernel
+
+from code_interpreter.async_interpreter import AsyncCodeInterpreter
+from code_interpreter.config import (
+    SESSION_HIBERNATE,
+    SESSION_HIBERNATE_MAX_MB,
+    SESSION_HIBERNATE_MAX_VARIABLE_MB,
+    SESSION_HIBERNATE_TIMEOUT,
+    SESSION_HIBERNATE_TTL,
+    SESSION_IDLE_TTL,
+    SESSION_MAX_KERNELS,
+    SESSION_MEMORY_BUDGET_MB,
+    SESSION_SWEEP_INTERVAL,
+)
+from code_interpreter.hibernation import snapshot_path
+from code_interpreter.interpreter import get_default_work_dir
+from code_interpreter.logger import logging
+from code_interpreter.metrics import EVICTIONS
+from code_interpreter.session_registry import SessionRegistry
+from code_interpreter.utils import print_traceback
+from code_interpreter.workspace import WorkspaceManager
+
+
+class _Session:
+    def __init__(self, interpreter: AsyncCodeInterpreter):
+        self.interpreter = interpreter
+        self.created = time.time()
+        self.last_used = self.created
+        self.rss = 0
+        # kernel 已回收，用户变量保存在快照里
+        self.hibernated = False
+
+
+class SessionManager:
+    """Bounded table of API key -> AsyncCodeInterpreter.
+
+    A background sweeper evicts sessions that have been idle for longer than
+    ``idle_ttl`` and, while there are more than ``max_kernels`` live kernels or
+    their RSS exceeds ``memory_budget_mb``, the least recently used ones.
+    Sessions in the middle of an execution are never evicted.
+
+    With a ``registry`` shared by several workers, the sweeper also merges the
+    last-used times of every worker, so a kernel that another worker keeps
+    using is not evicted by its owner as idle.
+
+    With ``hibernate`` an evicted session keeps its user namespace: it is
+    saved to ``hibernate_dir`` before the kernel is shut down, and restored
+    into a new kernel on the session's next request. Hibernated sessions cost
+    no kernel and are only dropped after ``hibernate_ttl``.
+
+    With ``workspaces`` the sweeper also measures the disk usage of the
+    sessions' workspaces and runs their garbage collection; a workspace is
+    deleted together with its session (a hibernated session keeps it).
+    With a registry only released and expired sessions lose it, since
+    another worker may still use the session.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], AsyncCodeInterpreter],
+        idle_ttl: float = SESSION_IDLE_TTL,
+        max_kernels: int = SESSION_MAX_KERNELS,
+        memory_budget_mb: float = SESSION_MEMORY_BUDGET_MB,
+        sweep_interval: float = SESSION_SWEEP_INTERVAL,
+        registry: Optional[SessionRegistry] = None,
+        hibernate: bool = SESSION_HIBERNATE,
+        hibernate_dir: Optional[str] = None,
+        hibernate_ttl: float = SESSION_HIBERNATE_TTL,
+        workspaces: Optional[WorkspaceManager] = None,
+    ):
+        self.factory = factory
+        self.registry = registry
+        self.workspaces = workspaces
+        # 上一次统计工作目录占用的时间，之后用过的会话需要重新统计
+        self._measured_at = 0.0
+        self.hibernate_enabled = hibernate
+        self.hibernate_dir = hibernate_dir or os.path.join(get_default_work_dir(), "hibernate")
+        self.hibernate_ttl = hibernate_ttl
+        self.idle_ttl = idle_ttl
+        self.max_kernels = max_kernels
+        self.memory_budget = memory_budget_mb * 2**20
+        self.sweep_interval = sweep_interval
+        # 按最近使用时间排序，最久未使用的在最前面
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.evictions: Dict[str, int] = {"idle": 0, "lru": 0, "memory": 0, "expired": 0}
+        self.hibernations = 0
+        self.hibernation_failures = 0
+
+    def get(self, api_key: str) -> AsyncCodeInterpreter:
+        session = self._sessions.get(api_key)
+        if session is None:
+            session = _Session(self.factory(api_key))
+            if self.hibernate_enabled:
+                # 快照路径只由 API key 决定，其他 worker 或上次运行留下的快照也会被恢复
+                session.interpreter.snapshot_path = snapshot_path(self.hibernate_dir, api_key)
+            self._sessions[api_key] = session
+            if len(self._sessions) > self.max_kernels and self._wakeup is not None:
+                self._wakeup.set()
+        else:
+            self._sessions.move_to_end(api_key)
+        session.last_used = time.time()
+        session.hibernated = False
+        return session.interpreter
+
+    def __contains__(self, api_key: str) -> bool:
+        return api_key in self._sessions
+
+    async def remove(self, api_key: str, reason: str = "release"):
+        session = self._sessions.pop(api_key, None)
+        if session is None:
+            return
+        if reason in self.evictions:
+            self.evictions[reason] += 1
+            EVICTIONS.inc(reason)
+        try:
+            # 只有主动释放才关闭其他 worker 的 kernel，其余情况只断开连接
+            await session.interpreter.stop(release=reason == "release")
+        except Exception:
+            print_traceback()
+        path = session.interpreter.snapshot_path
+        if reason in ("release", "expired") and path and os.path.exists(path):
+            os.remove(path)
+        if (
+            self.workspaces is not None
+            and reason != "shutdown"
+            and (self.registry is None or reason in ("release", "expired"))
+            # 关闭 kernel 期间同一个 key 又来了请求，新会话沿用这个目录
+            and api_key not in self._sessions
+        ):
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.workspaces.remove, api_key
+            )
+        logging.info(f"Removed interpreter for API key: {api_key} ({reason})")
+
+    async def evict(self, api_key: str, reason: str):
+        """Free the kernel of a session, hibernating it if enabled."""
+        if self.hibernate_enabled:
+            await self.hibernate(api_key, reason)
+        else:
+            await self.remove(api_key, reason)
+
+    async def hibernate(self, api_key: str, reason: str = "idle"):
+        session = self._sessions.get(api_key)
+        if session is None or session.hibernated:
+            return
+        used_at = session.last_used
+        try:
+            report = await session.interpreter.hibernate(
+                snapshot_path(self.hibernate_dir, api_key),
+                int(SESSION_HIBERNATE_MAX_MB * 2**20),
+                int(SESSION_HIBERNATE_MAX_VARIABLE_MB * 2**20),
+                SESSION_HIBERNATE_TIMEOUT,
+            )
+        except Exception:
+            print_traceback()
+            self.hibernation_failures += 1
+            report = None
+        if report is None:
+            # 没有可保存的 kernel(或保存失败)，按原来的方式回收
+            await self.remove(api_key, reason)
+            return
+        # 保存期间又来了请求时，它会在新 kernel 里恢复快照，会话不算休眠
+        if self._sessions.get(api_key) is session and session.last_used == used_at:
+            session.hibernated = True
+        self.hibernations += 1
+        if reason in self.evictions:
+            self.evictions[reason] += 1
+            EVICTIONS.inc(reason)
+        logging.info(f"Hibernated interpreter for API key: {api_key} ({reason}): {report}")
+
+    async def start(self):
+        if self._sweeper is None:
+            self._wakeup = asyncio.Event()
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for api_key in list(self._sessions):
+            await self.remove(api_key, reason="shutdown")
+
+    async def sweep(self):
+        if self.registry is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._sync_registry)
+        now = time.time()
+        self._measure()
+        for api_key, session in list(self._sessions.items()):
+            if session.interpreter.busy:
+                session.last_used = now
+                self._sessions.move_to_end(api_key)
+            elif session.hibernated:
+                if now - session.last_used > self.hibernate_ttl:
+                    await self.remove(api_key, reason="expired")
+            elif now - session.last_used > self.idle_ttl:
+                await self.evict(api_key, reason="idle")
+        if self.hibernate_enabled:
+            await asyncio.get_running_loop().run_in_executor(None, self._expire_snapshots)
+        if self.workspaces is not None:
+            await self._sweep_workspaces(now)
+
+        while True:
+            live = [
+                (k, s) for k, s in self._sessions.items() if s.interpreter.interpreter.kernel_pid
+            ]
+            if len(live) > self.max_kernels:
+                reason = "lru"
+            elif self.memory_budget and sum(s.rss for _, s in live) > self.memory_budget:
+                reason = "memory"
+            else:
+                break
+            victim = next((k for k, s in live if not s.interpreter.busy), None)
+            if victim is None:
+                break
+            await self.evict(victim, reason=reason)
+
+    def stats(self) -> Dict:
+        live = [s for s in self._sessions.values() if s.interpreter.interpreter.kernel_pid]
+        return {
+            "sessions": len(self._sessions),
+            "live_kernels": len(live),
+            "busy_kernels": sum(1 for s in live if s.interpreter.busy),
+            "kernel_rss_mb": sum(s.rss for s in live) / 2**20,
+            "idle_ttl": self.idle_ttl,
+            "max_kernels": self.max_kernels,
+            "memory_budget_mb": self.memory_budget / 2**20,
+            "evictions": dict(self.evictions),
+            "hibernated": sum(1 for s in self._sessions.values() if s.hibernated),
+            "hibernations": self.hibernations,
+            "hibernation_failures": self.hibernation_failures,
+            "attached_kernels": sum(1 for s in live if s.interpreter.interpreter.kernel_attached),
+            "registry": self.registry.stats() if self.registry is not None else None,
+            "workspaces": self.workspaces.stats() if self.workspaces is not None else None,
+        }
+
+    def _sync_registry(self):
+        last_used = self.registry.touch(  # type: ignore
+            {k: s.last_used for k, s in self._sessions.items()}
+        )
+        for api_key, t in last_used.items():
+            session = self._sessions.get(api_key)
+            if session is not None:
+                session.last_used = max(session.last_used, t)
+
+    def _expire_snapshots(self):
+        # 其他 worker 或上次运行留下、已经没有会话使用的快照
+        try:
+            entries = list(os.scandir(self.hibernate_dir))
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > self.hibernate_ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    async def _sweep_workspaces(self, now: float):
+        loop = asyncio.get_running_loop()
+        used = [k for k, s in self._sessions.items() if s.last_used >= self._measured_at]
+        self._measured_at = now
+        await loop.run_in_executor(None, self.workspaces.measure, used)  # type: ignore
+        if now - self.workspaces.last_collect >= self.workspaces.gc_interval:  # type: ignore
+            await loop.run_in_executor(
+                None,
+                self.workspaces.collect,  # type: ignore
+                list(self._sessions),
+                self.hibernate_dir if self.hibernate_enabled else None,
+            )
+
+    def _measure(self):
+        for session in self._sessions.values():
+            pid = session.interpreter.interpreter.kernel_pid
+            session.rss = _process_tree_rss(pid) if pid else 0
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.sweep_interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()  # type: ignore
+            try:
+                await self.sweep()
+            except Exception:
+                print_traceback()
+
+
+def _process_tree_rss(pid: int) -> int:
+    try:
+        process = psutil.Process(pid)
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+    except psutil.Error:
+        return 0
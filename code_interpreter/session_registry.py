@@ -0,0 +1,241 @@
+import abc
+import contextlib
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from typing import ContextManager, Dict, List, NamedTuple, Optional
+
+from code_interpreter.config import SESSION_REGISTRY
+from code_interpreter.logger import logging
+from code_interpreter.utils import hash_sha256
+
+
+class SessionRecord(NamedTuple):
+    api_key: str
+    worker_pid: int  # 启动该 kernel 的 worker 进程
+    kernel_pid: int
+    connection_file: str
+    last_used: float
+
+
+class SessionStore(abc.ABC):
+    """Where the registry keeps its records; subclass it to use another backend."""
+
+    @abc.abstractmethod
+    def get(self, api_key: str) -> Optional[SessionRecord]:
+        pass
+
+    @abc.abstractmethod
+    def put(self, record: SessionRecord):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, api_key: str, kernel_pid: int):
+        """Delete the record, unless it has meanwhile been replaced by another kernel."""
+
+    @abc.abstractmethod
+    def touch(self, last_used: Dict[str, float]) -> Dict[str, float]:
+        """Merge per-key ``last_used`` times and return the latest known ones."""
+
+    @abc.abstractmethod
+    def list(self) -> List[SessionRecord]:
+        pass
+
+    @abc.abstractmethod
+    def lock(self, api_key: str) -> ContextManager:
+        """Exclusive lock on one key, held while its kernel is looked up or started."""
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store, for a single worker or for tests."""
+
+    def __init__(self):
+        self._records: Dict[str, SessionRecord] = {}
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    def get(self, api_key: str) -> Optional[SessionRecord]:
+        return self._records.get(api_key)
+
+    def put(self, record: SessionRecord):
+        with self._lock:
+            self._records[record.api_key] = record
+
+    def delete(self, api_key: str, kernel_pid: int):
+        with self._lock:
+            record = self._records.get(api_key)
+            if record is not None and record.kernel_pid == kernel_pid:
+                del self._records[api_key]
+
+    def touch(self, last_used: Dict[str, float]) -> Dict[str, float]:
+        merged = {}
+        with self._lock:
+            for api_key, t in last_used.items():
+                record = self._records.get(api_key)
+                if record is None:
+                    continue
+                if t > record.last_used:
+                    record = self._records[api_key] = record._replace(last_used=t)
+                merged[api_key] = record.last_used
+        return merged
+
+    def list(self) -> List[SessionRecord]:
+        return list(self._records.values())
+
+    def lock(self, api_key: str) -> ContextManager:
+        with self._lock:
+            return self._key_locks.setdefault(api_key, threading.Lock())
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store shared by all worker processes on a host, in one SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_dir = f"{path}.locks"
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " api_key TEXT PRIMARY KEY,"
+                " worker_pid INTEGER NOT NULL,"
+                " kernel_pid INTEGER NOT NULL,"
+                " connection_file TEXT NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程使用，每个线程一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, api_key: str) -> Optional[SessionRecord]:
+        row = (
+            self._conn()
+            .execute("SELECT * FROM sessions WHERE api_key = ?", (api_key,))
+            .fetchone()
+        )
+        return SessionRecord(*row) if row else None
+
+    def put(self, record: SessionRecord):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", tuple(record)
+            )
+
+    def delete(self, api_key: str, kernel_pid: int):
+        with self._conn() as conn:
+            conn.execute(
+                "DELETE FROM sessions WHERE api_key = ? AND kernel_pid = ?",
+                (api_key, kernel_pid),
+            )
+
+    def touch(self, last_used: Dict[str, float]) -> Dict[str, float]:
+        if not last_used:
+            return {}
+        with self._conn() as conn:
+            conn.executemany(
+                "UPDATE sessions SET last_used = MAX(last_used, ?) WHERE api_key = ?",
+                [(t, k) for k, t in last_used.items()],
+            )
+            placeholders = ",".join("?" * len(last_used))
+            rows = conn.execute(
+                f"SELECT api_key, last_used FROM sessions WHERE api_key IN ({placeholders})",
+                list(last_used),
+            ).fetchall()
+        return dict(rows)
+
+    def list(self) -> List[SessionRecord]:
+        return [SessionRecord(*row) for row in self._conn().execute("SELECT * FROM sessions")]
+
+    @contextlib.contextmanager
+    def lock(self, api_key: str):
+        # 启动 kernel 要几秒，不能占着数据库的写锁，每个 key 单独用一个文件锁
+        path = os.path.join(self.lock_dir, f"{hash_sha256(api_key)}.lock")
+        with open(path, "w") as fout:
+            fcntl.flock(fout, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fout, fcntl.LOCK_UN)
+
+
+class SessionRegistry:
+    """Which kernel serves which API key, shared between worker processes.
+
+    The worker that starts a session's kernel publishes its connection file
+    here; a request for the same key that lands on another worker attaches to
+    that kernel instead of starting a second one with diverging state.
+    """
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def lookup(self, api_key: str) -> Optional[SessionRecord]:
+        """Return the record of a live kernel for ``api_key``, dropping stale ones."""
+        record = self.store.get(api_key)
+        if record is None:
+            return None
+        if not _pid_alive(record.kernel_pid) or not os.path.exists(record.connection_file):
+            logging.info(f"Dropping stale session record for {api_key}")
+            self.store.delete(api_key, record.kernel_pid)
+            return None
+        return record
+
+    def publish(self, api_key: str, kernel_pid: int, connection_file: str):
+        self.store.put(
+            SessionRecord(
+                api_key=api_key,
+                worker_pid=os.getpid(),
+                kernel_pid=kernel_pid,
+                connection_file=os.path.abspath(connection_file),
+                last_used=time.time(),
+            )
+        )
+
+    def claim(self, api_key: str) -> ContextManager:
+        """Hold this while looking up and, if needed, starting the kernel of a key,
+        so that two workers do not both start one."""
+        return self.store.lock(api_key)
+
+    def unpublish(self, api_key: str, kernel_pid: int):
+        self.store.delete(api_key, kernel_pid)
+
+    def touch(self, last_used: Dict[str, float]) -> Dict[str, float]:
+        return self.store.touch(last_used)
+
+    def stats(self) -> Dict:
+        records = self.store.list()
+        return {
+            "sessions": len(records),
+            "owned_by_this_worker": sum(1 for r in records if r.worker_pid == os.getpid()),
+        }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def create_session_registry(url: str = SESSION_REGISTRY) -> Optional[SessionRegistry]:
+    """Build a registry from a URL: "" (disabled), "memory" or "sqlite:///<path>"."""
+    if not url:
+        return None
+    if url == "memory":
+        return SessionRegistry(MemorySessionStore())
+    if url.startswith("sqlite://"):
+        return SessionRegistry(SQLiteSessionStore(url[len("sqlite://"):]))
+    raise ValueError(f"Unsupported session registry: {url}")
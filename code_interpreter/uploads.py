@@ -0,0 +1,185 @@
+import asyncio
+import os
+import re
+import tempfile
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from code_interpreter.config import DOWNLOAD_CHUNK_SIZE, UPLOAD_MAX_MB
+from code_interpreter.metrics import InstrumentedThreadPoolExecutor
+
+# 上传的文件在这里写盘，不阻塞事件循环
+_WRITER = InstrumentedThreadPoolExecutor("upload", max_workers=4)
+
+_MAX_HEADER_BYTES = 16384
+
+
+class UploadError(Exception):
+    """The upload is malformed or too large; ``status_code`` is the HTTP status."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+
+    ``feed`` takes the body in chunks of any size and returns events:
+    ("headers", {name: value}) when a part starts, ("data", bytes) for its
+    content and ("end", None) when it is complete. Only the bytes that may
+    still be the start of a delimiter are kept between calls, so memory use
+    does not depend on the size of the parts.
+    """
+
+    def __init__(self, boundary: bytes):
+        # 第一个分隔符前面没有换行，补上之后所有分隔符都一样
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = bytearray(b"\r\n")
+        self._state = "preamble"
+
+    @property
+    def done(self) -> bool:
+        return self._state == "epilogue"
+
+    def feed(self, chunk: bytes) -> List[Tuple[str, Optional[object]]]:
+        self._buffer += chunk
+        events: List[Tuple[str, Optional[object]]] = []
+        while True:
+            if self._state in ("preamble", "body"):
+                index = self._buffer.find(self._delimiter)
+                if index < 0:
+                    # 末尾可能是被截断的分隔符，留到下一块再判断
+                    keep = len(self._delimiter) - 1
+                    if self._state == "body" and len(self._buffer) > keep:
+                        events.append(("data", bytes(self._buffer[:-keep])))
+                        del self._buffer[:-keep]
+                    elif self._state == "preamble":
+                        del self._buffer[:-keep]
+                    return events
+                if self._state == "body":
+                    if index:
+                        events.append(("data", bytes(self._buffer[:index])))
+                    events.append(("end", None))
+                del self._buffer[: index + len(self._delimiter)]
+                self._state = "delimiter"
+            elif self._state == "delimiter":
+                if len(self._buffer) < 2:
+                    return events
+                if self._buffer[:2] == b"--":
+                    self._state = "epilogue"
+                    continue
+                self._state = "headers"
+            elif self._state == "headers":
+                index = self._buffer.find(b"\r\n\r\n")
+                if index < 0:
+                    if len(self._buffer) > _MAX_HEADER_BYTES:
+                        raise UploadError("Multipart headers are too large")
+                    return events
+                # 分隔符所在行的剩余部分(通常只有换行)之后才是头部
+                lines = self._buffer[:index].decode("utf-8", "replace").split("\r\n")[1:]
+                headers = {}
+                for line in lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                del self._buffer[: index + 4]
+                events.append(("headers", headers))
+                self._state = "body"
+            else:
+                self._buffer.clear()
+                return events
+
+
+def parse_boundary(content_type: str) -> bytes:
+    match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+    if not content_type.startswith("multipart/form-data") or match is None:
+        raise UploadError("Expected a multipart/form-data body")
+    return match.group(1).encode("latin-1")
+
+
+def part_filename(headers: Dict[str, str]) -> Optional[str]:
+    """The file name of a part, or None for a plain form field."""
+    disposition = headers.get("content-disposition", "")
+    match = re.search(r'filename\*=UTF-8\'\'([^;]+)', disposition, re.IGNORECASE)
+    if match is None:
+        match = re.search(r'filename="([^"]*)"', disposition) or re.search(
+            r"filename=([^;]+)", disposition
+        )
+    if match is None:
+        return None
+    # 浏览器可能带上客户端的路径，只保留文件名
+    name = os.path.basename(match.group(1).replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        raise UploadError("Invalid file name")
+    return name
+
+
+async def save_multipart(
+    chunks: AsyncIterator[bytes],
+    content_type: str,
+    save_dir: str,
+    max_bytes: float = UPLOAD_MAX_MB * 2**20,
+    reserved_names: Iterable[str] = (),
+) -> List[Dict]:
+    """Stream the files of a multipart body into ``save_dir``.
+
+    Each file is written to a temporary file next to its destination, and
+    all of them are renamed into place once the whole body has arrived, so
+    the kernel never sees a partial file and a failed upload leaves nothing
+    behind. Form fields are ignored. Raises UploadError (413) once more than
+    ``max_bytes`` have been received, and (400) for files named like one of
+    ``reserved_names`` or like a directory in ``save_dir``.
+    """
+    parser = MultipartParser(parse_boundary(content_type))
+    os.makedirs(save_dir, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    saved: List[Dict] = []
+    # 已经写完、等整个请求体收完再改名的 (临时文件, 目标路径)
+    complete: List[Tuple[str, str]] = []
+    received = 0
+    fout = None
+    tmp_path = ""
+    pending = bytearray()
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if max_bytes and received > max_bytes:
+                raise UploadError(f"Upload exceeds {max_bytes / 2**20:g} MB", 413)
+            for event, value in parser.feed(chunk):
+                if event == "headers":
+                    filename = part_filename(value)  # type: ignore
+                    if filename in reserved_names:
+                        raise UploadError(f"{filename} is a reserved name")
+                    if filename is not None:
+                        fd, tmp_path = tempfile.mkstemp(dir=save_dir, prefix=".upload-")
+                        fout = os.fdopen(fd, "wb")
+                        path = os.path.join(save_dir, filename)
+                        saved.append({"name": filename, "path": path, "size": 0})
+                elif event == "data" and fout is not None:
+                    pending += value  # type: ignore
+                    saved[-1]["size"] += len(value)  # type: ignore
+                    if len(pending) >= DOWNLOAD_CHUNK_SIZE:
+                        await loop.run_in_executor(_WRITER, fout.write, bytes(pending))
+                        pending.clear()
+                elif event == "end" and fout is not None:
+                    if pending:
+                        await loop.run_in_executor(_WRITER, fout.write, bytes(pending))
+                        pending.clear()
+                    fout.close()
+                    fout = None
+                    complete.append((tmp_path, saved[-1]["path"]))
+                    tmp_path = ""
+        if not parser.done:
+            raise UploadError("The multipart body is incomplete")
+        for _, path in complete:
+            if os.path.isdir(path):
+                raise UploadError(f"{os.path.basename(path)} is a directory")
+        for tmp, path in complete:
+            os.replace(tmp, path)
+        complete = []
+    finally:
+        if fout is not None:
+            fout.close()
+        for path in [tmp_path] + [tmp for tmp, _ in complete]:
+            if path and os.path.exists(path):
+                os.remove(path)
+    return saved
@@ -2,11 +2,9 @@ import hashlib
 import json
 import os
 import re
-import shutil
 import signal
 import socket
 import sys
-import time
 import traceback
 import urllib.parse
 from typing import Any, List, Literal
@@ -140,35 +138,10 @@ def sanitize_chrome_file_path(file_path: str) -> str:
 
 
 def save_url_to_local_work_dir(url: str, save_dir: str, save_filename: str = "") -> str:
-    if not save_filename:
-        save_filename = get_basename_from_url(url)
-    new_path = os.path.join(save_dir, save_filename)
-    if os.path.exists(new_path):
-        os.remove(new_path)
-    logging.info(f"Downloading {url} to {new_path}...")
-    start_time = time.time()
-    if not is_http_url(url):
-        parsed_url = urllib.parse.urlparse(url)
-        path = urllib.parse.unquote(parsed_url.path)
-        url = sanitize_chrome_file_path(path)
-        shutil.copy(url, new_path)
-    else:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-        }
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            with open(new_path, "wb") as file:
-                file.write(response.content)
-        else:
-            raise ValueError(
-                "Can not download this file. Please check your network or the file link."
-            )
-    end_time = time.time()
-    logging.info(
-        f"Finished downloading {url} to {new_path}. Time spent: {end_time - start_time} seconds."
-    )
-    return new_path
+    # 通过共享的下载缓存获取，避免同一个文件反复下载
+    from code_interpreter.download_cache import get_download_cache
+
+    return get_download_cache().save(url, save_dir, save_filename)
 
 
 def read_text_from_file(path: str) -> str:
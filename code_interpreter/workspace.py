@@ -0,0 +1,242 @@
+import fnmatch
+import os
+import shutil
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import psutil  # installed together with ipykernel
+
+from code_interpreter.config import (
+    WORKSPACE_ARTIFACT_TTL,
+    WORKSPACE_GC_INTERVAL,
+    WORKSPACE_QUOTA_MB,
+)
+from code_interpreter.datasets import MOUNT_DIR_NAME
+from code_interpreter.image_store import drop_image_store, expire_images
+from code_interpreter.interpreter import (
+    get_connection_dir,
+    get_default_work_dir,
+    get_shared_work_dir,
+)
+from code_interpreter.logger import logging
+from code_interpreter.utils import hash_sha256
+
+# 工作目录下由服务管理的子目录：数据集、图片、溢出的输出，上传的文件不能用这些名字
+RESERVED_NAMES = (MOUNT_DIR_NAME, "images", "outputs")
+
+# 旧版本直接写在工作目录下的文件，按保留时间清理
+_LEGACY_PATTERNS = (
+    "kernel_connection_file_*.json",
+    "launch_kernel_*.py",
+    "test_file_permission_*.txt",
+)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class WorkspaceManager:
+    """Per-session working directories with a disk quota.
+
+    Every API key gets the directory ``sessions/<sha256 of the key>`` under
+    the default working directory, the same on every worker, as the cwd of
+    its kernel and the place for its downloads, uploads, images and spilled
+    outputs. The
+    session manager's sweeper measures the workspaces that were used
+    (``measure``); once one holds more than ``quota_mb``, executions and
+    uploads of its session are refused (``check``) until files are deleted.
+    The quota is checked before a request, so a single execution can still
+    go over it.
+
+    ``collect`` is the garbage collector: it removes images and spilled
+    outputs older than ``artifact_ttl``, workspaces nobody has used for that
+    long, files of stateless executions, and the connection files of worker
+    processes that are gone.
+    """
+
+    def __init__(
+        self,
+        quota_mb: float = WORKSPACE_QUOTA_MB,
+        artifact_ttl: float = WORKSPACE_ARTIFACT_TTL,
+        gc_interval: float = WORKSPACE_GC_INTERVAL,
+    ):
+        self.root = get_default_work_dir()
+        self.sessions_dir = os.path.join(self.root, "sessions")
+        self.quota = quota_mb * 2**20
+        self.artifact_ttl = artifact_ttl
+        self.gc_interval = gc_interval
+        # 工作目录 -> 最近一次统计的占用(字节)
+        self._usage: Dict[str, int] = {}
+        self.last_collect = 0.0
+        self.removed = 0
+        self.expired_files = 0
+
+    def path(self, api_key: str) -> str:
+        return os.path.join(self.sessions_dir, hash_sha256(api_key))
+
+    def usage(self, api_key: str) -> int:
+        return self._usage.get(self.path(api_key), 0)
+
+    def check(self, api_key: str):
+        """Raise QuotaExceeded if the workspace of ``api_key`` is full."""
+        usage = self.usage(api_key)
+        if self.quota and usage >= self.quota:
+            raise QuotaExceeded(
+                f"The workspace uses {usage / 2**20:.1f} MB and exceeds its quota of "
+                f"{self.quota / 2**20:g} MB, delete some files first."
+            )
+
+    def upload_limit(self, api_key: str, max_bytes: float) -> float:
+        """``max_bytes`` (0 means no limit) lowered to what is left of the quota."""
+        if not self.quota:
+            return max_bytes
+        left = max(1, self.quota - self.usage(api_key))
+        return min(max_bytes, left) if max_bytes else left
+
+    def add(self, api_key: str, size: int):
+        # 上传完成后先计入，不必等下一次统计
+        path = self.path(api_key)
+        self._usage[path] = self._usage.get(path, 0) + size
+
+    def measure(self, api_keys: Iterable[str]):
+        """Recount the disk usage of the workspaces of ``api_keys``."""
+        for api_key in api_keys:
+            path = self.path(api_key)
+            self._usage[path] = _scan(path)[0]
+
+    def remove(self, api_key: str):
+        """Delete the workspace of ``api_key`` with everything in it."""
+        path = self.path(api_key)
+        self._usage.pop(path, None)
+        drop_image_store(path)
+        if os.path.isdir(path):
+            # 数据集是符号链接，rmtree 不会进入
+            shutil.rmtree(path, ignore_errors=True)
+            self.removed += 1
+
+    def collect(self, api_keys: Iterable[str], hibernate_dir: Optional[str] = None):
+        """Expire old artifacts; ``api_keys`` are the sessions of this worker.
+
+        Workspaces of other keys are removed once nothing in them changed for
+        ``artifact_ttl``, unless the session is hibernated (its snapshot is
+        in ``hibernate_dir``).
+        """
+        started = time.time()
+        self.last_collect = started
+        cutoff = started - self.artifact_ttl
+        active = {os.path.basename(self.path(k)) for k in api_keys}
+        expired = 0
+        removed = self.removed
+        try:
+            entries = list(os.scandir(self.sessions_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name in active:
+                expired += self._expire_artifacts(entry.path)
+                continue
+            snapshot = hibernate_dir and os.path.join(hibernate_dir, f"{entry.name}.pkl")
+            if snapshot and os.path.exists(snapshot):
+                continue
+            # 其他 worker 的会话也在这里，只删除很久没有变化的
+            if _scan(entry.path)[1] < cutoff:
+                self._usage.pop(entry.path, None)
+                drop_image_store(entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self.removed += 1
+        # 无状态执行的文件与产物
+        shared_dir = get_shared_work_dir()
+        expired += expire_images(shared_dir, self.artifact_ttl) + _expire_files(shared_dir, cutoff)
+        # 旧版本留在工作目录下的连接文件、图片与输出
+        expired += self._expire_artifacts(self.root)
+        try:
+            for entry in os.scandir(self.root):
+                if (
+                    entry.is_file(follow_symlinks=False)
+                    and any(fnmatch.fnmatch(entry.name, p) for p in _LEGACY_PATTERNS)
+                    and _changed_at(entry.path) < cutoff
+                ):
+                    os.remove(entry.path)
+                    expired += 1
+        except OSError:
+            pass
+        self._remove_dead_connection_dirs()
+        self.expired_files += expired
+        if expired or self.removed > removed:
+            logging.info(
+                f"Workspace GC: {expired} files expired, "
+                f"{self.removed - removed} workspaces removed ({time.time() - started:.2f}s)"
+            )
+
+    def stats(self) -> Dict:
+        return {
+            "root": self.sessions_dir,
+            "quota_mb": self.quota / 2**20,
+            "artifact_ttl": self.artifact_ttl,
+            "usage_mb": sum(self._usage.values()) / 2**20,
+            "over_quota": sum(1 for u in self._usage.values() if self.quota and u >= self.quota),
+            "removed": self.removed,
+            "expired_files": self.expired_files,
+            "last_collect": self.last_collect,
+        }
+
+    def _expire_artifacts(self, work_dir: str) -> int:
+        cutoff = time.time() - self.artifact_ttl
+        return expire_images(work_dir, self.artifact_ttl) + _expire_files(
+            os.path.join(work_dir, "outputs"), cutoff
+        )
+
+    def _remove_dead_connection_dirs(self):
+        connections_dir = os.path.dirname(get_connection_dir())
+        try:
+            entries = list(os.scandir(connections_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            # 每个 worker 进程一个目录，进程不在了，其中的 kernel 也已经关闭
+            if entry.name.isdigit() and not psutil.pid_exists(int(entry.name)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _changed_at(path: str) -> float:
+    st = os.lstat(path)
+    # 硬链接、改名不改 mtime，取较新的 ctime
+    return max(st.st_mtime, st.st_ctime)
+
+
+def _scan(path: str) -> Tuple[int, float]:
+    """Total size of the files under ``path`` and when the newest one changed.
+
+    Symbolic links (the mounted datasets) are not followed.
+    """
+    size = 0
+    newest = 0.0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for names, is_file in ((dir_names, False), (file_names, True)):
+            for name in names:
+                try:
+                    st = os.lstat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                newest = max(newest, st.st_mtime, st.st_ctime)
+                if is_file:
+                    size += st.st_size
+    return size, newest
+
+
+def _expire_files(path: str, cutoff: float) -> int:
+    """Remove the files under ``path`` that did not change since ``cutoff``."""
+    removed = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            try:
+                if _changed_at(file_path) < cutoff:
+                    os.remove(file_path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
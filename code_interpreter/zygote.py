@@ -0,0 +1,231 @@
+"""
+Fork server ("zygote") for ipykernel processes.
+
+The zygote imports ipykernel and the libraries used by the init script once,
+then forks a child for every kernel, so the imported modules are shared
+copy-on-write instead of being re-imported by every kernel process. The child
+runs a normal IPKernelApp, i.e. it writes the usual connection file and is
+used through BlockingKernelClient exactly like a subprocess kernel.
+
+Run as ``python -m code_interpreter.zygote <socket_path> [<preload profile>]``;
+the server side is ``ZygoteLauncher``.
+"""
+
+import atexit
+import gc
+import importlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from code_interpreter.config import KERNEL_PRELOAD_PROFILE
+from code_interpreter.preload import zygote_modules
+
+
+_READY = b"ready\n"
+
+
+def _reap_children(_sig_num=None, _frame=None):
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def _run_kernel(request: Dict):
+    # Child side of the fork: detach from the zygote and become a kernel.
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.setsid()
+    os.environ.clear()
+    os.environ.update(request.get("env", {}))
+    os.chdir(request["cwd"])
+    # The preloaded objects inherited from the zygote stay frozen (see serve):
+    # unfreezing them would let the child's first full collection touch, and
+    # so copy, all of their pages.
+    argv: List[str] = request["argv"]
+    sys.argv = [sys.executable] + argv
+
+    from ipykernel import kernelapp as app
+
+    app.launch_new_instance(argv=argv)
+
+
+def serve(socket_path: str, profile: str = KERNEL_PRELOAD_PROFILE):
+    for module in zygote_modules(profile):
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f"zygote: failed to preload {module}: {e}", file=sys.stderr)
+    # Keep the preloaded objects out of the collector so that gc passes in the
+    # children don't touch (and un-share) their pages.
+    gc.collect()
+    gc.freeze()
+
+    signal.signal(signal.SIGCHLD, _reap_children)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    server.settimeout(1.0)
+    parent_pid = os.getppid()
+    sys.stdout.buffer.write(_READY)
+    sys.stdout.flush()
+    # Nobody reads the pipe after the handshake; kernels inherit stderr instead.
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    while True:
+        if os.getppid() != parent_pid:
+            # The server went away without stopping us.
+            break
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        with conn:
+            conn.settimeout(None)
+            try:
+                request = json.loads(conn.makefile("rb").readline())
+            except Exception as e:
+                conn.sendall(json.dumps({"error": str(e)}).encode() + b"\n")
+                continue
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                conn.close()
+                try:
+                    _run_kernel(request)
+                finally:
+                    os._exit(0)
+            conn.sendall(json.dumps({"pid": pid}).encode() + b"\n")
+    server.close()
+    os.remove(socket_path)
+
+
+class ZygoteProcess:
+    """Minimal ``subprocess.Popen`` look-alike for a kernel forked by the zygote."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            try:
+                with open(f"/proc/{self.pid}/stat") as fin:
+                    # The zygote reaps its children, but a zombie may linger briefly.
+                    if fin.read().rsplit(")", 1)[-1].split()[0] == "Z":
+                        self.returncode = 0
+            except FileNotFoundError:
+                self.returncode = 0
+            except OSError:
+                try:
+                    os.kill(self.pid, 0)
+                except ProcessLookupError:
+                    self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        deadline = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)  # type: ignore
+            time.sleep(0.01)
+        return self.returncode  # type: ignore
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ZygoteLauncher:
+    """Starts (and restarts) the zygote lazily and asks it to fork kernels."""
+
+    def __init__(
+        self, socket_path: Optional[str] = None, profile: str = KERNEL_PRELOAD_PROFILE
+    ):
+        self.socket_path = socket_path or os.path.join(
+            tempfile.gettempdir(), f"m6_code_interpreter_zygote_{os.getpid()}_{profile}.sock"
+        )
+        self.profile = profile
+        self._process: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def launch(
+        self, argv: List[str], cwd: str, env: Optional[Dict[str, str]] = None
+    ) -> ZygoteProcess:
+        request = {"argv": argv, "cwd": cwd, "env": dict(os.environ if env is None else env)}
+        self._ensure_started()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.socket_path)
+            conn.sendall(json.dumps(request).encode() + b"\n")
+            reply = json.loads(conn.makefile("rb").readline())
+        if "pid" not in reply:
+            raise RuntimeError(f"Zygote failed to fork a kernel: {reply}")
+        return ZygoteProcess(reply["pid"])
+
+    def stop(self):
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self._process.terminate()
+            self._process = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return
+            self._process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "code_interpreter.zygote",
+                    self.socket_path,
+                    self.profile,
+                ],
+                stdout=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            )
+            # The zygote prints a line once the preloading is done and it listens.
+            line = self._process.stdout.readline()  # type: ignore
+            if line != _READY:
+                self._process.kill()
+                self._process = None
+                raise RuntimeError("Zygote process failed to start")
+
+
+_LAUNCHERS: Dict[str, ZygoteLauncher] = {}
+_LAUNCHER_LOCK = threading.Lock()
+
+
+def get_zygote_launcher(profile: str = KERNEL_PRELOAD_PROFILE) -> ZygoteLauncher:
+    """One zygote per preload profile, each preloads only what its kernels use."""
+    with _LAUNCHER_LOCK:
+        if profile not in _LAUNCHERS:
+            _LAUNCHERS[profile] = ZygoteLauncher(profile=profile)
+            atexit.register(_LAUNCHERS[profile].stop)
+        return _LAUNCHERS[profile]
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], *sys.argv[2:3])
@@ -1,4 +1,18 @@
+import os
+
 import uvicorn
 
+# 多个 worker 进程，会话通过共享的注册表找到已有的 kernel
+WORKERS = int(os.getenv("M6_CODE_INTERPRETER_WORKERS", "1"))
+
 if __name__ == "__main__":
-    uvicorn.run("ws_server:app", host="0.0.0.0", port=8000, reload=True)
+    if WORKERS > 1:
+        from code_interpreter.interpreter import get_default_work_dir
+
+        os.environ.setdefault(
+            "M6_CODE_INTERPRETER_SESSION_REGISTRY",
+            "sqlite://" + os.path.join(get_default_work_dir(), "sessions.db"),
+        )
+        uvicorn.run("ws_server:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run("ws_server:app", host="0.0.0.0", port=8000, reload=True)
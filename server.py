@@ -1,51 +1,258 @@
+import asyncio
 import json
-from typing import Dict, List, Optional
+from typing import List, Literal, Optional
 from uuid import uuid4
 
 import uvicorn
 from fastapi import Depends, FastAPI, Header, HTTPException
-from fastapi.responses import JSONResponse
-from fastapi.security import APIKeyHeader
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 
-from code_interpreter.interpreter import CodeInterpreter
+from code_interpreter.async_interpreter import AsyncCodeInterpreter
+from code_interpreter.datasets import DatasetNotFound
+from code_interpreter.fanout import FanOutExecutor
+from code_interpreter.image_store import STATIC_CACHE_CONTROL, resolve_static_file
+from code_interpreter.interpreter import get_default_work_dir
+from code_interpreter.kernel_pool import KernelPool
 from code_interpreter.logger import logging
+from code_interpreter.metrics import (
+    CONTENT_TYPE,
+    PHASE_SECONDS,
+    REGISTRY,
+    InstrumentedThreadPoolExecutor,
+    track_server,
+)
+from code_interpreter.result_cache import ResultCache
+from code_interpreter.routes import API_KEY_HEADER, file_routes, over_quota
+from code_interpreter.scheduler import ExecutionScheduler, SchedulerFull
+from code_interpreter.session_manager import SessionManager
+from code_interpreter.session_registry import create_session_registry
+from code_interpreter.workspace import QuotaExceeded, WorkspaceManager
 
 app = FastAPI()
 
-# 用于存储 API key 到 CodeInterpreter 实例的映射
-interpreters: Dict[str, CodeInterpreter] = {}
-API_KEY_HEADER = APIKeyHeader(name="X-API-Key")
+# 预热的 kernel 池，新 API key 的第一次请求直接从池中取 kernel
+kernel_pool = KernelPool()
+# 多 worker 部署时共享的会话注册表，请求落到其他 worker 时连接已有的 kernel
+registry = create_session_registry()
+# 每个 API key 独立的工作目录，有磁盘配额，后台定期清理过期的文件
+workspaces = WorkspaceManager()
+# 用于存储 API key 到 CodeInterpreter 实例的映射，空闲或超出上限的会话会被回收
+sessions = SessionManager(
+    lambda api_key: AsyncCodeInterpreter(
+        {"work_dir": workspaces.path(api_key)},
+        kernel_pool=kernel_pool,
+        registry=registry,
+        session_key=api_key,
+    ),
+    registry=registry,
+    workspaces=workspaces,
+)
+# 无状态执行(并行 map 与 stateless 请求)使用的 kernel，与会话的 kernel 分开；
+# stateless 请求的结果会被缓存
+fanout = FanOutExecutor(kernel_pool, result_cache=ResultCache())
+# 执行请求的准入控制：并发数有上限，按 API key 轮流排队，排满后返回 429
+scheduler = ExecutionScheduler()
+# 上传、共享数据集与工作目录的接口，与 WebSocket 服务相同
+app.include_router(file_routes(sessions, workspaces))
 
 
 class CodeRequest(BaseModel):
     code: str
     files: List[str] = []
-    timeout: Optional[int] = 30
+    timeout: Optional[float] = 30
+    # 不使用会话的状态，在干净的 kernel 上执行，结果按代码与输入文件缓存
+    stateless: bool = False
+    bypass_cache: bool = False
+    # 挂载到工作目录 datasets/ 下的共享数据集
+    datasets: List[str] = []
+    # structured：按顺序返回各个输出(类型、MIME、内容)，不拼接成 markdown
+    output_format: Literal["markdown", "structured"] = "markdown"
 
 
-def get_interpreter(api_key: str = Depends(API_KEY_HEADER)) -> CodeInterpreter:
-    if api_key not in interpreters:
-        interpreters[api_key] = CodeInterpreter()
-    return interpreters[api_key]
+class BatchRequest(BaseModel):
+    cells: List[str]
+    files: List[str] = []
+    timeout: Optional[float] = 30  # 每个 cell 单独计时
+    stop_on_error: bool = True
+    datasets: List[str] = []
+    output_format: Literal["markdown", "structured"] = "markdown"
+
+
+class MapRequest(BaseModel):
+    snippets: List[str]
+    setup: Optional[str] = None  # 每个 snippet 之前在同一个 kernel 上执行
+    files: List[str] = []
+    timeout: Optional[float] = 30
+
+
+def get_interpreter(api_key: str = Depends(API_KEY_HEADER)) -> AsyncCodeInterpreter:
+    return sessions.get(api_key)
+
+
+def too_busy(e: SchedulerFull) -> HTTPException:
+    return HTTPException(
+        status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    # 默认线程池也换成能统计占用情况的版本
+    asyncio.get_running_loop().set_default_executor(InstrumentedThreadPoolExecutor("default"))
+    track_server(kernel_pool, sessions, fanout, scheduler)
+    kernel_pool.start()
+    await sessions.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await sessions.stop()
+    await fanout.stop()
+    kernel_pool.stop()
+
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
+@app.get("/pool")
+def pool_stats():
+    return kernel_pool.stats()
+
+
+@app.get("/sessions")
+def session_stats():
+    return sessions.stats()
+
+
+@app.get("/fanout")
+def fanout_stats():
+    return fanout.stats()
+
+
+@app.get("/scheduler")
+def scheduler_stats():
+    return scheduler.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.generate_latest(), media_type=CONTENT_TYPE)
+
+
+@app.get("/static/{path:path}")
+def static_file(path: str):
+    # 代码生成的图片，把 M6_CODE_INTERPRETER_STATIC_URL 设为 http://<host>:<port>/static 即可
+    local_file = resolve_static_file(get_default_work_dir(), path)
+    if local_file is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(local_file, headers={"Cache-Control": STATIC_CACHE_CONTROL})
+
+
+@app.post("/release")
+async def release(api_key: str = Depends(API_KEY_HEADER)):
+    await sessions.remove(api_key)
+    return {"result": "Interpreter released", "status": "success"}
+
+
 @app.post("/execute")
-def execute_code(request: CodeRequest, interpreter: CodeInterpreter = Depends(get_interpreter)):
+async def execute_code(request: CodeRequest, api_key: str = Depends(API_KEY_HEADER)):
     logging.info(f"Request data: {request}")
+    if request.stateless and request.datasets:
+        # 结果缓存的键里没有数据集，无状态执行不支持挂载
+        raise HTTPException(
+            status_code=400, detail="Datasets are not supported in stateless executions"
+        )
+    if request.stateless and request.output_format != "markdown":
+        # 缓存的是 markdown 结果
+        raise HTTPException(
+            status_code=400,
+            detail="Structured output is not supported in stateless executions",
+        )
+
+    try:
+        if not request.stateless:
+            workspaces.check(api_key)
+        async with scheduler.slot(api_key) as timing:
+            if request.stateless:
+                outcome = await fanout.execute(
+                    request.code,
+                    files=request.files,
+                    timeout=request.timeout,
+                    bypass_cache=request.bypass_cache,
+                )
+            else:
+                outcome = await get_interpreter(api_key).execute(
+                    params=json.dumps({"code": request.code}),
+                    files=request.files,
+                    timeout=request.timeout,
+                    datasets=request.datasets,
+                    output_format=request.output_format,
+                )
+        # 排队等待与执行的耗时分开返回
+        outcome.update(timing)
+        with PHASE_SECONDS.time("serialization"):
+            response = JSONResponse(content=outcome)
+        return response
+    except SchedulerFull as e:
+        raise too_busy(e)
+    except QuotaExceeded as e:
+        raise over_quota(e)
+    except DatasetNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
+@app.post("/execute_batch")
+async def execute_batch(request: BatchRequest, api_key: str = Depends(API_KEY_HEADER)):
+    logging.info(f"Batch request data: {request}")
 
     try:
-        result = interpreter.call(
-            params=json.dumps({"code": request.code}),
-            files=request.files,
-            timeout=request.timeout,
-        )
-        return JSONResponse(content={"result": result})
+        workspaces.check(api_key)
+        async with scheduler.slot(api_key) as timing:
+            results = await get_interpreter(api_key).execute_batch(
+                cells=request.cells,
+                files=request.files,
+                timeout=request.timeout,
+                stop_on_error=request.stop_on_error,
+                datasets=request.datasets,
+                output_format=request.output_format,
+            )
+        status = "success" if all(r["status"] == "success" for r in results) else "error"
+        with PHASE_SECONDS.time("serialization"):
+            response = JSONResponse(content={"status": status, "results": results, **timing})
+        return response
+    except SchedulerFull as e:
+        raise too_busy(e)
+    except QuotaExceeded as e:
+        raise over_quota(e)
+    except DatasetNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/map")
+async def map_code(request: MapRequest, api_key: str = Depends(API_KEY_HEADER)):
+    logging.info(f"Map request data: {request}")
+
+    try:
+        async with scheduler.slot(api_key) as timing:
+            results = await fanout.map(
+                snippets=request.snippets,
+                setup=request.setup,
+                files=request.files,
+                timeout=request.timeout,
+            )
+        status = "success" if all(r["status"] == "success" for r in results) else "error"
+        with PHASE_SECONDS.time("serialization"):
+            response = JSONResponse(content={"status": status, "results": results, **timing})
+        return response
+    except SchedulerFull as e:
+        raise too_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+# 配置在导入时读取，测试用的目录要在导入 code_interpreter 之前设置好
+_ROOT = tempfile.mkdtemp(prefix="m6_ci_test_")
+for name, sub in (
+    ("M6_CODE_INTERPRETER_WORK_DIR", "work"),
+    ("M6_CODE_INTERPRETER_DOWNLOAD_CACHE_DIR", "download_cache"),
+    ("M6_CODE_INTERPRETER_RESULT_CACHE_DIR", "result_cache"),
+    ("M6_CODE_INTERPRETER_DATASET_DIR", "datasets"),
+):
+    os.environ.setdefault(name, os.path.join(_ROOT, sub))
+os.environ.setdefault("M6_CODE_INTERPRETER_PRELOAD_PROFILE", "minimal")
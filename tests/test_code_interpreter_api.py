@@ -1,25 +1,119 @@
-import json
+import os
+import time
+import uuid
 from typing import List, Optional
 
 import requests
 
 
 class CodeInterpreterClient:
-    def __init__(self, base_url: str, api_key: str):
+    def __init__(self, base_url: str, api_key: str, max_retries: int = 5):
         self.base_url = base_url
         self.api_key = api_key
         self.headers = {"X-API-Key": self.api_key, "Content-Type": "application/json"}
+        self.max_retries = max_retries
+
+    def _post(self, path: str, payload: dict):
+        # 服务端排队已满时返回 429，按 Retry-After 等待后重试
+        for _ in range(self.max_retries):
+            response = requests.post(f"{self.base_url}{path}", headers=self.headers, json=payload)
+            if response.status_code != 429:
+                break
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        return response.json()
 
     def execute_code(
-        self, code: str, files: List[str] = [], timeout: Optional[int] = 30
+        self,
+        code: str,
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+        stateless: bool = False,
+        datasets: List[str] = [],
     ):
-        url = f"{self.base_url}/execute"
         payload = {"code": code, "files": files, "timeout": timeout}
+        if stateless:
+            payload["stateless"] = True
+        if datasets:
+            payload["datasets"] = datasets
 
-        response = requests.post(url, headers=self.headers, json=payload)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        return self._post("/execute", payload)["result"]
+
+    def execute_structured(self, code: str, files: List[str] = [], timeout: Optional[int] = 30):
+        """Like execute_code, but return the outputs as a list (kind, mime, text or url)
+        together with status, ename/evalue and execution_count."""
+        payload = {"code": code, "files": files, "timeout": timeout, "output_format": "structured"}
+        return self._post("/execute", payload)
+
+    def execute_batch(
+        self,
+        cells: List[str],
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+        stop_on_error: bool = True,
+    ):
+        payload = {
+            "cells": cells,
+            "files": files,
+            "timeout": timeout,
+            "stop_on_error": stop_on_error,
+        }
+
+        return self._post("/execute_batch", payload)["results"]
+
+    def upload_files(self, paths: List[str]):
+        """Upload local files into the working directory of the session."""
+        return self._upload("POST", "/upload", paths)["files"]
+
+    def register_dataset(self, name: str, paths: List[str]):
+        """Register (or replace) a read-only dataset shared by every session.
+
+        Needs an API key listed in M6_CODE_INTERPRETER_DATASET_ADMIN_KEYS.
+        """
+        return self._upload("PUT", f"/datasets/{name}", paths)
 
-        return response.json()["result"]
+    def workspace(self):
+        """Disk usage and quota of the session's working directory."""
+        response = requests.get(f"{self.base_url}/workspace", headers=self.headers)
+        response.raise_for_status()
+        return response.json()
+
+    def _upload(self, method: str, path: str, paths: List[str]):
+        # 以生成器作为请求体，大文件边读边发，不整个读进内存
+        boundary = uuid.uuid4().hex
+
+        def body():
+            for file_path in paths:
+                name = os.path.basename(file_path)
+                yield (
+                    f"--{boundary}\r\n"
+                    f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                    "Content-Type: application/octet-stream\r\n\r\n"
+                ).encode()
+                with open(file_path, "rb") as fin:
+                    for chunk in iter(lambda: fin.read(2**20), b""):
+                        yield chunk
+                yield b"\r\n"
+            yield f"--{boundary}--\r\n".encode()
+
+        headers = {
+            "X-API-Key": self.api_key,
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+        }
+        response = requests.request(method, f"{self.base_url}{path}", headers=headers, data=body())
+        response.raise_for_status()
+        return response.json()
+
+    def map(
+        self,
+        snippets: List[str],
+        setup: Optional[str] = None,
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+    ):
+        payload = {"snippets": snippets, "setup": setup, "files": files, "timeout": timeout}
+
+        return self._post("/map", payload)["results"]
 
 
 # Example usage
@@ -33,5 +127,16 @@ if __name__ == "__main__":
         for i in range(5):
             result = client.execute_code(f"print('Iteration {i}')\n{i} * 2")
             print(f"Result of iteration {i}:", result)
+
+        results = client.execute_batch(["import math", "x = math.sqrt(2)", "x * 2"])
+        for i, r in enumerate(results):
+            print(f"Batch cell {i} ({r['status']}):", r["result"])
+
+        for _ in range(2):  # 第二次直接命中结果缓存
+            print("Stateless:", client.execute_code("sum(range(10**6))", stateless=True))
+
+        results = client.map([f"n ** {i}" for i in range(4)], setup="n = 3")
+        for i, r in enumerate(results):
+            print(f"Map task {i} ({r['status']}, {r['duration']:.3f}s):", r["result"])
     except requests.exceptions.RequestException as e:
         print("An error occurred:", e)
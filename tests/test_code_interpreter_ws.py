@@ -32,12 +32,22 @@ class CodeInterpreterClient:
         raise ConnectionError("Failed to connect after maximum retries")
 
     async def execute_code(
-        self, code: str, files: List[str] = [], timeout: Optional[int] = 30
+        self,
+        code: str,
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+        stateless: bool = False,
+        datasets: List[str] = [],
     ):
         if not self.websocket:
             await self.connect()
 
         request = {"type": "execute", "code": code, "files": files, "timeout": timeout}
+        if stateless:
+            request["stateless"] = True
+        if datasets:
+            # 先通过 HTTP 服务的 PUT /datasets/<name> 注册
+            request["datasets"] = datasets
 
         try:
             await self.websocket.send(json.dumps(request))
@@ -48,7 +58,94 @@ class CodeInterpreterClient:
                 "WebSocket connection closed. Attempting to reconnect..."
             )
             await self.connect()
-            return await self.execute_code(code, files, timeout)  # Retry the request
+            return await self.execute_code(code, files, timeout, stateless, datasets)  # Retry the request
+
+    async def execute_structured(
+        self, code: str, files: List[str] = [], timeout: Optional[int] = 30, binary: bool = False
+    ):
+        """Return the outputs as a list (kind, mime, text or image) with status,
+        ename/evalue and execution_count. ``binary`` uses msgpack frames, in
+        which images are raw bytes."""
+        if not self.websocket:
+            await self.connect()
+
+        request = {
+            "type": "execute",
+            "code": code,
+            "files": files,
+            "timeout": timeout,
+            "output_format": "structured",
+        }
+        if binary:
+            import msgpack
+
+            await self.websocket.send(msgpack.packb(request))
+            return msgpack.unpackb(await self.websocket.recv())
+        await self.websocket.send(json.dumps(request))
+        return json.loads(await self.websocket.recv())
+
+    async def execute_code_stream(
+        self, code: str, files: List[str] = [], timeout: Optional[int] = 30
+    ):
+        """Yield output frames as the server sends them, until the "done" frame."""
+        if not self.websocket:
+            await self.connect()
+
+        request = {
+            "type": "execute",
+            "code": code,
+            "files": files,
+            "timeout": timeout,
+            "stream": True,
+        }
+        await self.websocket.send(json.dumps(request))
+        while True:
+            frame = json.loads(await self.websocket.recv())
+            yield frame
+            if frame.get("type") == "done":
+                break
+
+    async def execute_batch(
+        self,
+        cells: List[str],
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+        stop_on_error: bool = True,
+    ):
+        """Run several cells in one request; returns one result per cell."""
+        if not self.websocket:
+            await self.connect()
+
+        request = {
+            "type": "execute_batch",
+            "cells": cells,
+            "files": files,
+            "timeout": timeout,
+            "stop_on_error": stop_on_error,
+        }
+        await self.websocket.send(json.dumps(request))
+        return json.loads(await self.websocket.recv())["results"]
+
+    async def map(
+        self,
+        snippets: List[str],
+        setup: Optional[str] = None,
+        files: List[str] = [],
+        timeout: Optional[int] = 30,
+    ):
+        """Run independent snippets in parallel, each on a clean kernel."""
+        if not self.websocket:
+            await self.connect()
+
+        request = {
+            "type": "map",
+            "snippets": snippets,
+            "setup": setup,
+            "files": files,
+            "timeout": timeout,
+        }
+        await self.websocket.send(json.dumps(request))
+        return json.loads(await self.websocket.recv())["results"]
 
     # async def close(self):
     #     if self.websocket:
@@ -95,6 +192,28 @@ async def main():
         for i in range(5):
             result = await client.execute_code(f"print('Iteration {i}')\n{i} * 2")
             print(f"Result of iteration {i}:", result)
+
+        response = await client.execute_structured("print('hi')\n1 / 0")
+        print("Structured:", response["status"], response["ename"], response["outputs"])
+
+        async for frame in client.execute_code_stream(
+            "import time\nfor i in range(3):\n    print(i)\n    time.sleep(0.5)"
+        ):
+            print("Stream frame:", frame)
+
+        results = await client.execute_batch(
+            ["import math", "x = math.sqrt(2)", "print(x)", "x * 2"]
+        )
+        for i, r in enumerate(results):
+            print(f"Batch cell {i} ({r['status']}):", r["result"])
+
+        for _ in range(2):  # 第二次直接命中结果缓存
+            result = await client.execute_code("sum(range(10**6))", stateless=True)
+            print("Stateless:", result)
+
+        results = await client.map([f"n ** {i}" for i in range(4)], setup="n = 3")
+        for i, r in enumerate(results):
+            print(f"Map task {i} ({r['status']}, {r['duration']:.3f}s):", r["result"])
     except Exception as e:
         print(f"An error occurred: {str(e)}")
     finally:
@@ -0,0 +1,126 @@
+import asyncio
+import queue
+
+import pytest
+
+from code_interpreter.dispatcher import IopubDispatcher
+
+
+class FakeKernelClient:
+    """Records execute requests; the test plays the kernel by calling ``emit``."""
+
+    def __init__(self):
+        self.sent = []
+        self._iopub: asyncio.Queue = asyncio.Queue()
+
+    def execute(self, code: str, **kwargs) -> str:
+        self.sent.append(code)
+        return f"msg-{len(self.sent)}"
+
+    async def get_iopub_msg(self):
+        msg = await self._iopub.get()
+        if isinstance(msg, Exception):
+            raise msg
+        return msg
+
+    def emit(self, msg_id: str, msg_type: str, **content):
+        self._iopub.put_nowait(
+            {"parent_header": {"msg_id": msg_id}, "msg_type": msg_type, "content": content}
+        )
+
+    def idle(self, msg_id: str):
+        self.emit(msg_id, "status", execution_state="idle")
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_routes_messages_and_starts_in_order():
+    async def main():
+        kc = FakeKernelClient()
+        dispatcher = IopubDispatcher(kc)
+        first, second = dispatcher.execute("1"), dispatcher.execute("2")
+        assert dispatcher.in_flight == 2
+        # kernel_info 之类没人等的消息直接丢弃
+        kc.emit("other", "status", execution_state="busy")
+        kc.emit(second, "stream", name="stdout", text="two")
+        kc.emit(first, "stream", name="stdout", text="one")
+        await settle()
+        second_started = asyncio.ensure_future(dispatcher.started(second))
+        await dispatcher.started(first)
+        await settle()
+        assert not second_started.done()
+
+        assert (await dispatcher.get(first))["content"]["text"] == "one"
+        assert (await dispatcher.get(second))["content"]["text"] == "two"
+        with pytest.raises(queue.Empty):
+            await dispatcher.get(first, timeout=0.01)
+
+        kc.idle(first)
+        await dispatcher.finished(first)
+        await asyncio.wait_for(second_started, 1)
+        drained = asyncio.ensure_future(dispatcher.drained())
+        await settle()
+        assert not drained.done()
+        kc.idle(second)
+        await asyncio.wait_for(drained, 1)
+        dispatcher.discard(first)
+        dispatcher.discard(second)
+        assert dispatcher.in_flight == 0
+        dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_discarded_request_still_blocks_the_next():
+    async def main():
+        kc = FakeKernelClient()
+        dispatcher = IopubDispatcher(kc)
+        first, second = dispatcher.execute("1"), dispatcher.execute("2")
+        dispatcher.discard(first)
+        kc.emit(first, "stream", name="stdout", text="late")
+        await settle()
+        second_started = asyncio.ensure_future(dispatcher.started(second))
+        await settle()
+        assert not second_started.done()
+        kc.idle(first)
+        await asyncio.wait_for(second_started, 1)
+        dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_close_wakes_everyone():
+    async def main():
+        kc = FakeKernelClient()
+        dispatcher = IopubDispatcher(kc)
+        first, second = dispatcher.execute("1"), dispatcher.execute("2")
+        waiters = [
+            asyncio.ensure_future(dispatcher.get(second)),
+            asyncio.ensure_future(dispatcher.started(second)),
+            asyncio.ensure_future(dispatcher.finished(first)),
+            asyncio.ensure_future(dispatcher.drained()),
+        ]
+        await settle()
+        dispatcher.close()
+        results = await asyncio.wait_for(asyncio.gather(*waiters), 1)
+        assert results[0] is None
+        assert await dispatcher.get(first) is None
+        with pytest.raises(RuntimeError):
+            dispatcher.execute("3")
+
+    asyncio.run(main())
+
+
+def test_broken_channel_aborts():
+    async def main():
+        kc = FakeKernelClient()
+        dispatcher = IopubDispatcher(kc)
+        msg_id = dispatcher.execute("1")
+        kc._iopub.put_nowait(ValueError("channel closed"))
+        assert await asyncio.wait_for(dispatcher.get(msg_id), 1) is None
+        assert dispatcher.closed
+
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from code_interpreter.download_cache import DownloadCache
+
+
+class FileServer:
+    """Serves ``files`` (path -> body, ETag, Last-Modified) and answers conditional requests."""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, etag, last_modified = server.files[self.path]
+                server.requests.append((self.path, dict(self.headers)))
+                if (etag and self.headers.get("If-None-Match") == etag) or (
+                    last_modified and self.headers.get("If-Modified-Since") == last_modified
+                ):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                if last_modified:
+                    self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as fin:
+        return fin.read()
+
+
+@pytest.mark.parametrize("validator", ["etag", "last_modified"])
+def test_revalidates_with_conditional_requests(tmp_path, server, validator):
+    etag, last_modified = ('"v1"', None) if validator == "etag" else (None, "Mon, 01 Jan 2024")
+    server.files["/x.txt"] = (b"AAA", etag, last_modified)
+    cache = DownloadCache(str(tmp_path / "cache"), max_size_mb=0)
+    first = cache.place(f"{server.url}/x.txt", str(tmp_path))
+    second = cache.place(f"{server.url}/x.txt", str(tmp_path))
+    assert first == second and read(first[0]) == b"AAA"
+    headers = server.requests[1][1]
+    assert headers.get("If-None-Match") == etag
+    assert headers.get("If-Modified-Since") == last_modified
+    assert (cache.hits, cache.misses, cache.revalidations) == (1, 1, 1)
+
+    # 内容变了，服务端返回新版本
+    server.files["/x.txt"] = (b"BBB", '"v2"', "Tue, 02 Jan 2024")
+    path, digest = cache.place(f"{server.url}/x.txt", str(tmp_path))
+    assert read(path) == b"BBB" and digest != first[1]
+    assert cache.misses == 2
+
+
+def test_index_survives_restart(tmp_path, server):
+    server.files["/x.txt"] = (b"AAA", '"v1"', None)
+    DownloadCache(str(tmp_path / "cache")).fetch(f"{server.url}/x.txt")
+    cache = DownloadCache(str(tmp_path / "cache"))
+    assert read(cache.fetch(f"{server.url}/x.txt")) == b"AAA"
+    assert cache.revalidations == 1
+
+
+def test_placed_copy_is_private(tmp_path, server):
+    server.files["/x.txt"] = (b"AAA", '"v1"', None)
+    cache = DownloadCache(str(tmp_path / "cache"))
+    path, _ = cache.place(f"{server.url}/x.txt", str(tmp_path))
+    with open(path, "wb") as fout:
+        fout.write(b"changed by the kernel")
+    path, _ = cache.place(f"{server.url}/x.txt", str(tmp_path))
+    assert read(path) == b"AAA"
+
+
+def test_evicts_least_recently_used(tmp_path, server):
+    for name in "abc":
+        server.files[f"/{name}"] = (name.encode() * 400 * 1024, f'"{name}"', None)
+    cache = DownloadCache(str(tmp_path / "cache"), max_size_mb=1)
+    blobs = {name: cache.fetch(f"{server.url}/{name}") for name in "ab"}
+    cache.fetch(f"{server.url}/a")
+    blobs["c"] = cache.fetch(f"{server.url}/c")
+    # b 最久未用，淘汰之后总大小回到上限以内
+    assert not os.path.exists(blobs["b"])
+    assert os.path.exists(blobs["a"]) and os.path.exists(blobs["c"])
+    assert cache.stats()["size_mb"] <= 1
+    misses = cache.misses
+    cache.fetch(f"{server.url}/b")
+    assert cache.misses == misses + 1
+
+
+def test_pinned_blobs_are_not_evicted(tmp_path, server):
+    for name in "abc":
+        server.files[f"/{name}"] = (name.encode() * 600 * 1024, f'"{name}"', None)
+    cache = DownloadCache(str(tmp_path / "cache"), max_size_mb=1)
+    # 相当于正在放入工作目录的文件
+    pinned = cache._fetch(f"{server.url}/a")
+    assert cache.stats()["pinned"] == 1
+    cache.fetch(f"{server.url}/b")
+    assert os.path.exists(pinned)
+    cache._unpin(os.path.basename(pinned))
+    cache.fetch(f"{server.url}/c")
+    assert not os.path.exists(pinned)
+    assert cache.stats()["pinned"] == 0
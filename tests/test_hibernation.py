@@ -0,0 +1,38 @@
+import asyncio
+
+from code_interpreter.async_interpreter import AsyncCodeInterpreter
+from code_interpreter.session_manager import SessionManager
+
+
+def test_namespace_survives_hibernation(tmp_path):
+    async def main():
+        manager = SessionManager(
+            lambda api_key: AsyncCodeInterpreter({"work_dir": str(tmp_path / "work")}),
+            hibernate=True,
+            hibernate_dir=str(tmp_path / "hibernate"),
+        )
+        try:
+            saved = await manager.get("a").execute(
+                "import threading\n"
+                "x = 41\n"
+                "def f():\n"
+                "    return x + 1\n"
+                "lock = threading.Lock()\n"
+            )
+            assert saved["status"] == "success"
+            await manager.hibernate("a")
+            assert manager.stats()["hibernated"] == 1
+            assert manager.stats()["live_kernels"] == 0
+            restored = await manager.get("a").execute("print(f())")
+            second = await manager.get("a").execute("print(x)")
+        finally:
+            await manager.stop()
+        return restored, second
+
+    restored, second = asyncio.run(main())
+    assert "42" in restored["result"]
+    # 锁不能序列化，报告里说明没有恢复
+    assert restored["restore"]["restored"] == ["f", "x"]
+    assert "lock" in restored["restore"]["skipped"]
+    # 报告只随恢复后的第一次执行返回
+    assert "41" in second["result"] and "restore" not in second
@@ -0,0 +1,69 @@
+import base64
+import os
+import shutil
+import time
+
+from code_interpreter.image_store import ImageStore, expire_images, resolve_static_file
+
+IMAGE = base64.b64encode(b"\x89PNG" + b"x" * 100).decode()
+OTHER = base64.b64encode(b"\x89PNG" + b"y" * 100).decode()
+
+
+def save(store: ImageStore, image: str = IMAGE) -> str:
+    url, future = store.save(image)
+    if future is not None:
+        future.result()
+    return url
+
+
+def test_small_images_are_inlined(tmp_path):
+    store = ImageStore(str(tmp_path / "images"), inline_max_bytes=1024)
+    url, future = store.save(IMAGE)
+    assert url.startswith("data:image/png;base64,") and future is None
+    assert not os.path.exists(tmp_path / "images")
+
+
+def test_same_image_is_stored_once(tmp_path):
+    store = ImageStore(str(tmp_path / "images"), static_url="/static", inline_max_bytes=0)
+    url = save(store)
+    assert url.startswith("/static/images/") and url.endswith(".png")
+    again, future = store.save(IMAGE)
+    assert again == url and future is None
+    assert save(store, OTHER) != url
+    assert len(os.listdir(tmp_path / "images")) == 2
+
+
+def test_reused_image_is_not_expired(tmp_path):
+    store = ImageStore(str(tmp_path / "images"), inline_max_bytes=0)
+    path = save(store)
+    time.sleep(0.3)
+    assert save(store) == path
+    # 刚刚再次返回的图片按新的计算，不会被清理
+    assert expire_images(str(tmp_path), max_age=0.2) == 0
+    assert os.path.exists(path)
+
+
+def test_deleted_image_is_written_again(tmp_path):
+    store = ImageStore(str(tmp_path / "images"), inline_max_bytes=0)
+    path = save(store)
+    shutil.rmtree(tmp_path / "images")
+    assert save(store) == path
+    assert os.path.exists(path)
+
+
+def test_resolve_static_file(tmp_path):
+    root = tmp_path / "work"
+    (root / "images").mkdir(parents=True)
+    (root / "images" / "a.png").write_bytes(b"png")
+    (root / "notes.txt").write_text("text")
+    (tmp_path / "secret.png").write_bytes(b"png")
+    os.symlink(tmp_path / "secret.png", root / "images" / "link.png")
+    assert resolve_static_file(str(root), "images/a.png") == str(root / "images" / "a.png")
+    assert resolve_static_file(str(root), "images/missing.png") is None
+    # 不允许离开 static_root，也只提供图片
+    assert resolve_static_file(str(root), "../secret.png") is None
+    assert resolve_static_file(str(root), "images/../../secret.png") is None
+    assert resolve_static_file(str(root), "images/link.png") is None
+    assert resolve_static_file(str(root), str(tmp_path / "secret.png")) is None
+    assert resolve_static_file(str(root), "notes.txt") is None
+    assert resolve_static_file(str(root), "images") is None
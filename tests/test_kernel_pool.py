@@ -0,0 +1,88 @@
+import time
+
+from code_interpreter.kernel_pool import KernelPool
+
+
+class FakeProcess:
+    def __init__(self):
+        self.terminated = False
+
+    def poll(self):
+        return 1 if self.terminated else None
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeClient:
+    connection_file = "/nonexistent/kernel.json"
+
+    def shutdown(self):
+        pass
+
+    def cleanup_ipc_files(self):
+        pass
+
+
+def make_pool(min_size: int, max_size: int, fail: int = 0) -> KernelPool:
+    pool = KernelPool(work_dir="/tmp", min_size=min_size, max_size=max_size, refill_rate=0)
+    calls = []
+
+    def create_kernel(pool_id: str):
+        calls.append(time.time())
+        if len(calls) <= fail:
+            raise RuntimeError("kernel did not start")
+        return FakeClient(), FakeProcess()
+
+    pool._launcher._create_kernel = create_kernel
+    pool.create_calls = calls
+    return pool
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_target_follows_demand_within_bounds():
+    pool = make_pool(min_size=1, max_size=3)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        kernels = [pool.acquire() for _ in range(5)]
+        # 一次命中，之后的未命中把预热数加到上限为止
+        assert kernels[0] is not None
+        assert pool.stats()["target"] == 3
+        wait_for(lambda: pool.stats()["idle"] == 3)
+        time.sleep(0.05)
+        assert pool.stats()["idle"] + pool.stats()["starting"] == 3
+        # 命中且仍有空闲时逐个回落到 min_size
+        for _ in range(3):
+            assert pool.acquire() is not None
+        assert pool.stats()["target"] == 1
+    finally:
+        pool.stop()
+
+
+def test_backs_off_after_failures():
+    pool = make_pool(min_size=1, max_size=1, fail=2)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        calls = pool.create_calls
+        assert pool.stats()["refill_failures"] == 2
+        # 第一次失败后等 1 秒，第二次失败后等 2 秒
+        assert calls[1] - calls[0] >= 0.9 and calls[2] - calls[1] >= 1.9
+    finally:
+        pool.stop()
+
+
+def test_stop_interrupts_backoff():
+    pool = make_pool(min_size=1, max_size=1, fail=100)
+    pool.start()
+    wait_for(lambda: pool.stats()["refill_failures"] >= 2)
+    pool.stop()
+    pool._thread.join(1)
+    assert not pool._thread.is_alive()
@@ -0,0 +1,116 @@
+from code_interpreter.output_buffer import OutputBuffer, OutputList
+
+
+def fill(buffer: OutputBuffer):
+    buffer.add("stdout", "a" * 80)
+    buffer.add_image("/static/fig.png")
+    buffer.add("stdout", "b" * 40)
+    buffer.add("stderr", "c" * 80)
+    return buffer
+
+
+def test_merges_consecutive_streams():
+    buffer = OutputBuffer(max_chars=0)
+    buffer.add("stdout", "1\n")
+    buffer.add("stdout", "2\n")
+    buffer.add("stderr", "warn")
+    assert buffer.getvalue() == "stdout:\n\n```\n1\n2\n\n```\n\nstderr:\n\n```\nwarn\n```"
+
+
+def test_keeps_head_and_tail():
+    full = fill(OutputBuffer(max_chars=0)).getvalue()
+    value = fill(OutputBuffer(max_chars=100)).getvalue()
+    total = 80 + len("![fig-001](/static/fig.png)") + 40 + 80
+    # 开头和结尾各保留 max_chars / 2 个字符
+    assert value.startswith("stdout:\n\n```\n" + "a" * 50 + "\n```")
+    assert value.endswith("stderr:\n\n```\n" + "c" * 50 + "\n```")
+    assert f"[{total - 100} characters of output omitted]" in value
+    assert "b" not in value and "fig-001" not in value
+    assert len(value) < len(full)
+
+
+def test_keeps_images_whole():
+    buffer = OutputBuffer(max_chars=40)
+    buffer.add("stdout", "a" * 10)
+    buffer.add_image("/static/fig.png")
+    buffer.add("stdout", "b" * 100)
+    value = buffer.getvalue()
+    assert "![fig-001](/static/fig.png)" in value
+    assert value.endswith("b" * 20 + "\n```")
+
+
+def test_spills_complete_output(tmp_path):
+    buffer = fill(OutputBuffer(max_chars=100, spill_dir=str(tmp_path)))
+    value = buffer.getvalue()
+    assert buffer.spill_path is not None
+    assert f"the complete output is in {buffer.spill_path}]" in value
+    with open(buffer.spill_path) as f:
+        assert f.read() == fill(OutputBuffer(max_chars=0)).getvalue()
+
+
+def stream(text: str, name: str = "stdout"):
+    return {"kind": "stream", "name": name, "mime": "text/plain", "text": text}
+
+
+def fill_list(outputs: OutputList):
+    outputs.add({"kind": "execute_input", "execution_count": 3})
+    outputs.add(stream("a" * 80))
+    outputs.add({"kind": "display_data", "mime": "image/png", "url": "/static/fig.png"})
+    outputs.add(stream("b" * 40))
+    outputs.add(stream("c" * 80, "stderr"))
+    outputs.add(
+        {"kind": "error", "mime": "text/plain", "ename": "ValueError", "evalue": "x", "text": "tb"}
+    )
+    return outputs
+
+
+def test_output_list_merges_consecutive_streams():
+    outputs = OutputList(max_chars=0)
+    outputs.add(stream("1\n"))
+    outputs.add(stream(""))
+    outputs.add(stream("2\n"))
+    outputs.add(stream("warn", "stderr"))
+    outputs.add({"kind": "execute_result", "execution_count": 1, "mime": "text/plain", "text": "2"})
+    outputs.add(stream("3\n"))
+    result = outputs.result()
+    assert [o.get("name", o["kind"]) for o in result["outputs"]] == [
+        "stdout",
+        "stderr",
+        "execute_result",
+        "stdout",
+    ]
+    assert result["outputs"][0] == stream("1\n2\n")
+    assert "omitted_chars" not in result and result["ename"] is None
+
+
+def test_output_list_keeps_head_and_tail(tmp_path):
+    outputs = fill_list(OutputList(max_chars=100, spill_dir=str(tmp_path)))
+    result = outputs.result()
+    # 与 OutputBuffer 一样保留开头和结尾各 max_chars / 2 个字符，图片与报错总是保留
+    assert result["outputs"] == [
+        stream("a" * 50),
+        {"kind": "display_data", "mime": "image/png", "url": "/static/fig.png"},
+        stream("c" * 50, "stderr"),
+        {"kind": "error", "mime": "text/plain", "ename": "ValueError", "evalue": "x", "text": "tb"},
+    ]
+    assert result["omitted_chars"] == 200 - 100
+    assert (result["execution_count"], result["ename"], result["evalue"]) == (3, "ValueError", "x")
+    # 完整输出与 markdown 格式相同
+    assert result["output_path"] == outputs.spill_path
+    buffer = OutputBuffer(max_chars=0)
+    buffer.add("stdout", "a" * 80)
+    buffer.add_image("/static/fig.png")
+    buffer.add("stdout", "b" * 40)
+    buffer.add("stderr", "c" * 80)
+    buffer.add("error", "tb")
+    with open(outputs.spill_path) as f:
+        assert f.read() == buffer.getvalue()
+
+
+def test_output_list_without_spill_dir():
+    outputs = OutputList(max_chars=10)
+    outputs.add(stream("hello "))
+    outputs.add(stream("world!"))
+    result = outputs.result()
+    assert result["outputs"] == [stream("hello"), stream("orld!")]
+    assert result["omitted_chars"] == 2 and "output_path" not in result
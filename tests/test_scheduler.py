@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from code_interpreter.scheduler import ExecutionScheduler, SchedulerFull
+
+
+async def run_in_order(scheduler: ExecutionScheduler, requests):
+    """Queue ``requests`` (API keys) behind a running request; the order they get a slot."""
+    order = []
+    release = asyncio.Event()
+
+    async def request(key: str, hold: bool = False):
+        async with scheduler.slot(key):
+            order.append(key)
+            if hold:
+                await release.wait()
+
+    first = asyncio.ensure_future(request(requests[0], hold=True))
+    await asyncio.sleep(0)
+    others = []
+    for key in requests[1:]:
+        others.append(asyncio.ensure_future(request(key)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(first, *others)
+    return order
+
+
+def test_keys_take_turns():
+    scheduler = ExecutionScheduler(max_concurrency=1, max_queue=10, max_queue_per_key=10)
+    order = asyncio.run(run_in_order(scheduler, ["a", "a", "a", "a", "b", "c"]))
+    # 排在后面的 b、c 不必等 a 的请求全部执行完
+    assert order == ["a", "b", "c", "a", "a", "a"]
+    assert scheduler.stats()["admitted"] == 6
+    assert scheduler.running == 0 and scheduler.stats()["queued"] == 0
+
+
+def test_rejects_when_full():
+    async def main():
+        scheduler = ExecutionScheduler(max_concurrency=1, max_queue=2, max_queue_per_key=1)
+        release = asyncio.Event()
+
+        async def request(key: str):
+            async with scheduler.slot(key):
+                await release.wait()
+
+        running = [asyncio.ensure_future(request(key)) for key in ("a", "a", "b")]
+        await asyncio.sleep(0)
+        # a 已经有一个在排队
+        with pytest.raises(SchedulerFull) as info:
+            await request("a")
+        assert info.value.retry_after >= 1
+        # 总共已有两个在排队
+        with pytest.raises(SchedulerFull):
+            await request("c")
+        assert scheduler.stats()["rejected"] == 2
+        release.set()
+        await asyncio.gather(*running)
+        assert scheduler.stats()["admitted"] == 3
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def main():
+        scheduler = ExecutionScheduler(max_concurrency=1, max_queue=10, max_queue_per_key=10)
+        release = asyncio.Event()
+        order = []
+
+        async def request(key: str):
+            async with scheduler.slot(key):
+                order.append(key)
+                await release.wait()
+
+        first = asyncio.ensure_future(request("a"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.ensure_future(request("b"))
+        waiting = asyncio.ensure_future(request("c"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 1
+        release.set()
+        await asyncio.gather(first, waiting)
+        assert order == ["a", "c"]
+        assert scheduler.running == 0
+
+    asyncio.run(main())
+
+
+def test_reports_queue_wait():
+    async def main():
+        scheduler = ExecutionScheduler(max_concurrency=1)
+
+        async def request():
+            async with scheduler.slot("a") as timing:
+                await asyncio.sleep(0.05)
+            return timing
+
+        first, second = await asyncio.gather(request(), request())
+        assert first["queue_wait"] < 0.05 <= second["queue_wait"]
+        assert second["duration"] >= 0.05
+
+    asyncio.run(main())
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from code_interpreter import session_manager
+from code_interpreter.session_manager import SessionManager
+
+
+class FakeKernel:
+    def __init__(self, pid: int):
+        self.kernel_pid = pid
+        self.kernel_attached = False
+
+
+class FakeInterpreter:
+    """Stands in for AsyncCodeInterpreter: a "kernel" is just a pid."""
+
+    def __init__(self, pid: int):
+        self.interpreter = FakeKernel(pid)
+        self.busy = False
+        self.snapshot_path = None
+        self.stopped = False
+
+        # hibernate 在保存快照前等待它，测试借此在保存期间发请求
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def stop(self, release: bool = False):
+        self.stopped = True
+        self.interpreter.kernel_pid = None
+
+    async def hibernate(self, path, max_bytes, max_variable_bytes, timeout):
+        await self.gate.wait()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb"):
+            pass
+        self.snapshot_path = path
+        await self.stop()
+        return {"saved": [], "skipped": {}, "bytes": 0}
+
+
+def make_manager(**kwargs) -> SessionManager:
+    pids = iter(range(100000, 200000))
+    kwargs.setdefault("hibernate", False)
+    return SessionManager(lambda api_key: FakeInterpreter(next(pids)), **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def fake_rss(monkeypatch):
+    """RSS of the fake kernels, by pid; 0 unless a test sets it."""
+    rss = {}
+    monkeypatch.setattr(session_manager, "_process_tree_rss", lambda pid: rss.get(pid, 0))
+    return rss
+
+
+def test_evicts_idle_sessions():
+    async def main():
+        manager = make_manager(idle_ttl=60)
+        old, fresh, busy = manager.get("old"), manager.get("fresh"), manager.get("busy")
+        busy.busy = True
+        for api_key in ("old", "busy"):
+            manager._sessions[api_key].last_used = time.time() - 120
+        await manager.sweep()
+        assert old.stopped and "old" not in manager
+        assert not fresh.stopped and "fresh" in manager
+        # 执行中的会话不会被回收，并且算作刚用过
+        assert not busy.stopped and "busy" in manager
+        assert manager.stats()["evictions"]["idle"] == 1
+
+    asyncio.run(main())
+
+
+def test_evicts_least_recently_used_over_max_kernels():
+    async def main():
+        manager = make_manager(max_kernels=2)
+        a, b, c = manager.get("a"), manager.get("b"), manager.get("c")
+        manager.get("a")
+        b.busy = True
+        await manager.sweep()
+        # b 最久未用但正在执行，回收下一个
+        assert c.stopped and not a.stopped and not b.stopped
+        assert "c" not in manager and "a" in manager and "b" in manager
+        assert manager.stats()["evictions"]["lru"] == 1
+        assert manager.stats()["live_kernels"] == 2
+
+    asyncio.run(main())
+
+
+def test_evicts_until_under_memory_budget(fake_rss):
+    async def main():
+        manager = make_manager(memory_budget_mb=100)
+        sessions = [manager.get(k) for k in ("a", "b", "c")]
+        for session in sessions:
+            fake_rss[session.interpreter.kernel_pid] = 40 * 2**20
+        await manager.sweep()
+        assert [s.stopped for s in sessions] == [True, False, False]
+        assert manager.stats()["evictions"]["memory"] == 1
+        assert manager.stats()["kernel_rss_mb"] == 80
+
+    asyncio.run(main())
+
+
+def test_release_and_shutdown():
+    async def main():
+        manager = make_manager()
+        a, b = manager.get("a"), manager.get("b")
+        await manager.remove("a")
+        assert a.stopped and "a" not in manager
+        # 释放之后再来的请求得到新的会话
+        assert manager.get("a") is not a
+        await manager.stop()
+        assert b.stopped and manager.stats()["sessions"] == 0
+
+    asyncio.run(main())
+
+
+def test_hibernated_sessions_expire(tmp_path):
+    async def main():
+        manager = make_manager(
+            idle_ttl=60, hibernate=True, hibernate_dir=str(tmp_path), hibernate_ttl=3600
+        )
+        interpreter = manager.get("a")
+        manager._sessions["a"].last_used = time.time() - 120
+        await manager.sweep()
+        assert manager.stats()["hibernated"] == 1 and manager.stats()["live_kernels"] == 0
+        assert os.path.exists(interpreter.snapshot_path)
+        # 休眠的会话只在 hibernate_ttl 之后才删除，连同快照
+        await manager.sweep()
+        assert "a" in manager
+        manager._sessions["a"].last_used = time.time() - 7200
+        await manager.sweep()
+        assert "a" not in manager and not os.path.exists(interpreter.snapshot_path)
+        assert manager.stats()["evictions"] == {"idle": 1, "lru": 0, "memory": 0, "expired": 1}
+
+    asyncio.run(main())
+
+
+def test_request_during_hibernation_keeps_session_awake(tmp_path):
+    async def main():
+        manager = make_manager(idle_ttl=60, hibernate=True, hibernate_dir=str(tmp_path))
+        interpreter = manager.get("a")
+        interpreter.gate.clear()
+        hibernating = asyncio.ensure_future(manager.hibernate("a"))
+        await asyncio.sleep(0)
+        assert manager.get("a") is interpreter
+        interpreter.gate.set()
+        await hibernating
+        # 新请求会恢复快照，这个会话仍按空闲时间回收
+        assert not manager._sessions["a"].hibernated
+        assert manager.stats()["hibernated"] == 0
+        manager._sessions["a"].last_used = time.time() - 120
+        await manager.sweep()
+        assert manager.stats()["evictions"]["idle"] == 2
+
+    asyncio.run(main())
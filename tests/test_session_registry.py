@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from code_interpreter.session_registry import (
+    MemorySessionStore,
+    SessionRegistry,
+    SessionStore,
+    SQLiteSessionStore,
+    create_session_registry,
+)
+
+
+@pytest.fixture
+def registries(tmp_path):
+    """Two registries on the same SQLite file, as in two worker processes."""
+    path = str(tmp_path / "sessions.db")
+    return SessionRegistry(SQLiteSessionStore(path)), SessionRegistry(SQLiteSessionStore(path))
+
+
+@pytest.fixture
+def connection_file(tmp_path):
+    path = tmp_path / "kernel-1.json"
+    path.write_text("{}")
+    return str(path)
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_lookup_and_unpublish_across_stores(registries, connection_file):
+    first, second = registries
+    # 用本进程的 pid 充当一个活着的 kernel
+    first.publish("a", os.getpid(), connection_file)
+    record = second.lookup("a")
+    assert record is not None
+    assert (record.kernel_pid, record.connection_file) == (os.getpid(), connection_file)
+    assert second.stats() == {"sessions": 1, "owned_by_this_worker": 1}
+    # 另一个 kernel 的记录不会被删掉
+    second.unpublish("a", os.getpid() + 1)
+    assert first.lookup("a") is not None
+    second.unpublish("a", os.getpid())
+    assert first.lookup("a") is None
+
+
+def test_touch_keeps_latest(registries, connection_file):
+    first, second = registries
+    first.publish("a", os.getpid(), connection_file)
+    later = time.time() + 100
+    assert first.touch({"a": later, "unknown": later}) == {"a": later}
+    assert second.touch({"a": later - 50}) == {"a": later}
+    assert second.touch({}) == {}
+
+
+@pytest.mark.parametrize("stale", ["dead kernel", "missing connection file"])
+def test_drops_stale_records(registries, connection_file, stale):
+    first, second = registries
+    if stale == "dead kernel":
+        first.publish("a", dead_pid(), connection_file)
+    else:
+        first.publish("a", os.getpid(), connection_file)
+        os.remove(connection_file)
+    assert second.lookup("a") is None
+    assert first.store.get("a") is None
+
+
+def test_claim_excludes_other_stores(registries):
+    first, second = registries
+    events = []
+
+    def claim_second():
+        with second.claim("a"):
+            events.append("second")
+
+    with first.claim("a"):
+        thread = threading.Thread(target=claim_second)
+        thread.start()
+        time.sleep(0.1)
+        # 其他 key 不受影响
+        with second.claim("b"):
+            events.append("other key")
+        events.append("first done")
+    thread.join(5)
+    assert events == ["other key", "first done", "second"]
+
+
+def test_create_session_registry(tmp_path):
+    assert create_session_registry("") is None
+    assert isinstance(create_session_registry("memory").store, MemorySessionStore)
+    registry = create_session_registry(f"sqlite://{tmp_path}/sessions.db")
+    assert isinstance(registry.store, SQLiteSessionStore)
+    with pytest.raises(ValueError):
+        create_session_registry("redis://localhost")
@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+from code_interpreter.download_cache import get_download_cache
+from code_interpreter.fanout import FanOutExecutor, _same_inputs
+from code_interpreter.result_cache import ResultCache
+
+READ_X = "print(open('x.txt').read())"
+
+
+def write(path, text: str) -> str:
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(text)
+    return str(path)
+
+
+def test_key_follows_file_content(tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+    a = write(tmp_path / "a" / "x.txt", "AAA")
+    b = write(tmp_path / "b" / "x.txt", "BBB")
+    inputs_a, inputs_b = cache.inputs([a]), cache.inputs([b])
+    # 同名文件内容不同，key 也不同
+    assert inputs_a[0][0] == inputs_b[0][0] == "x.txt"
+    assert cache.key(READ_X, inputs_a, 30) != cache.key(READ_X, inputs_b, 30)
+    assert cache.key(READ_X, inputs_a, 30) == cache.key(READ_X, cache.inputs([a]), 30)
+    assert cache.key(READ_X, inputs_a, 30) != cache.key(READ_X, inputs_a, 10)
+    # 保存下来的文件的 digest 与计算 key 时的一致
+    save_dir = tmp_path / "run"
+    save_dir.mkdir()
+    path, digest = get_download_cache().place(a, str(save_dir))
+    assert [(os.path.basename(path), digest)] == inputs_a
+
+
+def test_same_inputs():
+    a, b = ("x.txt", "1" * 64), ("x.txt", "2" * 64)
+    assert _same_inputs([a], [a])
+    assert _same_inputs([], [])
+    assert not _same_inputs(None, [a])
+    # 文件在计算 key 之后变了，或者没有保存成功
+    assert not _same_inputs([a], [b])
+    assert not _same_inputs([a], [None])
+    # 同名的两个文件只有一个能被看到
+    assert not _same_inputs([a, b], [a, b])
+
+
+def test_stateless_runs_see_only_their_files(tmp_path):
+    a = write(tmp_path / "a" / "x.txt", "AAA")
+    b = write(tmp_path / "b" / "x.txt", "BBB")
+
+    async def main():
+        executor = FanOutExecutor(
+            max_kernels=2,
+            work_dir=str(tmp_path / "work"),
+            result_cache=ResultCache(cache_dir=str(tmp_path / "cache")),
+        )
+        try:
+            runs = [executor.execute(READ_X, files=[f]) for f in (a, b, a, b)]
+            first = await asyncio.gather(*runs)
+            second = await asyncio.gather(executor.execute(READ_X, files=[a]),
+                                          executor.execute(READ_X, files=[b]))
+            write(tmp_path / "a" / "x.txt", "CCC")
+            changed = await executor.execute(READ_X, files=[a])
+        finally:
+            await executor.stop()
+        return first, second, changed
+
+    first, second, changed = asyncio.run(main())
+    for result, expected in zip(first + second, ["AAA", "BBB"] * 3):
+        assert result["status"] == "success"
+        assert expected in result["result"]
+    assert all(result["cached"] for result in second)
+    assert not changed["cached"] and "CCC" in changed["result"]
+    # 每次执行的目录用完即删
+    assert os.listdir(tmp_path / "work" / "runs") == []
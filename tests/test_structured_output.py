@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from code_interpreter.interpreter import CodeInterpreter
+from code_interpreter.output_buffer import OutputList
+from ws_server import receive_message, send_message
+
+PNG = b"\x89PNG" + b"x" * 100
+
+
+class FakeWebSocket:
+    """Records what is sent and replays ``received`` ASGI messages."""
+
+    def __init__(self, *received):
+        self.received = list(received)
+        self.sent = []
+
+    async def receive(self):
+        return self.received.pop(0)
+
+    async def send_text(self, text: str):
+        self.sent.append(text)
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append(data)
+
+
+def parse(msg_type: str, content: dict, image_data: bool = False):
+    # 只用到 _serve_image，不需要启动 kernel
+    interpreter = SimpleNamespace(
+        _serve_image=lambda image, mime: f"/static/images/x.{mime.split('/')[1]}"
+    )
+    msg = {"msg_type": msg_type, "content": content}
+    return CodeInterpreter._parse_output(interpreter, msg, image_data=image_data)
+
+
+def test_parse_output_kinds():
+    assert parse("stream", {"name": "stderr", "text": "warn"}) == {
+        "kind": "stream",
+        "name": "stderr",
+        "mime": "text/plain",
+        "text": "warn",
+    }
+    assert parse("execute_result", {"execution_count": 2, "data": {"text/plain": "3"}}) == {
+        "kind": "execute_result",
+        "execution_count": 2,
+        "mime": "text/plain",
+        "text": "3",
+    }
+    assert parse("execute_input", {"code": "1 + 2", "execution_count": 2}) == {
+        "kind": "execute_input",
+        "execution_count": 2,
+    }
+    error = parse(
+        "error",
+        {
+            "ename": "ZeroDivisionError",
+            "evalue": "division by zero",
+            "traceback": ["\x1b[0;31ma", "b"],
+        },
+    )
+    assert error == {
+        "kind": "error",
+        "mime": "text/plain",
+        "ename": "ZeroDivisionError",
+        "evalue": "division by zero",
+        "text": "a\nb",
+    }
+    # 没有可用内容的消息跳过
+    assert parse("display_data", {"data": {"text/html": "<b>x</b>"}}) is None
+    assert parse("status", {"execution_state": "idle"}) is None
+
+
+@pytest.mark.parametrize("mime", ["image/png", "image/jpeg"])
+def test_parse_output_images(mime):
+    data = {mime: base64.b64encode(PNG).decode(), "text/plain": "<Figure>"}
+    extension = mime.split("/")[1]
+    assert parse("display_data", {"data": data}) == {
+        "kind": "display_data",
+        "mime": mime,
+        "url": f"/static/images/x.{extension}",
+    }
+    assert parse("display_data", {"data": data}, image_data=True) == {
+        "kind": "display_data",
+        "mime": mime,
+        "data": PNG,
+    }
+
+
+def test_error_and_execution_count_in_result():
+    outputs = OutputList()
+    for msg_type, content in [
+        ("execute_input", {"code": "1 / 0", "execution_count": 5}),
+        ("stream", {"name": "stdout", "text": "hi\n"}),
+        ("error", {"ename": "ZeroDivisionError", "evalue": "division by zero", "traceback": []}),
+    ]:
+        outputs.add(parse(msg_type, content))
+    result = outputs.result()
+    assert result["execution_count"] == 5
+    assert (result["ename"], result["evalue"]) == ("ZeroDivisionError", "division by zero")
+    assert [o["kind"] for o in result["outputs"]] == ["stream", "error"]
+
+
+def test_receive_message():
+    msgpack = pytest.importorskip("msgpack")
+
+    async def main():
+        request = {"action": "execute", "code": "1"}
+        websocket = FakeWebSocket(
+            {"type": "websocket.receive", "text": json.dumps(request)},
+            {"type": "websocket.receive", "bytes": msgpack.packb(request)},
+            {"type": "websocket.disconnect", "code": 1001},
+        )
+        assert await receive_message(websocket) == (request, False)
+        assert await receive_message(websocket) == (request, True)
+        with pytest.raises(WebSocketDisconnect):
+            await receive_message(websocket)
+
+    asyncio.run(main())
+
+
+def test_send_message():
+    msgpack = pytest.importorskip("msgpack")
+
+    async def main():
+        data = {"status": "success", "outputs": [{"kind": "display_data", "data": PNG}]}
+        websocket = FakeWebSocket()
+        await send_message(websocket, {"result": "中文"})
+        await send_message(websocket, data, "msgpack")
+        text, frame = websocket.sent
+        assert text == '{"result":"中文"}'
+        # 图片以原始字节发送，不经过 base64
+        assert isinstance(frame, bytes) and PNG in frame
+        assert msgpack.unpackb(frame) == data
+
+    asyncio.run(main())
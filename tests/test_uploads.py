@@ -0,0 +1,117 @@
+import asyncio
+import os
+
+import pytest
+
+from code_interpreter.uploads import (
+    MultipartParser,
+    UploadError,
+    part_filename,
+    save_multipart,
+)
+
+BOUNDARY = "----m6boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart_body(parts, close=True) -> bytes:
+    body = b"preamble\r\n"
+    for disposition, data in parts:
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + data
+        body += b"\r\n"
+    if close:
+        body += f"--{BOUNDARY}--\r\nepilogue".encode()
+    return body
+
+
+def file_part(name: str, data: bytes):
+    return f'form-data; name="file"; filename="{name}"', data
+
+
+def parse(body: bytes, chunk_size: int):
+    parser = MultipartParser(BOUNDARY.encode())
+    parts = []
+    for i in range(0, len(body), chunk_size):
+        for event, value in parser.feed(body[i : i + chunk_size]):
+            if event == "headers":
+                parts.append([value, b"", False])
+            elif event == "data":
+                parts[-1][1] += value
+            else:
+                parts[-1][2] = True
+    return parser, parts
+
+
+async def stream(body: bytes, chunk_size: int = 5):
+    for i in range(0, len(body), chunk_size):
+        yield body[i : i + chunk_size]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 17, 10**6])
+def test_parser_is_independent_of_chunking(chunk_size):
+    # 第二部分的内容里有不完整的分隔符
+    tricky = b"x\r\n--" + BOUNDARY.encode()[:-1] + b"\r\n--"
+    body = multipart_body(
+        [file_part("a.txt", b"hello"), file_part("b.bin", tricky), ('form-data; name="f"', b"")]
+    )
+    parser, parts = parse(body, chunk_size)
+    assert parser.done
+    assert [data for _, data, _ in parts] == [b"hello", tricky, b""]
+    assert all(complete for _, _, complete in parts)
+    assert part_filename(parts[0][0]) == "a.txt"
+    assert part_filename(parts[2][0]) is None
+
+
+def test_parser_rejects_huge_headers():
+    parser = MultipartParser(BOUNDARY.encode())
+    parser.feed(f"--{BOUNDARY}\r\nX-Padding: ".encode())
+    with pytest.raises(UploadError):
+        parser.feed(b"x" * 20000)
+
+
+def test_part_filename_strips_client_paths():
+    def disposition(value):
+        return {"content-disposition": f"form-data; name=file; {value}"}
+
+    assert part_filename(disposition('filename="C:\\data\\a.csv"')) == "a.csv"
+    assert part_filename(disposition('filename="../../etc/passwd"')) == "passwd"
+    assert part_filename(disposition("filename*=UTF-8''%E6%95%B0.csv")) == "%E6%95%B0.csv"
+    with pytest.raises(UploadError):
+        part_filename(disposition('filename=".."'))
+
+
+def test_save_multipart(tmp_path):
+    body = multipart_body([file_part("a.txt", b"A" * 100), file_part("b.txt", b"B")])
+    saved = asyncio.run(save_multipart(stream(body), CONTENT_TYPE, str(tmp_path)))
+    assert [(f["name"], f["size"]) for f in saved] == [("a.txt", 100), ("b.txt", 1)]
+    assert (tmp_path / "a.txt").read_bytes() == b"A" * 100
+    assert sorted(os.listdir(tmp_path)) == ["a.txt", "b.txt"]
+
+
+@pytest.mark.parametrize(
+    "body, kwargs, status_code",
+    [
+        # 请求体不完整
+        (multipart_body([file_part("a.txt", b"A")], close=False), {}, 400),
+        # 第二个文件超出大小上限
+        (multipart_body([file_part("a.txt", b"A"), file_part("b.txt", b"B" * 64)]),
+         {"max_bytes": 100}, 413),
+        # 第二个文件使用保留的名字
+        (multipart_body([file_part("a.txt", b"A"), file_part("images", b"B")]),
+         {"reserved_names": ("images",)}, 400),
+    ],
+)
+def test_failed_upload_leaves_nothing(tmp_path, body, kwargs, status_code):
+    with pytest.raises(UploadError) as info:
+        asyncio.run(save_multipart(stream(body), CONTENT_TYPE, str(tmp_path), **kwargs))
+    assert info.value.status_code == status_code
+    assert os.listdir(tmp_path) == []
+
+
+def test_upload_does_not_replace_directories(tmp_path):
+    (tmp_path / "outputs").mkdir()
+    body = multipart_body([file_part("outputs", b"x")])
+    with pytest.raises(UploadError) as info:
+        asyncio.run(save_multipart(stream(body), CONTENT_TYPE, str(tmp_path)))
+    assert info.value.status_code == 400
+    assert os.listdir(tmp_path) == ["outputs"]
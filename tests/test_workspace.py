@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+
+from code_interpreter.interpreter import get_connection_dir
+from code_interpreter.routes import file_routes
+from code_interpreter.workspace import QuotaExceeded, WorkspaceManager
+
+MB = 2**20
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("M6_CODE_INTERPRETER_WORK_DIR", str(tmp_path))
+    return tmp_path
+
+
+def write(path, size: int = 0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fout:
+        fout.write(b"x" * size)
+
+
+def asgi_request(app, method: str, path: str, headers: dict, body: bytes):
+    """Send one HTTP request straight to an ASGI app; returns (status, JSON body)."""
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 1234),
+        "server": ("127.0.0.1", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    content = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return status, json.loads(content)
+
+
+def test_quota():
+    workspaces = WorkspaceManager(quota_mb=1)
+    workspaces.check("a")
+    assert workspaces.upload_limit("a", 10 * MB) == MB
+    workspaces.add("a", MB // 4)
+    # 上传不能超过配额剩下的空间，0 表示只受配额限制
+    assert workspaces.upload_limit("a", 10 * MB) == 3 * MB // 4
+    assert workspaces.upload_limit("a", MB // 8) == MB // 8
+    assert workspaces.upload_limit("a", 0) == 3 * MB // 4
+    write(os.path.join(workspaces.path("a"), "big.bin"), MB)
+    workspaces.measure(["a"])
+    with pytest.raises(QuotaExceeded):
+        workspaces.check("a")
+    workspaces.check("b")
+    assert workspaces.stats()["over_quota"] == 1
+    os.remove(os.path.join(workspaces.path("a"), "big.bin"))
+    workspaces.measure(["a"])
+    workspaces.check("a")
+    assert WorkspaceManager(quota_mb=0).upload_limit("a", 0) == 0
+
+
+def test_upload_over_quota_is_507():
+    workspaces = WorkspaceManager(quota_mb=1)
+    sessions = SimpleNamespace(
+        get=lambda api_key: SimpleNamespace(
+            interpreter=SimpleNamespace(work_dir=workspaces.path(api_key))
+        )
+    )
+    app = FastAPI()
+    app.include_router(file_routes(sessions, workspaces))
+    boundary = "m6"
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n\r\n'
+        f"hello\r\n--{boundary}--\r\n"
+    ).encode()
+    headers = {"X-API-Key": "a", "Content-Type": f"multipart/form-data; boundary={boundary}"}
+    status, result = asgi_request(app, "POST", "/upload", headers, body)
+    assert status == 200 and result["files"] == [{"name": "a.txt", "size": 5}]
+    assert workspaces.usage("a") == 5
+    workspaces.add("a", MB)
+    status, result = asgi_request(app, "POST", "/upload", headers, body)
+    assert status == 507 and "quota" in result["detail"]
+    status, result = asgi_request(app, "GET", "/workspace", {"X-API-Key": "a"}, b"")
+    assert status == 200 and result["usage_mb"] == 5 / MB
+
+
+def test_collect(tmp_path):
+    workspaces = WorkspaceManager(artifact_ttl=0.2)
+    active, other, hibernated = (workspaces.path(k) for k in ("active", "other", "hibernated"))
+    for path in (active, other, hibernated):
+        write(os.path.join(path, "data.csv"), 10)
+    write(os.path.join(active, "images", "old.png"))
+    write(os.path.join(active, "outputs", "old.md"))
+    hibernate_dir = tmp_path / "hibernate"
+    write(os.path.join(hibernate_dir, f"{os.path.basename(hibernated)}.pkl"))
+    time.sleep(0.3)
+    write(os.path.join(active, "images", "new.png"))
+    workspaces.collect(["active"], str(hibernate_dir))
+    # 活跃会话只清理过期的图片和输出，用户文件保留
+    assert sorted(os.listdir(active)) == ["data.csv", "images", "outputs"]
+    assert os.listdir(os.path.join(active, "images")) == ["new.png"]
+    assert os.listdir(os.path.join(active, "outputs")) == []
+    # 很久没用的工作目录删除，休眠会话的保留
+    assert not os.path.exists(other) and os.path.exists(hibernated)
+    assert workspaces.stats()["removed"] == 1 and workspaces.stats()["expired_files"] == 2
+
+
+def test_remove_and_dead_connection_dirs():
+    workspaces = WorkspaceManager()
+    write(os.path.join(workspaces.path("a"), "data.csv"), 10)
+    workspaces.measure(["a"])
+    workspaces.remove("a")
+    assert not os.path.exists(workspaces.path("a")) and workspaces.usage("a") == 0
+
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    dead, alive = get_connection_dir(process.pid), get_connection_dir()
+    for path in (dead, alive):
+        write(os.path.join(path, "kernel.json"))
+    workspaces.collect([])
+    assert not os.path.exists(dead) and os.path.exists(alive)
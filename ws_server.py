@@ -1,35 +1,183 @@
 import asyncio
 import json
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import uvicorn
-from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.security import APIKeyHeader
 
-from code_interpreter.interpreter import CodeInterpreter
+from code_interpreter.async_interpreter import AsyncCodeInterpreter
+from code_interpreter.datasets import DatasetNotFound
+from code_interpreter.fanout import FanOutExecutor
+from code_interpreter.image_store import STATIC_CACHE_CONTROL, resolve_static_file
+from code_interpreter.interpreter import get_default_work_dir
+from code_interpreter.config import STREAM_FLUSH_INTERVAL
+from code_interpreter.kernel_pool import KernelPool
 from code_interpreter.logger import logging
+from code_interpreter.metrics import (
+    CONTENT_TYPE,
+    PHASE_SECONDS,
+    REGISTRY,
+    InstrumentedThreadPoolExecutor,
+    track_server,
+)
+from code_interpreter.result_cache import ResultCache
+from code_interpreter.routes import file_routes
+from code_interpreter.scheduler import ExecutionScheduler, SchedulerFull
+from code_interpreter.session_manager import SessionManager
+from code_interpreter.session_registry import create_session_registry
+from code_interpreter.workspace import QuotaExceeded, WorkspaceManager
+
+try:
+    # 可选：msgpack 编码的二进制帧，图片直接以字节发送
+    import msgpack
+except ImportError:
+    msgpack = None
 
 app = FastAPI()
 
-interpreters: Dict[str, CodeInterpreter] = {}
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key")
+kernel_pool = KernelPool()
+# 多 worker 部署时共享的会话注册表，请求落到其他 worker 时连接已有的 kernel
+registry = create_session_registry()
+# 每个 API key 独立的工作目录，有磁盘配额，后台定期清理过期的文件
+workspaces = WorkspaceManager()
+sessions = SessionManager(
+    lambda api_key: AsyncCodeInterpreter(
+        {"work_dir": workspaces.path(api_key)},
+        kernel_pool=kernel_pool,
+        registry=registry,
+        session_key=api_key,
+    ),
+    registry=registry,
+    workspaces=workspaces,
+)
+# 无状态执行(并行 map 与 stateless 请求)使用的 kernel，与会话的 kernel 分开；
+# stateless 请求的结果会被缓存
+fanout = FanOutExecutor(kernel_pool, result_cache=ResultCache())
+# 执行请求的准入控制：并发数有上限，按 API key 轮流排队，排满后直接拒绝
+scheduler = ExecutionScheduler()
+# 上传、共享数据集与工作目录的接口，与 HTTP 服务相同
+app.include_router(file_routes(sessions, workspaces))
+
+
+def get_interpreter(api_key: str) -> AsyncCodeInterpreter:
+    return sessions.get(api_key)
+
+
+@app.on_event("startup")
+async def startup():
+    # 默认线程池也换成能统计占用情况的版本
+    asyncio.get_running_loop().set_default_executor(InstrumentedThreadPoolExecutor("default"))
+    track_server(kernel_pool, sessions, fanout, scheduler)
+    kernel_pool.start()
+    await sessions.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await sessions.stop()
+    await fanout.stop()
+    kernel_pool.stop()
+
+
+async def remove_interpreter(api_key: str):
+    await sessions.remove(api_key)  # 关闭 kernel
+
+
+@app.get("/pool")
+def pool_stats():
+    return kernel_pool.stats()
+
+
+@app.get("/sessions")
+def session_stats():
+    return sessions.stats()
+
+
+@app.get("/fanout")
+def fanout_stats():
+    return fanout.stats()
+
+
+@app.get("/scheduler")
+def scheduler_stats():
+    return scheduler.stats()
 
-executor = ThreadPoolExecutor(max_workers=50) # 设置最大线程数为 50
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.generate_latest(), media_type=CONTENT_TYPE)
 
-def get_interpreter(api_key: str) -> CodeInterpreter:
-    if api_key not in interpreters:
-        interpreters[api_key] = CodeInterpreter()
-    return interpreters[api_key]
 
+@app.get("/static/{path:path}")
+def static_file(path: str):
+    # 代码生成的图片，把 M6_CODE_INTERPRETER_STATIC_URL 设为 http://<host>:<port>/static 即可
+    local_file = resolve_static_file(get_default_work_dir(), path)
+    if local_file is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(local_file, headers={"Cache-Control": STATIC_CACHE_CONTROL})
 
-def remove_interpreter(api_key: str):
-    if api_key in interpreters:
-        interpreter = interpreters.pop(api_key)
-        interpreter.__del__() # 手动调用 interpreter 的 __del__ 方法
-        logging.info(f"Removed interpreter for API key: {api_key}")
+
+async def receive_message(websocket: WebSocket) -> Tuple[Dict, bool]:
+    """The next request, sent as JSON text or as a msgpack binary frame, and
+    whether it was binary."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        if msgpack is None:
+            raise RuntimeError("Binary frames need msgpack, which is not installed")
+        return msgpack.unpackb(message["bytes"]), True
+    return json.loads(message["text"]), False
+
+
+async def send_message(websocket: WebSocket, data: Dict, encoding: str = "json"):
+    # JSON 与 WebSocket.send_json 的编码相同，只是单独统计序列化耗时；msgpack 编码时发送二进制帧
+    with PHASE_SECONDS.time("serialization"):
+        if encoding == "msgpack":
+            payload = msgpack.packb(data, use_bin_type=True)
+        else:
+            text = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    if encoding == "msgpack":
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(text)
+
+
+def rejected(e: SchedulerFull) -> Dict:
+    # WebSocket 没有 429，返回错误并带上建议的重试间隔(秒)
+    return {"result": str(e), "status": "error", "retry_after": e.retry_after}
+
+
+async def stream_execution(
+    websocket: WebSocket,
+    interpreter: AsyncCodeInterpreter,
+    code: str,
+    files: List[str],
+    timeout: Optional[float],
+    flush_interval: float,
+    timing: Dict[str, float],
+    datasets: List[str],
+    output_format: str,
+    encoding: str,
+):
+    # 每个输出（合并后的 stdout/stderr、图片、报错等）单独发一帧，最后是 done 帧
+    async for event in interpreter.stream(
+        params=json.dumps({"code": code}),
+        files=files,
+        timeout=timeout,
+        flush_interval=flush_interval,
+        datasets=datasets,
+        output_format=output_format,
+        image_data=encoding == "msgpack",
+    ):
+        if event.get("type") == "done":
+            # 已经包括在 kernel 中排队的时间
+            event = {**event, "queue_wait": timing["queue_wait"]}
+        await send_message(websocket, event, encoding)
 
 
 @app.websocket("/ws")
@@ -41,41 +189,156 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close(code=4000, reason="API Key is required")
         return
 
-    interpreter = get_interpreter(api_key)
-
     try:
         while True:
-            data = await websocket.receive_json()
+            data, binary = await receive_message(websocket)
+            # 默认按请求的编码回复；msgpack 时结构化输出中的图片是原始字节
+            encoding = data.get("encoding", "msgpack" if binary else "json")
+            if encoding == "msgpack" and msgpack is None:
+                error = {"result": "msgpack is not installed", "status": "error"}
+                await send_message(websocket, error)
+                continue
+            output_format = data.get("output_format", "markdown")
             if data["type"] == "execute":
                 code = data["code"]
                 files = data.get("files", [])
                 timeout = data.get("timeout", 30)
+                stream = data.get("stream", False)
+                stateless = data.get("stateless", False)
+                datasets = data.get("datasets", [])
                 logging.info(f"Received request: {data}")
-
-                try:
-                    # 在线程池中运行同步的 interpreter.call 方法
-                    future = executor.submit(
-                        interpreter.call, params=json.dumps({"code": code}), files=files, timeout=timeout
+                if stateless and (datasets or output_format != "markdown"):
+                    # 结果缓存的键里没有数据集，缓存的也只有 markdown 结果
+                    final = {"type": "done"} if stream else {}
+                    error = (
+                        "Datasets are not supported in stateless executions"
+                        if datasets
+                        else "Structured output is not supported in stateless executions"
                     )
-
-                    # 等待结果，设置超时
-                    result = await asyncio.get_event_loop().run_in_executor(
-                        None, future.result, timeout
+                    await send_message(
+                        websocket, {**final, "result": error, "status": "error"}, encoding
                     )
-                    await websocket.send_json({"result": result, "status": "success"})
-                except TimeoutError:
-                    logging.warning(f"Execution timed out after {timeout} seconds")
-                    remove_interpreter(api_key)
-                    await websocket.send_json({"result": f"Execution timed out after {timeout} seconds", "status": "error"})
-                    await websocket.close(code=4000, reason="Execution timed out")
+                    continue
+
+                try:
+                    if not stateless:
+                        workspaces.check(api_key)
+                    async with scheduler.slot(api_key) as timing:
+                        # 每次请求都重新获取，会话可能已被回收；无状态执行不需要会话
+                        interpreter = None if stateless else get_interpreter(api_key)
+                        if stateless:
+                            # 无状态执行不分帧，直接返回(可能来自缓存的)完整结果
+                            outcome = await fanout.execute(
+                                code,
+                                files=files,
+                                timeout=timeout,
+                                bypass_cache=data.get("bypass_cache", False),
+                            )
+                        elif stream:
+                            await stream_execution(
+                                websocket,
+                                interpreter,  # type: ignore
+                                code,
+                                files,
+                                timeout,
+                                data.get("flush_interval", STREAM_FLUSH_INTERVAL),
+                                timing,
+                                datasets,
+                                output_format,
+                                encoding,
+                            )
+                        else:
+                            # 超时由 interpreter 在服务端处理：先中断 kernel，必要时再重启
+                            outcome = await interpreter.execute(  # type: ignore
+                                params=json.dumps({"code": code}),
+                                files=files,
+                                timeout=timeout,
+                                datasets=datasets,
+                                output_format=output_format,
+                                image_data=encoding == "msgpack",
+                            )
+                    if stateless:
+                        final = {"type": "done"} if stream else {}
+                        await send_message(websocket, {**final, **outcome, **timing}, encoding)
+                    elif not stream and output_format == "structured":
+                        await send_message(websocket, {**outcome, **timing}, encoding)
+                    elif not stream:
+                        response = {"result": outcome["result"], "status": outcome["status"]}
+                        if outcome["recovery"]:
+                            response["recovery"] = outcome["recovery"]
+                        if outcome.get("restore"):
+                            response["restore"] = outcome["restore"]
+                        # 排队等待与执行的耗时分开返回
+                        await send_message(websocket, {**response, **timing}, encoding)
+                except WebSocketDisconnect:
+                    raise
+                except SchedulerFull as e:
+                    final = {"type": "done"} if stream else {}
+                    await send_message(websocket, {**final, **rejected(e)}, encoding)
+                except (DatasetNotFound, QuotaExceeded) as e:
+                    # 请求本身有误或工作目录已满，会话不受影响
+                    final = {"type": "done"} if stream else {}
+                    error = {**final, "result": str(e), "status": "error"}
+                    await send_message(websocket, error, encoding)
+                except Exception as e:
+                    if not stateless:
+                        await remove_interpreter(api_key)
+                    # 流式模式下，结束帧(包括出错时)都带上 "type": "done"
+                    final = {"type": "done"} if stream else {}
+                    error = {**final, "result": str(e), "status": "error"}
+                    await send_message(websocket, error, encoding)
+            elif data["type"] == "execute_batch":
+                logging.info(f"Received batch request: {data}")
+                try:
+                    workspaces.check(api_key)
+                    async with scheduler.slot(api_key) as timing:
+                        results = await get_interpreter(api_key).execute_batch(
+                            cells=data["cells"],
+                            files=data.get("files", []),
+                            timeout=data.get("timeout", 30),
+                            stop_on_error=data.get("stop_on_error", True),
+                            datasets=data.get("datasets", []),
+                            output_format=output_format,
+                            image_data=encoding == "msgpack",
+                        )
+                    status = "success" if all(r["status"] == "success" for r in results) else "error"
+                    response = {"results": results, "status": status, **timing}
+                    await send_message(websocket, response, encoding)
+                except WebSocketDisconnect:
+                    raise
+                except SchedulerFull as e:
+                    await send_message(websocket, rejected(e), encoding)
+                except (DatasetNotFound, QuotaExceeded) as e:
+                    await send_message(websocket, {"result": str(e), "status": "error"}, encoding)
+                except Exception as e:
+                    await remove_interpreter(api_key)
+                    await send_message(websocket, {"result": str(e), "status": "error"}, encoding)
+            elif data["type"] == "map":
+                logging.info(f"Received map request: {data}")
+                try:
+                    async with scheduler.slot(api_key) as timing:
+                        results = await fanout.map(
+                            snippets=data["snippets"],
+                            setup=data.get("setup"),
+                            files=data.get("files", []),
+                            timeout=data.get("timeout", 30),
+                        )
+                    status = "success" if all(r["status"] == "success" for r in results) else "error"
+                    response = {"results": results, "status": status, **timing}
+                    await send_message(websocket, response, encoding)
+                except WebSocketDisconnect:
+                    raise
+                except SchedulerFull as e:
+                    await send_message(websocket, rejected(e), encoding)
                 except Exception as e:
-                    remove_interpreter(api_key)
-                    await websocket.send_json({"result": str(e), "status": "error"})
+                    await send_message(websocket, {"result": str(e), "status": "error"}, encoding)
             elif data["type"] == "release":
-                remove_interpreter(api_key)
-                await websocket.send_json({"result": "Interpreter released", "status": "success"})
+                await remove_interpreter(api_key)
+                response = {"result": "Interpreter released", "status": "success"}
+                await send_message(websocket, response, encoding)
             else:
-                await websocket.send_json({"result": "Unknown request type", "status": "error"})
+                response = {"result": "Unknown request type", "status": "error"}
+                await send_message(websocket, response, encoding)
     except WebSocketDisconnect:
         logging.info("WebSocket disconnected")
 